@@ -20,6 +20,18 @@ def prepare_denovo_command(mgf_dir, denovout_dir, config):
         kaiko_1_args = kaiko_1_args + ["--multi_decode"]
     if config['denovo']['beam_search']:
         kaiko_1_args = kaiko_1_args + ["--beam_search", "--beam_size", config['denovo']['beam_size']]     
+    if config['denovo'].get('num_workers', 1) > 1:
+        kaiko_1_args = kaiko_1_args + ["--num_workers", config['denovo']['num_workers']]
+    if config['denovo'].get('frozen_model'):
+        kaiko_1_args = kaiko_1_args + ["--frozen_model", config['denovo']['frozen_model']]
+    if config['denovo'].get('inference_precision', 'float32') != 'float32':
+        kaiko_1_args = kaiko_1_args + ["--inference_precision", config['denovo']['inference_precision']]
+    if config['denovo'].get('precursor_ppm', 0) > 0:
+        kaiko_1_args = kaiko_1_args + ["--precursor_ppm", config['denovo']['precursor_ppm']]
+    if config['denovo'].get('precursor_mass_tolerance', 0.01) != 0.01:
+        kaiko_1_args = kaiko_1_args + ["--precursor_mass_tolerance", config['denovo']['precursor_mass_tolerance']]
+    if config['denovo'].get('knapsack_precision', 100) != 100:
+        kaiko_1_args = kaiko_1_args + ["--knapsack_precision", config['denovo']['knapsack_precision']]
 
     print("DeNovo: Running the following command:\n")
     for i in range(len(kaiko_1_args)):
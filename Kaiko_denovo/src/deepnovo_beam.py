@@ -0,0 +1,169 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Array-backed beam of decode_beam_search_01().
+
+The paths under search are kept as a struct of arrays (Beam) instead of
+[[AA ids], prefix_mass, score, c_state, h_state] lists, and their AA ids as
+parent pointers in a PathTree, so that a step is a few numpy gathers.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class PathTree(object):
+  """AA ids of the beam paths as a tree of parent pointers.
+
+     A path is identified by the node of its last AA id; extending a path
+     adds one node instead of copying its AA ids.
+  """
+
+
+  def __init__(self, capacity=4096):
+    """Start an empty tree, its arrays grow past capacity as needed."""
+
+    self.token = np.zeros(capacity, dtype=np.int8)
+    self.parent = np.zeros(capacity, dtype=np.int32)
+    self.size = 0
+
+
+  def add(self, parent, token):
+    """Add nodes token[i] under parent[i] (-1 for a root), return their ids."""
+
+    count = len(token)
+    if self.size + count > len(self.token):
+      capacity = max(2 * len(self.token), self.size + count)
+      self.token = np.resize(self.token, capacity)
+      self.parent = np.resize(self.parent, capacity)
+    self.token[self.size:self.size+count] = token
+    self.parent[self.size:self.size+count] = parent
+    self.size += count
+    return np.arange(self.size - count, self.size, dtype=np.int32)
+
+
+  def path(self, node):
+    """Return the AA ids from the root to node as a list."""
+
+    node_list = []
+    while node >= 0:
+      node_list.append(node)
+      node = self.parent[node]
+    return self.token[node_list[::-1]].tolist()
+
+
+class Beam(object):
+  """Paths under search, path i is
+       spectrum_id[i]: index of its spectrum in the data set,
+       node[i]: its last node in the PathTree,
+       AA_id_1[i], AA_id_2[i]: its last 2 AA ids, the model inputs,
+       prefix_mass[i], score[i],
+       c_state[i], h_state[i]: its lstm state.
+     The arrays are preallocated for max_paths paths and the first size are
+     in use. The paths of a spectrum are contiguous.
+  """
+
+
+  def __init__(self, max_paths, num_units, state_dtype=np.float32):
+    """Allocate the arrays of max_paths paths of num_units lstm units."""
+
+    self.max_paths = max_paths
+    self.size = 0
+    self.spectrum_id = np.zeros(max_paths, dtype=np.int64)
+    self.node = np.zeros(max_paths, dtype=np.int32)
+    self.AA_id_1 = np.zeros(max_paths, dtype=np.int32)
+    self.AA_id_2 = np.zeros(max_paths, dtype=np.int32)
+    self.prefix_mass = np.zeros(max_paths, dtype=np.float64)
+    self.score = np.zeros(max_paths, dtype=np.float64)
+    self.c_state = np.zeros((max_paths, num_units), dtype=state_dtype)
+    self.h_state = np.zeros((max_paths, num_units), dtype=state_dtype)
+
+
+  def clear(self):
+    """Remove all paths, the arrays are kept for reuse."""
+
+    self.size = 0
+
+
+  def append(self,
+             spectrum_id,
+             node,
+             AA_id_1,
+             AA_id_2,
+             prefix_mass,
+             score,
+             c_state,
+             h_state):
+    """Append paths, the arguments are arrays (or scalars) of their fields."""
+
+    start = self.size
+    end = start + len(spectrum_id)
+    assert end <= self.max_paths, "Error: beam overflow"
+    self.spectrum_id[start:end] = spectrum_id
+    self.node[start:end] = node
+    self.AA_id_1[start:end] = AA_id_1
+    self.AA_id_2[start:end] = AA_id_2
+    self.prefix_mass[start:end] = prefix_mass
+    self.score[start:end] = score
+    self.c_state[start:end] = c_state
+    self.h_state[start:end] = h_state
+    self.size = end
+
+
+def segment_starts(spectrum_id):
+  """Return the start indices of the runs of equal spectrum_id."""
+
+  if len(spectrum_id) == 0:
+    return np.zeros(0, dtype=np.int64)
+  return np.flatnonzero(np.r_[True, spectrum_id[1:] != spectrum_id[:-1]])
+
+
+def select_top_paths(path_score,
+                     candidate_score,
+                     candidate_mask,
+                     spectrum_id,
+                     beam_size):
+  """Extend the paths by their candidate AA ids, keep the top of each spectrum.
+
+     path_score[i] is the score of path i, candidate_score[i, aa_id] what
+     extending it by aa_id adds and candidate_mask[i, aa_id] whether aa_id
+     is a candidate of path i. The paths of a spectrum are contiguous in
+     spectrum_id.
+     The new paths are laid out as a [spectra, paths * vocab_size] score
+     matrix (-inf where there is no candidate) and the top beam_size of all
+     spectra are found by one np.argpartition() along its rows.
+     Return (path_index, AA_id, score) of the kept new paths, ordered by
+     spectrum.
+  """
+
+  path_count, vocab_size = candidate_mask.shape
+  starts = segment_starts(spectrum_id)
+  lengths = np.diff(np.r_[starts, path_count])
+  segment = np.repeat(np.arange(len(starts)), lengths)
+  rank = np.arange(path_count) - np.repeat(starts, lengths)
+  max_length = int(lengths.max()) if path_count else 1
+
+  new_score = np.full((len(starts), max_length, vocab_size), -np.inf)
+  new_mask = np.zeros((len(starts), max_length, vocab_size), dtype=bool)
+  new_score[segment, rank] = np.where(candidate_mask,
+                                      path_score[:, np.newaxis] + candidate_score,
+                                      -np.inf)
+  new_mask[segment, rank] = candidate_mask
+  new_score = new_score.reshape(len(starts), -1)
+  new_mask = new_mask.reshape(len(starts), -1)
+
+  top_k = min(beam_size, new_score.shape[1])
+  top_k_column = np.argpartition(-new_score, top_k - 1, axis=1)[:, :top_k]
+  top_k_row = np.repeat(np.arange(len(starts)), top_k).reshape(-1, top_k)
+  kept = new_mask[top_k_row, top_k_column]
+  top_k_row = top_k_row[kept]
+  top_k_column = top_k_column[kept]
+
+  path_index = starts[top_k_row] + top_k_column // vocab_size
+  AA_id = top_k_column % vocab_size
+  return path_index, AA_id, new_score[top_k_row, top_k_column]
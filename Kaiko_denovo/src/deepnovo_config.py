@@ -13,6 +13,9 @@ from six.moves import xrange
 import numpy as np
 # import tensorflow as tf
 import tensorflow.compat.v1 as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+import deepnovo_peak_filter
 
 
 # ==============================================================================
@@ -75,6 +78,57 @@ tf.app.flags.DEFINE_string("decode_dir",
                            "decode_output",
                            "Output decode directory.")
 
+tf.app.flags.DEFINE_integer("num_workers",
+                            1,
+                            "Number of processes that multi_decode uses to"
+                            " read and decode the spectrum stacks of a file,"
+                            " each with its own session and share of cores.")
+
+tf.app.flags.DEFINE_integer("prefetch_depth",
+                            0,
+                            "Number of spectrum stacks that multi_decode reads"
+                            " ahead in a background process while decoding,"
+                            " 0 (default) to read them in the decoding process.")
+
+tf.app.flags.DEFINE_boolean("export_frozen_model",
+                            False,
+                            "Set to True to write the model restored from"
+                            " train_dir as a frozen graph to frozen_model.")
+
+tf.app.flags.DEFINE_string("frozen_model",
+                           "",
+                           "Frozen graph of the model, decoding loads it"
+                           " instead of the train_dir checkpoint if set.")
+
+tf.app.flags.DEFINE_boolean("benchmark_stages",
+                            False,
+                            "Set to True to time the stages of a decoding"
+                            " step on the first spectra in mgf_dir.")
+
+tf.app.flags.DEFINE_boolean("build_spectrum_store",
+                            False,
+                            "Set to True to convert the mgf files in mgf_dir"
+                            " into binary spectrum stores (.kspec).")
+
+tf.app.flags.DEFINE_integer("peak_top_n",
+                            0,
+                            "Keep the top n most intense peaks of each"
+                            " spectrum when reading it, 0 to keep all.")
+
+tf.app.flags.DEFINE_integer("peak_window_top_k",
+                            0,
+                            "Keep the top k most intense peaks in each"
+                            " peak_window_size m/z window, 0 to keep all.")
+
+tf.app.flags.DEFINE_float("peak_window_size",
+                          100.0,
+                          "m/z window (Da) of peak_window_top_k.")
+
+tf.app.flags.DEFINE_float("peak_min_intensity_ratio",
+                          0.0,
+                          "Drop the peaks below this fraction of the base"
+                          " peak intensity, 0 to keep all.")
+
 
 """
 for this
@@ -128,6 +182,33 @@ tf.app.flags.DEFINE_integer("beam_size",
                             5,
                             "Number of optimal paths to search during decoding.")
 
+tf.app.flags.DEFINE_boolean("fused_bidirectional",
+                            True,
+                            "Set to True to advance the forward and backward"
+                            " searches of all candidate masses together,"
+                            " one model step for both directions.")
+
+tf.app.flags.DEFINE_float("precursor_ppm",
+                          0.0,
+                          "If > 0, the precursor mass window of a spectrum is"
+                          " precursor_ppm (ppm) of its mass, and so is the"
+                          " knapsack window of its suffix masses, instead of"
+                          " --precursor_mass_tolerance and"
+                          " --knapsack_precision. Also the ppm window of the"
+                          " database search (10 ppm if 0).")
+
+tf.app.flags.DEFINE_float("precursor_mass_tolerance",
+                          0.01,
+                          "Precursor mass window (Da) of beam search when"
+                          " --precursor_ppm is 0, and of the de novo"
+                          " workers.")
+
+tf.app.flags.DEFINE_integer("knapsack_precision",
+                            100,
+                            "Knapsack window of the suffix masses (in"
+                            " 1/KNAPSACK_AA_RESOLUTION Da) of beam search"
+                            " when --precursor_ppm is 0.")
+
 tf.app.flags.DEFINE_boolean("search_db",
                             False,
                             "Set to True to do a database search.")
@@ -156,12 +237,78 @@ tf.app.flags.DEFINE_boolean("profile",
                              False,
                              "Set to True to profile the denovo model")
 
+tf.app.flags.DEFINE_integer("intra_op_threads",
+                            0,
+                            "Threads of the TF intra-op thread pool,"
+                            " 0 to let TF choose.")
+
+tf.app.flags.DEFINE_integer("inter_op_threads",
+                            0,
+                            "Threads of the TF inter-op thread pool,"
+                            " 0 to let TF choose.")
+
+tf.app.flags.DEFINE_boolean("xla_jit",
+                            False,
+                            "Set to True to compile the graphs with XLA.")
+
+tf.app.flags.DEFINE_boolean("gpu_memory_growth",
+                            False,
+                            "Set to True to allocate GPU memory as needed"
+                            " instead of all of it up front.")
+
+tf.app.flags.DEFINE_enum("inference_precision",
+                         "float32",
+                         ["float32", "bfloat16", "float16"],
+                         "Precision of the decoding model, float32 weights"
+                         " are kept and the graph is rewritten to compute in"
+                         " bfloat16 (oneDNN CPUs) or float16 (GPUs).")
+
 FLAGS = tf.app.flags.FLAGS
 """
 Kaiko cProfile addition
 """
 
 
+def session_config(intra_op_threads=0, inter_op_threads=0, inference=False):
+  """Return the ConfigProto of the TF sessions.
+
+     The thread pools follow the intra_op_threads/inter_op_threads flags, or
+     the given numbers of threads if the flags are 0 (0 lets TF choose).
+     Sessions of the decoding model (inference=True) follow the
+     inference_precision flag: grappler's auto mixed precision pass casts
+     the matmuls/convolutions and their neighbours, the variables stay
+     float32.
+  """
+
+  config = tf.ConfigProto(
+      intra_op_parallelism_threads=FLAGS.intra_op_threads or intra_op_threads,
+      inter_op_parallelism_threads=FLAGS.inter_op_threads or inter_op_threads)
+  config.gpu_options.allow_growth = FLAGS.gpu_memory_growth
+  if FLAGS.xla_jit:
+    config.graph_options.optimizer_options.global_jit_level = (
+        tf.OptimizerOptions.ON_1)
+  precision = FLAGS.inference_precision if inference else "float32"
+  rewrite_options = config.graph_options.rewrite_options
+  if precision == "bfloat16":
+    # fast on CPUs with AVX512_BF16/AMX, emulated (slower) on older ones
+    rewrite_options.auto_mixed_precision_onednn_bfloat16 = (
+        rewriter_config_pb2.RewriterConfig.ON)
+  elif precision == "float16":
+    # auto_mixed_precision only rewrites GPU ops, the CPU pass emulates
+    #   float16 and only serves to measure the accuracy on CPU-only hosts
+    rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.auto_mixed_precision_cpu = (
+        rewriter_config_pb2.RewriterConfig.ON)
+  print("session_config(), intra_op_threads={0}, inter_op_threads={1},"
+        " xla_jit={2}, gpu_memory_growth={3}, precision={4}".format(
+            config.intra_op_parallelism_threads or "default",
+            config.inter_op_parallelism_threads or "default",
+            FLAGS.xla_jit,
+            FLAGS.gpu_memory_growth,
+            precision))
+  return config
+
+
 # ==============================================================================
 # GLOBAL VARIABLES for VOCABULARY
 # ==============================================================================
@@ -337,12 +484,21 @@ print("SPECTRUM_RESOLUTION ", SPECTRUM_RESOLUTION)
 MZ_MAX = 3000.0
 MZ_SIZE = int(MZ_MAX * SPECTRUM_RESOLUTION) # 30k
 
+# peak picking applied to the spectra read from the input files
+peak_filter = deepnovo_peak_filter.PeakFilter(
+    top_n=FLAGS.peak_top_n,
+    window_top_k=FLAGS.peak_window_top_k,
+    window_size=FLAGS.peak_window_size,
+    min_intensity_ratio=FLAGS.peak_min_intensity_ratio)
+
 KNAPSACK_AA_RESOLUTION = 10000 # 0.0001 Da
 mass_AA_min_round = int(round(mass_AA_min * KNAPSACK_AA_RESOLUTION)) # 57.02146
-KNAPSACK_MASS_PRECISION_TOLERANCE = 100 # 0.01 Da
+KNAPSACK_MASS_PRECISION_TOLERANCE = FLAGS.knapsack_precision # 100 ~ 0.01 Da
 num_position = 0
 
-PRECURSOR_MASS_PRECISION_TOLERANCE = 0.01
+PRECURSOR_MASS_PRECISION_TOLERANCE = FLAGS.precursor_mass_tolerance # 0.01 Da
+# if --precursor_ppm > 0, the two tolerances above are replaced by a window
+#   of precursor_mass_ppm * peptide_mass, see precursor_mass_tolerance()
 
 # ONLY for accuracy evaluation
 #~ PRECURSOR_MASS_PRECISION_INPUT_FILTER = 0.01
@@ -539,8 +695,11 @@ cleavage_rule = "trypsin"
 num_missed_cleavage = 2
 fixed_mod_list = ['C']
 var_mod_list = ['N', 'Q', 'M']
-precursor_mass_tolerance = 0.01 # Da
-precursor_mass_ppm = 10.0/1000000 # ppm (20 better) # instead of absolute 0.01 Da
+precursor_mass_tolerance = PRECURSOR_MASS_PRECISION_TOLERANCE # Da
+if FLAGS.precursor_ppm > 0:
+  precursor_mass_ppm = FLAGS.precursor_ppm / 1000000
+else:
+  precursor_mass_ppm = 10.0/1000000 # ppm (20 better) # instead of absolute 0.01 Da
 knapsack_file = FLAGS.knapsack_file
 # training/testing/decoding files
 input_file_train = "/people/leej324/DeepNovo/DeepNovo_data_01152018/data.training/yeast.low.coon_2013/peaks.db.mgf.train.dup"
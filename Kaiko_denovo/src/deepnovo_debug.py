@@ -3,183 +3,661 @@
 # DeepNovo is publicly available for non-commercial uses.
 # ==============================================================================
 
-"""TODO(nh2tran): docstring."""
+"""Numba kernels for spectrum pre-processing and candidate intensities.
+
+The kernels are compiled in nopython mode and cached on disk (cache=True, see
+NUMBA_CACHE_DIR), so a new process does not recompile them. They do not read
+deepnovo_config: its constants are passed as a KernelConfig argument, which
+keeps the cached code valid. The functions without a leading underscore are
+the Python entry points that fill in that argument.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import time
+
 import numpy as np
 
-from numba import jit
+from numba import njit, prange
 
 import deepnovo_config
 
 
-@jit
+KernelConfig = collections.namedtuple("KernelConfig",
+                                      ["mass_ID",
+                                       "mass_H",
+                                       "mass_H2O",
+                                       "mass_NH3",
+                                       "mass_N_terminus",
+                                       "mass_C_terminus",
+                                       "SPECTRUM_RESOLUTION",
+                                       "MZ_SIZE",
+                                       "WINDOW_SIZE",
+                                       "num_ion",
+                                       "vocab_size",
+                                       "PAD_ID",
+                                       "GO_ID",
+                                       "EOS_ID"])
+
+
+def kernel_config():
+    """Return the KernelConfig of the current deepnovo_config."""
+
+    return KernelConfig(mass_ID=deepnovo_config.mass_ID_np,
+                        mass_H=float(deepnovo_config.mass_H),
+                        mass_H2O=float(deepnovo_config.mass_H2O),
+                        mass_NH3=float(deepnovo_config.mass_NH3),
+                        mass_N_terminus=float(deepnovo_config.mass_N_terminus),
+                        mass_C_terminus=float(deepnovo_config.mass_C_terminus),
+                        SPECTRUM_RESOLUTION=int(deepnovo_config.SPECTRUM_RESOLUTION),
+                        MZ_SIZE=int(deepnovo_config.MZ_SIZE),
+                        WINDOW_SIZE=int(deepnovo_config.WINDOW_SIZE),
+                        num_ion=int(deepnovo_config.num_ion),
+                        vocab_size=int(deepnovo_config.vocab_size),
+                        PAD_ID=int(deepnovo_config.PAD_ID),
+                        GO_ID=int(deepnovo_config.GO_ID),
+                        EOS_ID=int(deepnovo_config.EOS_ID))
+
+
+KERNEL_CONFIG = kernel_config()
+
+
+@njit(cache=True)
+def _fill_candidate_intensity(candidate_intensity,
+                              spectrum_location,
+                              spectrum_intensity,
+                              peptide_mass,
+                              prefix_mass,
+                              direction,
+                              config):
+    """Fill a zero [vocab_size, num_ion, WINDOW_SIZE] candidate_intensity.
+
+       spectrum_original is given by its sorted non-zero spectrum_location
+       and their spectrum_intensity, the peaks of each ion window are found
+       by binary search. The masses are computed in float32, like numpy does
+       for the float32 mass_ID, so that the ion locations are the same as in
+       the original DeepNovo code.
+    """
+
+    peptide_mass = np.float32(peptide_mass)
+    prefix_mass = np.float32(prefix_mass)
+    mass_H = np.float32(config.mass_H)
+    mass_H2O = np.float32(config.mass_H2O)
+    mass_NH3 = np.float32(config.mass_NH3)
+    resolution = np.float32(config.SPECTRUM_RESOLUTION)
+    ion_mass = np.empty(8, dtype=np.float32)
+
+    # FIRST_LABEL & prefix_mass
+    if direction == 0:
+        FIRST_LABEL = config.GO_ID
+        LAST_LABEL = config.EOS_ID
+    else:
+        FIRST_LABEL = config.EOS_ID
+        LAST_LABEL = config.GO_ID
+
+    for aa_id in range(config.vocab_size):
+        # PAD/GO/EOS stay 0.0
+        if aa_id == config.PAD_ID or aa_id == FIRST_LABEL or aa_id == LAST_LABEL:
+            continue
+        if direction == 0:
+            candidate_b_mass = prefix_mass + config.mass_ID[aa_id]
+            candidate_y_mass = peptide_mass - candidate_b_mass
+        else:
+            candidate_y_mass = prefix_mass + config.mass_ID[aa_id]
+            candidate_b_mass = peptide_mass - candidate_y_mass
+
+        # ion_8
+        ion_mass[0] = candidate_b_mass
+        ion_mass[1] = candidate_b_mass - mass_H2O
+        ion_mass[2] = candidate_b_mass - mass_NH3
+        ion_mass[3] = (candidate_b_mass + np.float32(2) * mass_H) / np.float32(2)
+        ion_mass[4] = candidate_y_mass
+        ion_mass[5] = candidate_y_mass - mass_H2O
+        ion_mass[6] = candidate_y_mass - mass_NH3
+        ion_mass[7] = (candidate_y_mass + np.float32(2) * mass_H) / np.float32(2)
+
+        for ion_id in range(config.num_ion):
+            # ion locations
+            window_start = np.int32(np.rint(ion_mass[ion_id] * resolution)) - 5
+            window_end = window_start + config.WINDOW_SIZE
+            if window_start < 0 or window_end > config.MZ_SIZE:
+                continue
+            # a window holds few peaks, scan them from the first one
+            index = np.searchsorted(spectrum_location, window_start)
+            while index < spectrum_location.size and spectrum_location[index] < window_end:
+                candidate_intensity[aa_id, ion_id, spectrum_location[index] - window_start] = spectrum_intensity[index] # TODO(nh2tran): line-too-long
+                index += 1
+
+
+@njit(cache=True)
+def _get_candidate_intensity(spectrum_original,
+                             peptide_mass,
+                             prefix_mass,
+                             direction,
+                             config):
+    """Kernel of get_candidate_intensity(), config is KERNEL_CONFIG."""
+
+    spectrum_location = np.flatnonzero(spectrum_original).astype(np.int32)
+    candidate_intensity = np.zeros(shape=(config.vocab_size,
+                                          config.num_ion,
+                                          config.WINDOW_SIZE),
+                                   dtype=np.float32)
+    _fill_candidate_intensity(candidate_intensity,
+                              spectrum_location,
+                              spectrum_original[spectrum_location],
+                              peptide_mass,
+                              prefix_mass,
+                              direction,
+                              config)
+    return candidate_intensity
+
+
 def get_candidate_intensity(spectrum_original,
                             peptide_mass,
                             prefix_mass,
                             direction):
+    """Return the [vocab_size, num_ion, WINDOW_SIZE] intensity windows of
+       the ions of the next amino acid candidates."""
 
-    # FIRST_LABEL & prefix_mass
-    if direction == 0:
-        FIRST_LABEL = deepnovo_config.GO_ID
-        LAST_LABEL = deepnovo_config.EOS_ID
-        candidate_b_mass = prefix_mass + deepnovo_config.mass_ID_np
-        candidate_y_mass = peptide_mass - candidate_b_mass
-    elif direction == 1:
-        FIRST_LABEL = deepnovo_config.EOS_ID
-        LAST_LABEL = deepnovo_config.GO_ID
-        candidate_y_mass = prefix_mass + deepnovo_config.mass_ID_np
-        candidate_b_mass = peptide_mass - candidate_y_mass
-
-    # b-ions
-    candidate_b_H2O = candidate_b_mass - deepnovo_config.mass_H2O
-    candidate_b_NH3 = candidate_b_mass - deepnovo_config.mass_NH3
-    candidate_b_plus2_charge1 = ((candidate_b_mass + 2 * deepnovo_config.mass_H) / 2)
-                                 # - deepnovo_config.mass_H)
-
-    # y-ions
-    candidate_y_H2O = candidate_y_mass - deepnovo_config.mass_H2O
-    candidate_y_NH3 = candidate_y_mass - deepnovo_config.mass_NH3
-    candidate_y_plus2_charge1 = ((candidate_y_mass + 2 * deepnovo_config.mass_H) / 2)
-                                 # - deepnovo_config.mass_H)
-
-    # ion_2
-    #~   b_ions = [candidate_b_mass]
-    #~   y_ions = [candidate_y_mass]
-    #~   ion_mass_list = b_ions + y_ions
-
-    # ion_8
-    b_ions = [candidate_b_mass,
-              candidate_b_H2O,
-              candidate_b_NH3,
-              candidate_b_plus2_charge1]
-    y_ions = [candidate_y_mass,
-              candidate_y_H2O,
-              candidate_y_NH3,
-              candidate_y_plus2_charge1]
-    ion_mass_list = b_ions + y_ions
-    ion_mass = np.array(ion_mass_list, dtype=np.float32)
-
-    # ion locations
-    location_sub50 = np.rint(ion_mass * deepnovo_config.SPECTRUM_RESOLUTION).astype(np.int32) # TODO(nh2tran): line-too-long
-    # location_sub50 -= (deepnovo_config.WINDOW_SIZE // 2)
-    location_sub50 -= 5
-    location_plus50 = location_sub50 + deepnovo_config.WINDOW_SIZE
-    ion_id_rows, aa_id_cols = np.nonzero(np.logical_and(
-        location_sub50 >= 0,
-        location_plus50 <= deepnovo_config.MZ_SIZE))
-
-    # candidate_intensity
-    candidate_intensity = np.zeros(shape=(deepnovo_config.vocab_size,
-                                          deepnovo_config.num_ion,
-                                          deepnovo_config.WINDOW_SIZE),
-                                   dtype=np.float32)
-    # cdef int [:,:] location_sub50_view = location_sub50
-    # cdef int [:,:] location_plus50_view = location_plus50
-    # cdef float [:,:,:] candidate_intensity_view = candidate_intensity
-    # cdef float [:] spectrum_original_view = spectrum_original
-    # cdef int[:] row = ion_id_rows.astype(np.int32)
-    # cdef int[:] col = aa_id_cols.astype(np.int32)
-    # cdef int index
-    for index in range(ion_id_rows.size):
-        # candidate_intensity_view[col[index], row[index], :] = spectrum_original_view[location_sub50_view[row[index], col[index]] : location_plus50_view[row[index], col[index]]] # TODO(nh2tran): line-too-long
-        candidate_intensity[aa_id_cols[index], ion_id_rows[index], :] = spectrum_original[
-                                                                        location_sub50[ion_id_rows[index], aa_id_cols[index]]:
-                                                                        location_plus50[
-                                                                            ion_id_rows[index], aa_id_cols[index]]]  # TODO(nh2tran): line-too-long
-
-    # PAD/GO/EOS
-    candidate_intensity[deepnovo_config.PAD_ID].fill(0.0)
-    candidate_intensity[FIRST_LABEL].fill(0.0)
-    candidate_intensity[LAST_LABEL].fill(0.0)
-    #~ b_ion_count = len(b_ions)
-    #~ if (direction==0):
-    #~ candidate_intensity[LAST_LABEL,b_ion_count:].fill(0.0)
-    #~ elif (direction==1):
-    #~ candidate_intensity[LAST_LABEL,:b_ion_count].fill(0.0)
-
-    #~ for aa_id in ([LAST_LABEL] + range(3,deepnovo_config.vocab_size)):
-    #~ for ion_id in xrange(deepnovo_config.num_ion):
-    #~ location_sub50 = location_sub50_list[ion_id][aa_id]
-    #~ #
-    #~ if (location_sub50 > 0):
-    #~ candidate_intensity[aa_id,ion_id] = spectrum_original[location_sub50:location_sub50+deepnovo_config.WINDOW_SIZE]
-
-    # Nomalization to N(0,1): tf.image.per_image_whitening
-    #~   adjusted_stddev = max(np.std(candidate_intensity), 1.0/math.sqrt(candidate_intensity.size))
-    #~   candidate_intensity = (candidate_intensity-np.mean(candidate_intensity)) / adjusted_stddev
+    return _get_candidate_intensity(spectrum_original,
+                                    peptide_mass,
+                                    prefix_mass,
+                                    direction,
+                                    KERNEL_CONFIG)
 
-    return candidate_intensity
 
+@njit(cache=True)
+def _fill_spectrum(spectrum_holder,
+                   spectrum_original_forward,
+                   spectrum_original_backward,
+                   spectrum_mz,
+                   spectrum_intensity,
+                   peptide_mass,
+                   config):
+    """Fill the zero MZ_SIZE spectrum_holder, spectrum_original_forward/backward
+       of a spectrum, see process_spectrum()."""
 
-@jit
-def process_spectrum(spectrum_mz_list, spectrum_intensity_list, peptide_mass):
-    """TODO(nh2tran): docstring."""
+    resolution = np.float32(config.SPECTRUM_RESOLUTION)
 
     # neutral mass, location, assuming ion charge z=1
     charge = 1.0
-    spectrum_mz = np.array(spectrum_mz_list, dtype=np.float32)
-    neutral_mass = spectrum_mz - charge*deepnovo_config.mass_H
-    neutral_mass_location = np.rint(neutral_mass * deepnovo_config.SPECTRUM_RESOLUTION).astype(np.int32) # TODO(nh2tran): line-too-long
-    # cdef int [:] neutral_mass_location_view = neutral_mass_location
+    neutral_mass = spectrum_mz - np.float32(charge * config.mass_H)
+    neutral_mass_location = np.rint(neutral_mass * resolution).astype(np.int32)
 
     # normalize intensity
-    spectrum_intensity = np.array(spectrum_intensity_list, dtype=np.float32)
-    norm_intensity = spectrum_intensity / np.max(spectrum_intensity)
-    ##### binning ##### by Joon############################################################
-    # norm_intensity = np.rint(norm_intensity*100)+1  # 1 ~ 10
-    #######################################################################################
-
-    # cdef float [:] norm_intensity_view = norm_intensity
+    if spectrum_intensity.size > 0:
+        norm_intensity = spectrum_intensity / np.max(spectrum_intensity)
+    else:
+        norm_intensity = spectrum_intensity
 
     # fill spectrum holders
-    spectrum_holder = np.zeros(shape=deepnovo_config.MZ_SIZE, dtype=np.float32)
-    # cdef float [:] spectrum_holder_view = spectrum_holder
-    # note that different peaks may fall into the same location, hence loop +=
-    # cdef int index
+    # note that different peaks may fall into the same location, hence max
     for index in range(neutral_mass_location.size):
-        #~     spectrum_holder_view[neutral_mass_location_view[index]] += norm_intensity_view[index] # TODO(nh2tran): line-too-long
-        # spectrum_holder_view[neutral_mass_location_view[index]] = max(spectrum_holder_view[neutral_mass_location_view[index]], # TODO(nh2tran): line-too-long
-        #                                                               norm_intensity_view[index]) # TODO(nh2tran): line-too-long
         spectrum_holder[neutral_mass_location[index]] = max(spectrum_holder[neutral_mass_location[index]],
                                                             norm_intensity[index])
-    spectrum_original_forward = np.copy(spectrum_holder)
-    spectrum_original_backward = np.copy(spectrum_holder)
+    for index in range(neutral_mass_location.size):
+        spectrum_original_forward[neutral_mass_location[index]] = spectrum_holder[neutral_mass_location[index]]
+        spectrum_original_backward[neutral_mass_location[index]] = spectrum_holder[neutral_mass_location[index]]
 
     # add complement
-    complement_mass = peptide_mass - neutral_mass
-    complement_mass_location = np.rint(complement_mass * deepnovo_config.SPECTRUM_RESOLUTION).astype(np.int32) # TODO(nh2tran): line-too-long
-    # cdef int [:] complement_mass_location_view = complement_mass_location
-    #~   cdef int index
-    for index in np.nonzero(complement_mass_location > 0)[0]:
-        # spectrum_holder_view[complement_mass_location_view[index]] += norm_intensity_view[index] # TODO(nh2tran): line-too-long
-        spectrum_holder[complement_mass_location[index]] += norm_intensity[index]
+    complement_mass = np.float32(peptide_mass) - neutral_mass
+    complement_mass_location = np.rint(complement_mass * resolution).astype(np.int32)
+    for index in range(complement_mass_location.size):
+        # locations past MZ_SIZE would raise an IndexError in numpy
+        if 0 < complement_mass_location[index] < config.MZ_SIZE:
+            spectrum_holder[complement_mass_location[index]] += norm_intensity[index]
 
+    # terminal locations past MZ_SIZE are dropped, like the complement peaks,
+    # rather than written into the next spectrum of a stack
     # peptide_mass
-    spectrum_original_forward[int(round(peptide_mass * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
-    spectrum_original_backward[int(round(peptide_mass * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
+    location = int(np.rint(peptide_mass * config.SPECTRUM_RESOLUTION))
+    if location < config.MZ_SIZE:
+        spectrum_original_forward[location] = 1.0
+        spectrum_original_backward[location] = 1.0
 
     # N-terminal, b-ion, peptide_mass_C
     # append N-terminal
-    mass_N = deepnovo_config.mass_N_terminus - deepnovo_config.mass_H
-    spectrum_holder[int(round(mass_N * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0
+    mass_N = config.mass_N_terminus - config.mass_H
+    spectrum_holder[int(np.rint(mass_N * config.SPECTRUM_RESOLUTION))] = 1.0
     # append peptide_mass_C
-    mass_C = deepnovo_config.mass_C_terminus + deepnovo_config.mass_H
+    mass_C = config.mass_C_terminus + config.mass_H
     peptide_mass_C = peptide_mass - mass_C
-    spectrum_holder[int(round(peptide_mass_C * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
-    spectrum_original_forward[int(round(peptide_mass_C * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
+    location = int(np.rint(peptide_mass_C * config.SPECTRUM_RESOLUTION))
+    if location < config.MZ_SIZE:
+        spectrum_holder[location] = 1.0
+        spectrum_original_forward[location] = 1.0
 
     # C-terminal, y-ion, peptide_mass_N
     # append C-terminal
-    mass_C = deepnovo_config.mass_C_terminus + deepnovo_config.mass_H
-    spectrum_holder[int(round(mass_C * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0
+    spectrum_holder[int(np.rint(mass_C * config.SPECTRUM_RESOLUTION))] = 1.0
     # append peptide_mass_N
-    mass_N = deepnovo_config.mass_N_terminus - deepnovo_config.mass_H
     peptide_mass_N = peptide_mass - mass_N
-    spectrum_holder[int(round(peptide_mass_N * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
-    spectrum_original_backward[int(round(peptide_mass_N * deepnovo_config.SPECTRUM_RESOLUTION))] = 1.0 # TODO(nh2tran): line-too-long
+    location = int(np.rint(peptide_mass_N * config.SPECTRUM_RESOLUTION))
+    if location < config.MZ_SIZE:
+        spectrum_holder[location] = 1.0
+        spectrum_original_backward[location] = 1.0
+
 
+@njit(cache=True)
+def _process_spectrum(spectrum_mz, spectrum_intensity, peptide_mass, config):
+    """Kernel of process_spectrum(), config is KERNEL_CONFIG."""
+
+    spectrum_holder = np.zeros(shape=config.MZ_SIZE, dtype=np.float32)
+    spectrum_original_forward = np.zeros(shape=config.MZ_SIZE, dtype=np.float32)
+    spectrum_original_backward = np.zeros(shape=config.MZ_SIZE, dtype=np.float32)
+    _fill_spectrum(spectrum_holder,
+                   spectrum_original_forward,
+                   spectrum_original_backward,
+                   spectrum_mz,
+                   spectrum_intensity,
+                   peptide_mass,
+                   config)
     return spectrum_holder, spectrum_original_forward, spectrum_original_backward
+
+
+def process_spectrum(spectrum_mz_list, spectrum_intensity_list, peptide_mass):
+    """Return spectrum_holder, spectrum_original_forward/backward of a spectrum."""
+
+    return _process_spectrum(np.asarray(spectrum_mz_list, dtype=np.float32),
+                             np.asarray(spectrum_intensity_list, dtype=np.float32),
+                             float(peptide_mass),
+                             KERNEL_CONFIG)
+
+
+# Sparse spectra
+# A dense MZ_SIZE spectrum is kept as a pair (location, intensity) of its
+# non-zero bins, sorted by location, and densified only when it is fed to
+# the model. A stack of test_stack_size spectra then takes a few MB instead
+# of 3 x MZ_SIZE float32 per spectrum.
+
+def sparsify_spectrum(spectrum):
+    """Return the (location, intensity) pair of a dense spectrum."""
+
+    location = np.flatnonzero(spectrum).astype(np.int32)
+    return location, spectrum[location]
+
+
+def densify_spectrum(sparse_spectrum, out=None):
+    """Return the dense MZ_SIZE spectrum of a (location, intensity) pair."""
+
+    location, intensity = sparse_spectrum
+    if out is None:
+        out = np.zeros(shape=deepnovo_config.MZ_SIZE, dtype=np.float32)
+    else:
+        out.fill(0.0)
+    out[location] = intensity
+    return out
+
+
+def densify_spectrum_batch(sparse_spectrum_list):
+    """Return the [batch_size, MZ_SIZE] array of a list of sparse spectra."""
+
+    batch = np.zeros(shape=(len(sparse_spectrum_list), deepnovo_config.MZ_SIZE),
+                     dtype=np.float32)
+    for index, (location, intensity) in enumerate(sparse_spectrum_list):
+        batch[index, location] = intensity
+    return batch
+
+
+def process_spectrum_sparse(spectrum_mz_list, spectrum_intensity_list, peptide_mass):
+    """Same as process_spectrum() but returns the three spectra sparse."""
+
+    return process_spectrum_stack_sparse([spectrum_mz_list],
+                                         [spectrum_intensity_list],
+                                         [peptide_mass])[0]
+
+
+# Spectrum stacks
+# read_spectra() pre-processes a whole stack of spectra at once: the peaks
+# are concatenated (see pack_peaks) and one kernel call fills the
+# [n_spectra, MZ_SIZE] blocks, a chunk of PROCESS_CHUNK_SIZE spectra at a
+# time to bound the size of the dense blocks.
+
+PROCESS_CHUNK_SIZE = 256
+
+
+def pack_peaks(spectrum_mz_list, spectrum_intensity_list):
+    """Concatenate peak lists into (mz, intensity, offset) float32 arrays.
+
+       The peaks of spectrum i are [offset[i], offset[i+1]).
+    """
+
+    offset = np.zeros(len(spectrum_mz_list) + 1, dtype=np.int64)
+    offset[1:] = np.cumsum([len(x) for x in spectrum_mz_list])
+    if spectrum_mz_list:
+        spectrum_mz = np.concatenate(spectrum_mz_list).astype(np.float32)
+        spectrum_intensity = np.concatenate(spectrum_intensity_list).astype(np.float32)
+    else:
+        spectrum_mz = np.zeros(0, dtype=np.float32)
+        spectrum_intensity = np.zeros(0, dtype=np.float32)
+    return spectrum_mz, spectrum_intensity, offset
+
+
+@njit(cache=True, parallel=True)
+def _process_spectrum_stack(spectrum_mz,
+                            spectrum_intensity,
+                            spectrum_offset,
+                            peptide_mass,
+                            config):
+    """Kernel of process_spectrum_stack(), one spectrum per prange iteration."""
+
+    stack_size = peptide_mass.shape[0]
+    spectrum_holder = np.zeros(shape=(stack_size, config.MZ_SIZE), dtype=np.float32)
+    spectrum_original_forward = np.zeros(shape=(stack_size, config.MZ_SIZE), dtype=np.float32)
+    spectrum_original_backward = np.zeros(shape=(stack_size, config.MZ_SIZE), dtype=np.float32)
+    for spectrum_id in prange(stack_size):
+        start = spectrum_offset[spectrum_id]
+        end = spectrum_offset[spectrum_id + 1]
+        _fill_spectrum(spectrum_holder[spectrum_id],
+                       spectrum_original_forward[spectrum_id],
+                       spectrum_original_backward[spectrum_id],
+                       spectrum_mz[start:end],
+                       spectrum_intensity[start:end],
+                       peptide_mass[spectrum_id],
+                       config)
+    return spectrum_holder, spectrum_original_forward, spectrum_original_backward
+
+
+def process_spectrum_stack(spectrum_mz_list, spectrum_intensity_list, peptide_mass_list):
+    """process_spectrum() of a stack of spectra in one call.
+
+       Returns spectrum_holder, spectrum_original_forward/backward as
+       [n_spectra, MZ_SIZE] arrays, row i is process_spectrum() of spectrum i.
+    """
+
+    spectrum_mz, spectrum_intensity, spectrum_offset = pack_peaks(spectrum_mz_list,
+                                                                  spectrum_intensity_list)
+    return _process_spectrum_stack(spectrum_mz,
+                                   spectrum_intensity,
+                                   spectrum_offset,
+                                   np.asarray(peptide_mass_list, dtype=np.float64),
+                                   KERNEL_CONFIG)
+
+
+@njit(cache=True)
+def _gather_spectrum(spectrum, location_list, out_location, out_intensity, out_start):
+    """Move the non-zero bins of spectrum at the sorted location_list to
+       out_location/out_intensity[out_start:], reset spectrum to zero and
+       return the number of bins moved."""
+
+    count = 0
+    previous = -1
+    for index in range(location_list.size):
+        location = location_list[index]
+        if location == previous:
+            continue
+        previous = location
+        if spectrum[location] != 0.0:
+            out_location[out_start + count] = location
+            out_intensity[out_start + count] = spectrum[location]
+            count += 1
+        spectrum[location] = 0.0
+    return count
+
+
+@njit(cache=True)
+def _process_spectrum_stack_sparse(spectrum_mz,
+                                   spectrum_intensity,
+                                   spectrum_offset,
+                                   peptide_mass,
+                                   config):
+    """Kernel of process_spectrum_stack_sparse().
+
+       Spectrum i of type t (holder, original forward, original backward) is
+       location[t, offset[t, i]:offset[t, i+1]] and the same slice of
+       intensity.
+    """
+
+    stack_size = peptide_mass.shape[0]
+    # a spectrum has at most 2 bins per peak (peak & complement) + 5 terminals
+    capacity = 2 * spectrum_mz.size + 5 * stack_size
+    location = np.empty(shape=(3, capacity), dtype=np.int32)
+    intensity = np.empty(shape=(3, capacity), dtype=np.float32)
+    offset = np.zeros(shape=(3, stack_size + 1), dtype=np.int64)
+    # dense scratch spectra, only their touched bins are reset after each use
+    scratch = np.zeros(shape=(3, config.MZ_SIZE), dtype=np.float32)
+
+    resolution = np.float32(config.SPECTRUM_RESOLUTION)
+    mass_N = config.mass_N_terminus - config.mass_H
+    mass_C = config.mass_C_terminus + config.mass_H
+    for spectrum_id in range(stack_size):
+        start = spectrum_offset[spectrum_id]
+        end = spectrum_offset[spectrum_id + 1]
+        _fill_spectrum(scratch[0],
+                       scratch[1],
+                       scratch[2],
+                       spectrum_mz[start:end],
+                       spectrum_intensity[start:end],
+                       peptide_mass[spectrum_id],
+                       config)
+
+        # all the bins that _fill_spectrum() may have touched, sorted
+        peak_count = end - start
+        touched = np.empty(2 * peak_count + 5, dtype=np.int32)
+        neutral_mass = spectrum_mz[start:end] - np.float32(config.mass_H)
+        touched[:peak_count] = np.rint(neutral_mass * resolution).astype(np.int32)
+        complement_mass = np.float32(peptide_mass[spectrum_id]) - neutral_mass
+        touched[peak_count:2*peak_count] = np.rint(complement_mass * resolution).astype(np.int32)
+        touched[2*peak_count] = int(np.rint(peptide_mass[spectrum_id] * config.SPECTRUM_RESOLUTION))
+        touched[2*peak_count+1] = int(np.rint(mass_N * config.SPECTRUM_RESOLUTION))
+        touched[2*peak_count+2] = int(np.rint((peptide_mass[spectrum_id] - mass_C) * config.SPECTRUM_RESOLUTION))
+        touched[2*peak_count+3] = int(np.rint(mass_C * config.SPECTRUM_RESOLUTION))
+        touched[2*peak_count+4] = int(np.rint((peptide_mass[spectrum_id] - mass_N) * config.SPECTRUM_RESOLUTION))
+        for index in range(touched.size):
+            # same wraparound as the negative indices of _fill_spectrum()
+            if touched[index] < 0:
+                touched[index] += config.MZ_SIZE
+            # skipped by _fill_spectrum()
+            elif touched[index] >= config.MZ_SIZE:
+                touched[index] = 0
+        touched = np.sort(touched)
+
+        for spectrum_type in range(3):
+            count = _gather_spectrum(scratch[spectrum_type],
+                                     touched,
+                                     location[spectrum_type],
+                                     intensity[spectrum_type],
+                                     offset[spectrum_type, spectrum_id])
+            offset[spectrum_type, spectrum_id + 1] = offset[spectrum_type, spectrum_id] + count
+    return location, intensity, offset
+
+
+def process_spectrum_stack_sparse(spectrum_mz_list, spectrum_intensity_list, peptide_mass_list):
+    """Same as process_spectrum_stack() but without the dense blocks.
+
+       Returns a list with the (spectrum_holder, spectrum_original_forward,
+       spectrum_original_backward) of each spectrum as (location, intensity)
+       pairs, like process_spectrum_sparse().
+    """
+
+    spectrum_mz, spectrum_intensity, spectrum_offset = pack_peaks(spectrum_mz_list,
+                                                                  spectrum_intensity_list)
+    location, intensity, offset = _process_spectrum_stack_sparse(
+        spectrum_mz,
+        spectrum_intensity,
+        spectrum_offset,
+        np.asarray(peptide_mass_list, dtype=np.float64),
+        KERNEL_CONFIG)
+    offset = offset.tolist()
+    return [tuple((location[t, offset[t][i]:offset[t][i+1]],
+                   intensity[t, offset[t][i]:offset[t][i+1]])
+                  for t in range(3))
+            for i in range(len(peptide_mass_list))]
+
+
+def iter_process_spectrum_stack(spectrum_mz_list,
+                                spectrum_intensity_list,
+                                peptide_mass_list,
+                                sparse=False,
+                                chunk_size=PROCESS_CHUNK_SIZE):
+    """Yield (spectrum_holder, spectrum_original_forward/backward) of each
+       spectrum of a stack.
+
+       The dense spectra are rows of [chunk_size, MZ_SIZE] blocks made by
+       process_spectrum_stack(); with sparse=True they are (location,
+       intensity) pairs made by process_spectrum_stack_sparse() and no dense
+       block is allocated.
+    """
+
+    if sparse:
+        for spectra in process_spectrum_stack_sparse(spectrum_mz_list,
+                                                     spectrum_intensity_list,
+                                                     peptide_mass_list):
+            yield spectra
+        return
+    for start in range(0, len(peptide_mass_list), chunk_size):
+        end = start + chunk_size
+        spectrum_blocks = process_spectrum_stack(spectrum_mz_list[start:end],
+                                                 spectrum_intensity_list[start:end],
+                                                 peptide_mass_list[start:end])
+        for spectra in zip(*spectrum_blocks):
+            yield spectra
+
+
+@njit(cache=True)
+def _get_candidate_intensity_sparse(spectrum_location,
+                                    spectrum_intensity,
+                                    peptide_mass,
+                                    prefix_mass,
+                                    direction,
+                                    config):
+    """Kernel of get_candidate_intensity_sparse()."""
+
+    candidate_intensity = np.zeros(shape=(config.vocab_size,
+                                          config.num_ion,
+                                          config.WINDOW_SIZE),
+                                   dtype=np.float32)
+    _fill_candidate_intensity(candidate_intensity,
+                              spectrum_location,
+                              spectrum_intensity,
+                              peptide_mass,
+                              prefix_mass,
+                              direction,
+                              config)
+    return candidate_intensity
+
+
+def get_candidate_intensity_sparse(spectrum_location,
+                                   spectrum_intensity,
+                                   peptide_mass,
+                                   prefix_mass,
+                                   direction):
+    """Same as get_candidate_intensity() for a sparse spectrum_original."""
+
+    return _get_candidate_intensity_sparse(spectrum_location,
+                                           spectrum_intensity,
+                                           peptide_mass,
+                                           prefix_mass,
+                                           direction,
+                                           KERNEL_CONFIG)
+
+
+def pack_sparse_spectra(sparse_spectrum_list):
+    """Concatenate sparse spectra into (location, intensity, offset) arrays.
+
+       The peaks of spectrum i are [offset[i], offset[i+1]), this is the input
+       of get_candidate_intensity_batch().
+    """
+
+    offset = np.zeros(len(sparse_spectrum_list) + 1, dtype=np.int64)
+    offset[1:] = np.cumsum([len(x[0]) for x in sparse_spectrum_list])
+    if sparse_spectrum_list:
+        location = np.concatenate([x[0] for x in sparse_spectrum_list]).astype(np.int32)
+        intensity = np.concatenate([x[1] for x in sparse_spectrum_list]).astype(np.float32)
+    else:
+        location = np.zeros(0, dtype=np.int32)
+        intensity = np.zeros(0, dtype=np.float32)
+    return location, intensity, offset
+
+
+@njit(cache=True, parallel=True)
+def _get_candidate_intensity_batch(spectrum_location,
+                                   spectrum_intensity,
+                                   spectrum_offset,
+                                   spectrum_index,
+                                   peptide_mass,
+                                   prefix_mass,
+                                   direction,
+                                   config):
+    """Kernel of get_candidate_intensity_batch(), one path per prange iteration."""
+
+    block_size = spectrum_index.shape[0]
+    candidate_intensity = np.zeros(shape=(block_size,
+                                          config.vocab_size,
+                                          config.num_ion,
+                                          config.WINDOW_SIZE),
+                                   dtype=np.float32)
+    for path_id in prange(block_size):
+        start = spectrum_offset[spectrum_index[path_id]]
+        end = spectrum_offset[spectrum_index[path_id] + 1]
+        _fill_candidate_intensity(candidate_intensity[path_id],
+                                  spectrum_location[start:end],
+                                  spectrum_intensity[start:end],
+                                  peptide_mass[path_id],
+                                  prefix_mass[path_id],
+                                  direction[path_id],
+                                  config)
+    return candidate_intensity
+
+
+def get_candidate_intensity_batch(spectrum_location,
+                                  spectrum_intensity,
+                                  spectrum_offset,
+                                  spectrum_index,
+                                  peptide_mass,
+                                  prefix_mass,
+                                  direction):
+    """get_candidate_intensity() of a whole block of paths in one call.
+
+       spectrum_location, spectrum_intensity, spectrum_offset are packed
+       sparse spectra (see pack_sparse_spectra), path i reads the spectrum
+       spectrum_index[i] with peptide_mass[i], prefix_mass[i], direction[i].
+       Returns a [block_size, vocab_size, num_ion, WINDOW_SIZE] array.
+    """
+
+    return _get_candidate_intensity_batch(spectrum_location,
+                                          spectrum_intensity,
+                                          spectrum_offset,
+                                          np.asarray(spectrum_index, dtype=np.int64),
+                                          np.asarray(peptide_mass, dtype=np.float64),
+                                          np.asarray(prefix_mass, dtype=np.float64),
+                                          np.asarray(direction, dtype=np.int64),
+                                          KERNEL_CONFIG)
+
+
+def warm_up():
+    """Run every kernel once on a small spectrum.
+
+       This loads the kernels from the numba cache (or compiles them) before
+       the first real batch, so that decoding time excludes the JIT cost.
+    """
+
+    start_time = time.time()
+    spectrum_mz = np.array([147.1128, 262.1397, 375.2238], dtype=np.float32)
+    spectrum_intensity = np.array([10.0, 20.0, 5.0], dtype=np.float32)
+    peptide_mass = 500.0
+    (spectrum_holder,
+     spectrum_original_forward,
+     spectrum_original_backward) = process_spectrum(spectrum_mz,
+                                                    spectrum_intensity,
+                                                    peptide_mass)
+    process_spectrum_stack([spectrum_mz], [spectrum_intensity], [peptide_mass])
+    process_spectrum_sparse(spectrum_mz, spectrum_intensity, peptide_mass)
+    for direction in (0, 1):
+        get_candidate_intensity(spectrum_original_forward, peptide_mass, 100.0, direction)
+    sparse_spectrum = sparsify_spectrum(spectrum_original_forward)
+    get_candidate_intensity_sparse(sparse_spectrum[0], sparse_spectrum[1], peptide_mass, 100.0, 0)
+    (spectrum_location,
+     spectrum_intensity,
+     spectrum_offset) = pack_sparse_spectra([sparse_spectrum])
+    get_candidate_intensity_batch(spectrum_location,
+                                  spectrum_intensity,
+                                  spectrum_offset,
+                                  np.zeros(2, dtype=np.int64),
+                                  np.full(2, peptide_mass),
+                                  np.full(2, 100.0),
+                                  np.array([0, 1], dtype=np.int64))
+    print("warm_up(), numba kernels ready in {0:.2f} s".format(time.time() - start_time))
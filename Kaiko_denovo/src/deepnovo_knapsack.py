@@ -0,0 +1,373 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Bitmask index of the knapsack matrix for the suffix mass filter.
+
+knapsack_matrix[aa_id, col] tells whether a peptide of mass col + 1 (in
+1/KNAPSACK_AA_RESOLUTION Da) can end with aa_id. KnapsackIndex packs each
+column into the bits of one uint32 and precomputes, for a mass tolerance,
+the OR of the columns in the tolerance window around each column, so that
+knapsack_search() is one array read and a whole block of paths is filtered
+at once.
+
+The index is stored in a directory "<name>.kpack" (see save_store()) holding
+  column_mask.npy: uint32 array, one bitmask per column (bit aa_id),
+  window_<tolerance>.npy: the precomputed window masks,
+  knapsack.json: format version, vocab_size, resolution and tolerances.
+The arrays are opened with mmap_mode="r", so the decoding processes of a
+node share one copy in the page cache. build_column_mask() computes the
+column masks directly, without the dense boolean matrix.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import deepnovo_config
+
+
+# the knapsack tolerances of decode_beam_search_2()
+STANDARD_TOLERANCE_LIST = [100, 1000]
+
+STORE_SUFFIX = ".kpack"
+STORE_VERSION = 1
+
+
+def is_store(path):
+  """Return True if path is a knapsack store directory."""
+
+  return os.path.isfile(os.path.join(path, "knapsack.json"))
+
+
+def store_name(knapsack_file):
+  """Return the default store path of a knapsack matrix file."""
+
+  return os.path.splitext(knapsack_file)[0] + STORE_SUFFIX
+
+
+def knapsack_column_count():
+  """Number of columns of the knapsack of MZ_MAX, as knapsack_build()."""
+
+  peptide_mass = deepnovo_config.MZ_MAX
+  peptide_mass = peptide_mass - (deepnovo_config.mass_C_terminus
+                                 + deepnovo_config.mass_H)
+  peptide_mass_round = int(round(peptide_mass
+                                 * deepnovo_config.KNAPSACK_AA_RESOLUTION))
+  return peptide_mass_round + deepnovo_config.KNAPSACK_AA_RESOLUTION
+
+
+def build_column_mask(column_count, mass_ID=None, resolution=None):
+  """Build the column masks of the knapsack matrix of knapsack_build().
+
+     knapsack_build() fills knapsack_matrix[aa_id, col] by dynamic
+     programming, column by column. The result is: mass col + 1 can be
+     written as a sum of AA masses that includes aa_id, i.e.
+     col + 1 - mass_aa is 0 or such a sum (reachable). reachable is computed
+     by blocks of mass_AA_min masses, which only depend on smaller masses,
+     so each block is a few vectorized ORs.
+  """
+
+  if mass_ID is None:
+    mass_ID = deepnovo_config.mass_ID
+  if resolution is None:
+    resolution = deepnovo_config.KNAPSACK_AA_RESOLUTION
+  assert len(mass_ID) <= 32, "Error: vocab_size does not fit a uint32 bitmask"
+  # excluding PAD, GO, EOS
+  mass_aa_round = [(aa_id, int(round(mass_ID[aa_id] * resolution)))
+                   for aa_id in range(3, len(mass_ID))]
+  mass_aa_min = min(mass for _, mass in mass_aa_round)
+  assert mass_aa_min > 0
+
+  # reachable[mass]: mass is 0 or a sum of AA masses
+  reachable = np.zeros(column_count + 1, dtype=bool)
+  reachable[0] = True
+  unique_mass_list = sorted(set(mass for _, mass in mass_aa_round))
+  for start in range(1, column_count + 1, mass_aa_min):
+    end = min(start + mass_aa_min, column_count + 1)
+    block = reachable[start:end]
+    for mass in unique_mass_list:
+      if end - mass <= 0:
+        break
+      block[max(mass - start, 0):] |= reachable[max(start - mass, 0):end-mass]
+
+  # col 0 ~ mass 1
+  column_mask = np.zeros(column_count, dtype=np.uint32)
+  for aa_id, mass in mass_aa_round:
+    if mass > column_count:
+      continue
+    column_mask[mass-1:] |= (reachable[:column_count-mass+1].astype(np.uint32)
+                             << np.uint32(aa_id))
+  return column_mask
+
+
+def unpack_columns(column_mask, vocab_size):
+  """Return the (vocab_size, columns) boolean matrix of the column masks."""
+
+  knapsack_matrix = np.zeros(shape=(vocab_size, len(column_mask)), dtype=bool)
+  for aa_id in range(vocab_size):
+    knapsack_matrix[aa_id] = (column_mask >> np.uint32(aa_id)) & np.uint32(1)
+  return knapsack_matrix
+
+
+def pack_columns(knapsack_matrix, chunk_size=1 << 18):
+  """Return the columns of knapsack_matrix as uint32 bitmasks (bit aa_id)."""
+
+  vocab_size, column_count = knapsack_matrix.shape
+  assert vocab_size <= 32, "Error: vocab_size does not fit a uint32 bitmask"
+  bits = np.left_shift(np.uint32(1), np.arange(vocab_size, dtype=np.uint32))
+  column_mask = np.zeros(column_count, dtype=np.uint32)
+  for start in range(0, column_count, chunk_size):
+    chunk = np.asarray(knapsack_matrix[:, start:start+chunk_size], dtype=bool)
+    column_mask[start:start+chunk_size] = np.bitwise_or.reduce(
+        np.where(chunk, bits[:, np.newaxis], np.uint32(0)),
+        axis=0)
+  return column_mask
+
+
+def window_or(column_mask, tolerance):
+  """Return window_mask, window_mask[col] = OR of column_mask[col-tolerance,
+     col+tolerance] (inclusive, clipped to the columns), for col in
+     [0, len(column_mask) + tolerance).
+  """
+
+  column_count = len(column_mask)
+  width = 2 * tolerance + 1
+  window_count = column_count + tolerance
+  # padded[i] is column i - tolerance, zeros outside of the columns
+  padded = np.zeros(column_count + 3 * tolerance + 1, dtype=np.uint32)
+  padded[tolerance:tolerance+column_count] = column_mask
+  # doubling: after each pass padded[i] = OR of the span columns from i
+  span = 1
+  while 2 * span <= width:
+    padded[:-span] |= padded[span:].copy()
+    span *= 2
+  return padded[:window_count] | padded[width-span:width-span+window_count]
+
+
+def window_or_at(column_mask, column, tolerance):
+  """Return window_or(column_mask, tolerance[i])[column[i]] for each i,
+     without the whole windows: the columns of all windows are gathered and
+     ORed by one np.bitwise_or.reduceat(). column[i] must be in
+     [0, len(column_mask) + tolerance[i]).
+  """
+
+  column = np.asarray(column, dtype=np.int64)
+  tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.int64),
+                              column.shape)
+  if len(column) == 0:
+    return np.zeros(0, dtype=np.uint32)
+  lowerbound = np.maximum(column - tolerance, 0)
+  upperbound = np.minimum(column + tolerance, len(column_mask) - 1)
+  length = upperbound - lowerbound + 1
+  offset = np.cumsum(length) - length
+  window_column = (np.repeat(lowerbound - offset, length)
+                   + np.arange(int(length.sum())))
+  return np.bitwise_or.reduceat(np.asarray(column_mask)[window_column], offset)
+
+
+class KnapsackIndex(object):
+  """Bitmask index of a knapsack matrix.
+
+     column_mask[col]: bitmask of knapsack_matrix[:, col].
+     window_mask(tolerance)[col]: OR of column_mask over the columns
+       searched by knapsack_search() around col with that tolerance; the
+       STANDARD_TOLERANCE_LIST are computed up front, others on first use.
+     search_mask() reads the window masks computed so far and ORs the
+     columns of the other tolerances directly (window_or_at()), so that
+     per-spectrum tolerances (--precursor_ppm) do not build a window mask
+     each.
+  """
+
+
+  def __init__(self, column_mask, vocab_size, tolerance_list=None):
+    """Index column_mask, precomputing the windows of tolerance_list."""
+
+    self.column_mask = column_mask
+    self.vocab_size = vocab_size
+    self.window_mask_dict = {}
+    if tolerance_list is None:
+      tolerance_list = STANDARD_TOLERANCE_LIST
+    for tolerance in tolerance_list:
+      self.window_mask(tolerance)
+
+
+  @classmethod
+  def from_matrix(cls, knapsack_matrix, tolerance_list=None):
+    """Build the index of a (vocab_size, columns) boolean knapsack matrix."""
+
+    return cls(pack_columns(knapsack_matrix),
+               knapsack_matrix.shape[0],
+               tolerance_list)
+
+
+  def window_mask(self, tolerance):
+    """Return the window masks of tolerance, computing them on first use."""
+
+    tolerance = int(tolerance)
+    if tolerance not in self.window_mask_dict:
+      self.window_mask_dict[tolerance] = window_or(self.column_mask, tolerance)
+    return self.window_mask_dict[tolerance]
+
+
+  def search_mask(self, peptide_mass, tolerance):
+    """Batched knapsack_search(): the bitmasks of the AA ids that can end
+       the masses peptide_mass (array, Da) within tolerance (scalar or array
+       of the same shape, in 1/KNAPSACK_AA_RESOLUTION Da).
+    """
+
+    peptide_mass = np.asarray(peptide_mass, dtype=np.float64)
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.int64),
+                                peptide_mass.shape)
+    peptide_mass_round = np.rint(
+        peptide_mass * deepnovo_config.KNAPSACK_AA_RESOLUTION).astype(np.int64)
+    # col 0 ~ mass 1
+    peptide_mass_col = peptide_mass_round - 1
+
+    # [peptide_mass_lowerbound, peptide_mass_upperbound] will NOT be less
+    #   than mass_AA_min_round, columns past the matrix are ignored
+    found = ((peptide_mass_round + tolerance
+              >= deepnovo_config.mass_AA_min_round)
+             & (peptide_mass_col >= 0)
+             & (peptide_mass_col < len(self.column_mask) + tolerance))
+    search_mask = np.zeros(peptide_mass.shape, dtype=np.uint32)
+    direct = found.copy()
+    for tolerance_value in np.unique(tolerance[found]).tolist():
+      if tolerance_value in self.window_mask_dict:
+        window_mask = self.window_mask_dict[tolerance_value]
+        index = found & (tolerance == tolerance_value)
+        search_mask[index] = window_mask[peptide_mass_col[index]]
+        direct &= ~index
+    if direct.any():
+      search_mask[direct] = window_or_at(self.column_mask,
+                                         peptide_mass_col[direct],
+                                         tolerance[direct])
+    return search_mask
+
+
+  def candidate_mask(self, search_mask):
+    """Expand bitmasks into a [len(search_mask), vocab_size] boolean array."""
+
+    bits = np.arange(self.vocab_size, dtype=np.uint32)
+    return ((np.asarray(search_mask, dtype=np.uint32)[:, np.newaxis] >> bits)
+            & np.uint32(1)).astype(bool)
+
+
+  def search(self, peptide_mass, tolerance):
+    """Same as knapsack_search(knapsack_matrix, peptide_mass, tolerance)."""
+
+    search_mask = self.search_mask([peptide_mass], tolerance)
+    return np.flatnonzero(self.candidate_mask(search_mask)[0]).tolist()
+
+
+def save_store(store_dir, knapsack_index, tolerance_list=None):
+  """Write knapsack_index and its window masks of tolerance_list.
+
+     The store is written into a temporary directory and renamed, so it is
+     never seen half-written.
+  """
+
+  if tolerance_list is None:
+    tolerance_list = STANDARD_TOLERANCE_LIST
+  temp_dir = "{0}.{1:d}.tmp".format(store_dir, os.getpid())
+  if os.path.exists(temp_dir):
+    shutil.rmtree(temp_dir)
+  os.makedirs(temp_dir)
+  np.save(os.path.join(temp_dir, "column_mask.npy"), knapsack_index.column_mask)
+  for tolerance in tolerance_list:
+    np.save(os.path.join(temp_dir, "window_{0:d}.npy".format(tolerance)),
+            knapsack_index.window_mask(tolerance))
+  with open(os.path.join(temp_dir, "knapsack.json"), "w") as handle:
+    json.dump({"version": STORE_VERSION,
+               "vocab_size": knapsack_index.vocab_size,
+               "resolution": deepnovo_config.KNAPSACK_AA_RESOLUTION,
+               "column_count": len(knapsack_index.column_mask),
+               "tolerance_list": list(tolerance_list)},
+              handle)
+  if os.path.exists(store_dir):
+    shutil.rmtree(store_dir)
+  os.rename(temp_dir, store_dir)
+
+
+def load_store(store_dir):
+  """Open a knapsack store, its arrays memory-mapped read-only."""
+
+  with open(os.path.join(store_dir, "knapsack.json")) as handle:
+    info = json.load(handle)
+  assert info["version"] == STORE_VERSION, "Error: unknown knapsack version"
+  assert info["vocab_size"] == deepnovo_config.vocab_size, (
+      "Error: knapsack store of another vocabulary")
+  assert info["resolution"] == deepnovo_config.KNAPSACK_AA_RESOLUTION, (
+      "Error: knapsack store of another KNAPSACK_AA_RESOLUTION")
+  knapsack_index = KnapsackIndex(
+      np.load(os.path.join(store_dir, "column_mask.npy"), mmap_mode="r"),
+      info["vocab_size"],
+      tolerance_list=[])
+  for tolerance in info["tolerance_list"]:
+    knapsack_index.window_mask_dict[tolerance] = np.load(
+        os.path.join(store_dir, "window_{0:d}.npy".format(tolerance)),
+        mmap_mode="r")
+  return knapsack_index
+
+
+def load_knapsack_index(knapsack_file):
+  """Return the KnapsackIndex of knapsack_file.
+
+     knapsack_file is a knapsack store, or a knapsack matrix (.npy) whose
+     store "<name>.kpack" is used if it exists, else the matrix is indexed
+     in memory.
+  """
+
+  start_time = time.time()
+  if is_store(knapsack_file):
+    knapsack_index = load_store(knapsack_file)
+  elif is_store(store_name(knapsack_file)):
+    knapsack_file = store_name(knapsack_file)
+    knapsack_index = load_store(knapsack_file)
+  else:
+    print("No knapsack store {0:s}, indexing the matrix in memory"
+          " (--knapsack_build writes the store)".format(
+              store_name(knapsack_file)))
+    knapsack_matrix = np.load(knapsack_file, mmap_mode="r")
+    knapsack_index = KnapsackIndex.from_matrix(knapsack_matrix)
+  print("knapsack index of {0:s}, {1:.2f} s".format(knapsack_file,
+                                                    time.time() - start_time))
+  return knapsack_index
+
+
+def check_knapsack(knapsack_file, column_mask):
+  """Compare column_mask with the columns of the knapsack matrix file.
+
+     Return the number of columns that differ, the extra columns of the
+     longer one included.
+  """
+
+  knapsack_matrix = np.load(knapsack_file, mmap_mode="r")
+  assert knapsack_matrix.shape[0] == deepnovo_config.vocab_size, (
+      "Error: knapsack matrix of another vocabulary")
+  column_count = min(knapsack_matrix.shape[1], len(column_mask))
+  diff_count = int(np.count_nonzero(
+      pack_columns(knapsack_matrix[:, :column_count])
+      != column_mask[:column_count]))
+  diff_count += abs(knapsack_matrix.shape[1] - len(column_mask))
+  print("check_knapsack(): {0:s} has {1:d} columns, {2:d} differ".format(
+      knapsack_file,
+      knapsack_matrix.shape[1],
+      diff_count))
+  return diff_count
+
+
+def as_knapsack_index(knapsack):
+  """Return knapsack if it is a KnapsackIndex, else the index of the matrix."""
+
+  if isinstance(knapsack, KnapsackIndex):
+    return knapsack
+  return KnapsackIndex.from_matrix(knapsack, tolerance_list=[])
@@ -30,13 +30,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import io
 import math
+import multiprocessing
 import os
 import random
 #~ random.seed(4)
 import sys
 import time
-import re
+import contextlib
 #import resource
 import glob
 
@@ -47,10 +50,20 @@ import numpy as np
 from six.moves import range  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import deepnovo_beam
 import deepnovo_config
+import deepnovo_knapsack
 import deepnovo_model
+import deepnovo_mgf_io
+import deepnovo_mzml
+import deepnovo_prefetch
+import deepnovo_spectrum_store
 
-from deepnovo_debug import process_spectrum, get_candidate_intensity
+from deepnovo_debug import get_candidate_intensity
+from deepnovo_debug import iter_process_spectrum_stack
+from deepnovo_debug import densify_spectrum, densify_spectrum_batch
+from deepnovo_debug import pack_sparse_spectra, get_candidate_intensity_batch
+from deepnovo_debug import warm_up
 
 import socket
 
@@ -65,6 +78,11 @@ def inspect_file_location(data_format, input_file):
 
   print("inspect_file_location(), input_file = ", input_file)
 
+  # a binary spectrum store addresses its spectra by index
+  if deepnovo_spectrum_store.is_store(input_file):
+    with deepnovo_spectrum_store.SpectrumStore(input_file) as store:
+      return store.get_location()
+
   if data_format == "msp":
     keyword = "Name"
   elif data_format == "mgf":
@@ -83,30 +101,14 @@ def inspect_file_location(data_format, input_file):
   #           spectra_file_location.append(file_location)
   # print(time.time() - start_time)
 
-  spectra_file_location = []
-  # start_time = time.time()
-  with open(input_file, mode="r") as file_handle:
-    # file_location = 0
-    # for line in file_handle:     
-    #   if len(line) > 0:
-    #     if line[0] == 'B':
-    #       if keyword in line:
-    #         spectra_file_location.append(file_location)
-            
-    #   file_location = file_location + len(line)
-
-    file_location = 0
-    line = file_handle.readline()
-    while line:     
-      if len(line) > 0:
-        if line[0] == 'B':
-          if keyword in line:
-            spectra_file_location.append(file_location)
-            
-      # file_location = file_location + len(line)
-      file_location = file_handle.tell()
-      line = file_handle.readline()
-  # print(time.time() - start_time)    
+  # bulk byte-offset scan over a memory-mapped file, see deepnovo_mgf_io
+  # mgf offsets are cached in a sidecar index next to the input file
+  if data_format == "mgf":
+    spectra_file_location = deepnovo_mgf_io.get_index(
+        input_file)["offsets"].tolist()
+  else:
+    spectra_file_location = deepnovo_mgf_io.locate_spectra(input_file,
+                                                           keyword).tolist()
 
   return spectra_file_location
 
@@ -124,26 +126,167 @@ def inspect_files_locations(data_format, input_files):
   return file_index,spectra_file_locations
 
 
-def spectra_header(file_handle, location):
-  file_handle.seek(location)
-  line = file_handle.readline()
-  assert ("BEGIN IONS" in line), "ERROR: read_spectra(); wrong format"
-
-  header_dict = {}
-  # new_location = location + len(line)
-  new_location = file_handle.tell()
-  line = file_handle.readline()
-  ## while not reading mass + intensity
-  while not bool(re.search("^[0-9.]+ [0-9.]+$", line)):
-    var_name = re.split('=|\n', line, 1)[0]
-    var_value = re.split('=|\n', line, 1)[1]
-    header_dict[var_name] = var_value
-    # new_location = new_location + len(line)
-    new_location = file_handle.tell()
-    line = file_handle.readline()
-  
-  file_handle.seek(new_location)
-  return(header_dict)
+def open_spectra_file(input_file):
+  """Open an mgf file or a binary spectrum store for read_spectra()."""
+
+  if deepnovo_spectrum_store.is_store(input_file):
+    return deepnovo_spectrum_store.SpectrumStore(input_file)
+  else:
+    return open(input_file, 'rb')
+
+
+def read_spectra_stacks(input_file,
+                        spectra_file_location,
+                        stack_size,
+                        file_index=0):
+  """Yield (file_handle, stack_locations) to read input_file stack by stack.
+
+     mgf files and spectrum stores are read through one open handle at the
+     given spectra_file_location. mzML files are streamed instead (with
+     spectra_file_location = None) and only one stack is held in memory.
+  """
+
+  if deepnovo_mzml.is_mzml(input_file):
+    for spectrum_stack in deepnovo_mzml.iter_spectrum_stacks(input_file,
+                                                             stack_size,
+                                                             file_index):
+      yield spectrum_stack, spectrum_stack.get_location()
+  else:
+    with open_spectra_file(input_file) as file_handle:
+      for i in range(0, len(spectra_file_location), stack_size):
+        yield file_handle, spectra_file_location[i:i+stack_size]
+
+
+def append_data_set(data_set, scan, spectra, peptide_mass, peptide):
+  """Add a pre-processed spectrum and its peptide to its bucket in data_set.
+
+     spectra is (spectrum_holder, spectrum_original_forward,
+     spectrum_original_backward), dense or sparse, see read_spectra().
+  """
+
+  (spectrum_holder,
+   spectrum_original_forward,
+   spectrum_original_backward) = spectra
+  peptide_len = len(peptide)
+
+  # PRE-PROCESS decoder_input
+  for bucket_id, target_size in enumerate(deepnovo_config._buckets):
+    if peptide_len + 2 <= target_size: # +2 to include GO and EOS
+      break
+  decoder_size = deepnovo_config._buckets[bucket_id]
+  # parse peptide AA sequence to list of ids
+  peptide_ids = [deepnovo_config.vocab[x] for x in peptide]
+  # PADDING
+  pad_size = decoder_size - (len(peptide_ids) + 2)
+  # forward
+  if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
+    peptide_ids_forward = peptide_ids[:]
+    peptide_ids_forward.insert(0, deepnovo_config.GO_ID)
+    peptide_ids_forward.append(deepnovo_config.EOS_ID)
+    peptide_ids_forward += [deepnovo_config.PAD_ID] * pad_size
+  # backward
+  if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
+    peptide_ids_backward = peptide_ids[::-1]
+    peptide_ids_backward.insert(0, deepnovo_config.EOS_ID)
+    peptide_ids_backward.append(deepnovo_config.GO_ID)
+    peptide_ids_backward += [deepnovo_config.PAD_ID] * pad_size
+
+  #~ # for testing
+  #~ start_time = time.time()
+
+  # PRE-PROCESS candidate_intensity
+  if not deepnovo_config.FLAGS.beam_search:
+
+    # forward
+    if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
+
+      candidate_intensity_list_forward = []
+      prefix_mass = 0.0
+      for index in range(decoder_size):
+
+        prefix_mass += deepnovo_config.mass_ID[peptide_ids_forward[index]]
+        candidate_intensity = get_candidate_intensity(
+          spectrum_original_forward,
+          peptide_mass,
+          prefix_mass,
+          0)
+        ################################################################
+        # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
+        #   spectrum_original_forward,
+        #   peptide_mass,
+        #   prefix_mass,
+        #   0)
+
+        # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
+        #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
+        ################################################################
+        candidate_intensity_list_forward.append(candidate_intensity)
+
+    # backward
+    if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
+
+      candidate_intensity_list_backward = []
+      suffix_mass = 0.0
+      for index in range(decoder_size):
+
+        suffix_mass += deepnovo_config.mass_ID[peptide_ids_backward[index]]
+        candidate_intensity = get_candidate_intensity(
+            spectrum_original_backward,
+            peptide_mass,
+            suffix_mass,
+            1)
+        ################################################################
+        # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
+        #     spectrum_original_backward,
+        #     peptide_mass,
+        #     suffix_mass,
+        #     1)
+
+        # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
+        #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
+        ################################################################
+        candidate_intensity_list_backward.append(candidate_intensity)
+
+  #~ # for testing
+  #~ test_time += time.time() - start_time
+
+  # assign data to buckets
+  if deepnovo_config.FLAGS.beam_search:
+    if deepnovo_config.FLAGS.direction == 0:
+      data_set[bucket_id].append([scan,
+                                  spectrum_holder,
+                                  spectrum_original_forward,
+                                  peptide_mass,
+                                  peptide_ids_forward])
+    elif deepnovo_config.FLAGS.direction == 1:
+      data_set[bucket_id].append([scan,
+                                  spectrum_holder,
+                                  spectrum_original_backward,
+                                  peptide_mass,
+                                  peptide_ids_backward])
+    else:
+      data_set[bucket_id].append([scan,
+                                  spectrum_holder,
+                                  spectrum_original_forward,
+                                  spectrum_original_backward,
+                                  peptide_mass,
+                                  peptide_ids_forward,
+                                  peptide_ids_backward])
+  else:
+    if deepnovo_config.FLAGS.direction == 0:
+      data_set[bucket_id].append([spectrum_holder,
+                                  candidate_intensity_list_forward,
+                                  peptide_ids_forward])
+    elif deepnovo_config.FLAGS.direction == 1:
+      data_set[bucket_id].append([spectrum_holder,
+                                  candidate_intensity_list_backward,
+                                  peptide_ids_backward])
+    else:
+      data_set[bucket_id].append([spectrum_holder,
+                                  candidate_intensity_list_forward,
+                                  candidate_intensity_list_backward,
+                                  peptide_ids_forward,
+                                  peptide_ids_backward])
 
 
 def read_spectra(file_handle, data_format, spectra_locations):
@@ -164,24 +307,32 @@ def read_spectra(file_handle, data_format, spectra_locations):
   counter_skipped_mass_precision = 0
   avg_peak_count = 0.0
   avg_peptide_len = 0.0
+  entry_list = []
+  spectrum_mz_list = []
+  spectrum_intensity_list = []
+  peptide_mass_list = []
+  peak_count_read = 0
+  peak_count_kept = 0
 
   if data_format == "mgf":
     keyword = "BEGIN IONS"
 
   for location in spectra_locations:
-    header_dict = spectra_header(file_handle, location)
+    if isinstance(file_handle, deepnovo_spectrum_store.SpectrumStore):
+      header_dict = file_handle.get_header(location)
+    else:
+      # read the whole spectrum block, its peak list is converted below
+      #   only if the spectrum is not skipped
+      (header_dict,
+       block,
+       peak_start) = deepnovo_mgf_io.read_header(file_handle, location)
     peptide_ion_mz = float(header_dict['PEPMASS'].split(' ')[0])
     charge = float(header_dict['CHARGE'].split('+')[0])
 
-    if ('SCANS' in header_dict.keys()):
-      scan = header_dict['SCANS'].split('\n')[0]
-    elif ('scan=' in header_dict['TITLE']):
-      scan = 'scan' + header_dict['TITLE'].split('scan=')[1].split('\n')[0]
-    else:
-      scan = 'scan_' + header_dict['TITLE'].split('\n')[0]
+    scan = deepnovo_mgf_io.header_scan(header_dict)
 
     if ('SEQ' in header_dict.keys()):
-      raw_sequence = header_dict['SEQ'].split('\n')[0]
+      raw_sequence = header_dict['SEQ']
     else:
       raw_sequence = 'UNKNOWN'
 
@@ -306,21 +457,24 @@ def read_spectra(file_handle, data_format, spectra_locations):
           counter_skipped += 1
           continue
 
-      # read spectrum
-      spectrum_mz = []
-      spectrum_intensity = []
-      line = file_handle.readline()
-      while not "END IONS" in line:
-        # parse pairs of "mz intensity"
-        mz, intensity = re.split(' |\n', line)[:2]
-        intensity_float = float(intensity)
-        mz_float = float(mz)
-        if mz_float > deepnovo_config.MZ_MAX: # skip this peak
-          line = file_handle.readline()
-          continue
-        spectrum_mz.append(mz_float)
-        spectrum_intensity.append(intensity_float)
-        line = file_handle.readline()
+    # read spectrum
+    if isinstance(file_handle, deepnovo_spectrum_store.SpectrumStore):
+      # a store returns memory-mapped peaks without any parsing
+      spectrum_mz, spectrum_intensity = file_handle.get_peaks(
+          location,
+          deepnovo_config.MZ_MAX)
+    else:
+      # convert the peak list in bulk
+      spectrum_mz, spectrum_intensity = deepnovo_mgf_io.parse_peaks(
+          block,
+          peak_start,
+          deepnovo_config.MZ_MAX)
+    if deepnovo_config.peak_filter.enabled:
+      peak_count_read += len(spectrum_mz)
+      spectrum_mz, spectrum_intensity = deepnovo_config.peak_filter.filter(
+          spectrum_mz,
+          spectrum_intensity)
+      peak_count_kept += len(spectrum_mz)
 
     # AN ENTRY FOUND
     counter += 1
@@ -339,147 +493,25 @@ def read_spectra(file_handle, data_format, spectra_locations):
       counter_skipped += 1
       continue
 
-    # PRE-PROCESS SPECTRUM
-    try:
-      (spectrum_holder,
-       spectrum_original_forward,
-       spectrum_original_backward) = process_spectrum(spectrum_mz,
-                                                      spectrum_intensity,
-                                                      peptide_mass)
-    except Exception as e:
-      raise e
-
-    ################################################################
-    # (spectrum_holder_debug,
-    #  spectrum_original_forward_debug,
-    #  spectrum_original_backward_debug) = deepnovo_debug.process_spectrum(spectrum_mz,
-    #                                                                spectrum_intensity,
-    #                                                                peptide_mass)
-
-    # assert np.array_equal(spectrum_holder_debug, spectrum_holder) & \
-    #        np.array_equal(spectrum_original_forward_debug, spectrum_original_forward) & \
-    #        np.array_equal(spectrum_original_backward_debug, spectrum_original_backward), \
-    #   "[ERR] deepnovo_debug.process_spectrum is different from the original."
-    ################################################################
-
-    # PRE-PROCESS decoder_input
-    for bucket_id, target_size in enumerate(deepnovo_config._buckets):
-      if peptide_len + 2 <= target_size: # +2 to include GO and EOS
-        break
-    decoder_size = deepnovo_config._buckets[bucket_id]
-    # parse peptide AA sequence to list of ids
-    peptide_ids = [deepnovo_config.vocab[x] for x in peptide]
-    # PADDING
-    pad_size = decoder_size - (len(peptide_ids) + 2)
-    # forward
-    if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_forward = peptide_ids[:]
-      peptide_ids_forward.insert(0, deepnovo_config.GO_ID)
-      peptide_ids_forward.append(deepnovo_config.EOS_ID)
-      peptide_ids_forward += [deepnovo_config.PAD_ID] * pad_size
-    # backward
-    if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_backward = peptide_ids[::-1]
-      peptide_ids_backward.insert(0, deepnovo_config.EOS_ID)
-      peptide_ids_backward.append(deepnovo_config.GO_ID)
-      peptide_ids_backward += [deepnovo_config.PAD_ID] * pad_size
-
-    #~ # for testing
-    #~ start_time = time.time()
-
-    # PRE-PROCESS candidate_intensity
-    if not deepnovo_config.FLAGS.beam_search:
-
-      # forward
-      if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_forward = []
-        prefix_mass = 0.0
-        for index in range(decoder_size):
-
-          prefix_mass += deepnovo_config.mass_ID[peptide_ids_forward[index]]
-          candidate_intensity = get_candidate_intensity(
-            spectrum_original_forward,
-            peptide_mass,
-            prefix_mass,
-            0)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #   spectrum_original_forward,
-          #   peptide_mass,
-          #   prefix_mass,
-          #   0)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_forward.append(candidate_intensity)
-
-      # backward
-      if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_backward = []
-        suffix_mass = 0.0
-        for index in range(decoder_size):
-
-          suffix_mass += deepnovo_config.mass_ID[peptide_ids_backward[index]]
-          candidate_intensity = get_candidate_intensity(
-              spectrum_original_backward,
-              peptide_mass,
-              suffix_mass,
-              1)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #     spectrum_original_backward,
-          #     peptide_mass,
-          #     suffix_mass,
-          #     1)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_backward.append(candidate_intensity)
-
-    #~ # for testing
-    #~ test_time += time.time() - start_time
-
-    # assign data to buckets
-    if deepnovo_config.FLAGS.beam_search:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    peptide_mass,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
-    else:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
+    # the spectrum is pre-processed below with the whole stack
+    entry_list.append((scan, peptide))
+    spectrum_mz_list.append(spectrum_mz)
+    spectrum_intensity_list.append(spectrum_intensity)
+    peptide_mass_list.append(peptide_mass)
+
+  # PRE-PROCESS SPECTRUM
+  # all spectra of the stack are pre-processed by one kernel call; beam search
+  # keeps a whole stack of spectra, hence they are kept sparse as
+  # (location, intensity) and densified batch by batch
+  spectra_iterator = iter_process_spectrum_stack(
+      spectrum_mz_list,
+      spectrum_intensity_list,
+      peptide_mass_list,
+      sparse=deepnovo_config.FLAGS.beam_search)
+  for (scan, peptide), peptide_mass, spectra in zip(entry_list,
+                                                    peptide_mass_list,
+                                                    spectra_iterator):
+    append_data_set(data_set, scan, spectra, peptide_mass, peptide)
 
   #~ # for testing
   #~ print("test_time = {0:.2f}".format(test_time))
@@ -494,6 +526,9 @@ def read_spectra(file_handle, data_format, spectra_locations):
         % counter_skipped_mass_precision)
 
   print("  average #peaks per spectrum %.1f" % (avg_peak_count/counter))
+  if deepnovo_config.peak_filter.enabled:
+    print("  total peaks dropped by peak filter %d/%d"
+          % (peak_count_read - peak_count_kept, peak_count_read))
   print("  average peptide length %.1f" % (avg_peptide_len/counter))
 
   return data_set, [counter,
@@ -507,6 +542,60 @@ def read_spectra(file_handle, data_format, spectra_locations):
     avg_peptide_len]
 
 
+def read_stack_data_sets(input_file, spectra_file_location, stack_size, file_index=0):
+  """Yield (stack_data_set, counts, stack_len) of input_file stack by stack.
+
+     stack_data_set and counts are the outputs of read_spectra(), stack_len is
+     the number of spectra in the stack.
+  """
+
+  spectra_stacks = read_spectra_stacks(input_file,
+                                       spectra_file_location,
+                                       stack_size,
+                                       file_index)
+  with contextlib.closing(spectra_stacks):
+    for input_file_handle, stack in spectra_stacks:
+      stack_data_set, counts = read_spectra(input_file_handle,
+                                            deepnovo_config.data_format,
+                                            stack)
+      yield stack_data_set, counts, len(stack)
+
+
+def read_all_stack_data_sets(input_files, stack_size):
+  """Read the stacks of all input_files, this is the prefetching producer.
+
+     Yields ("begin", data_set_len) for each file, then its stacks as
+     ("stack", (stack_data_set, counts, stack_len)), then ("end", None).
+  """
+
+  mzml_file_index = deepnovo_mzml.mzml_file_index(input_files)
+  for input_file in input_files:
+    if deepnovo_mzml.is_mzml(input_file):
+      spectra_file_location = None
+      data_set_len = "?"
+    else:
+      spectra_file_location = inspect_file_location(deepnovo_config.data_format,
+                                                    input_file)
+      data_set_len = len(spectra_file_location)
+    yield "begin", data_set_len
+    for stack_item in read_stack_data_sets(input_file,
+                                           spectra_file_location,
+                                           stack_size,
+                                           mzml_file_index.get(input_file, 0)):
+      yield "stack", stack_item
+    yield "end", None
+
+
+def iter_file_stack_data_sets(prefetch_iterator):
+  """Yield the stacks of the current file from a read_all_stack_data_sets()
+     iterator, up to its "end"."""
+
+  for message, value in prefetch_iterator:
+    if message == "end":
+      return
+    yield value
+
+
 def read_spectra_from_multiple_files(data_format, file_names, spectra_locations):
   """TODO(nh2tran): docstring."""
 
@@ -525,19 +614,24 @@ def read_spectra_from_multiple_files(data_format, file_names, spectra_locations)
   counter_skipped_mass_precision = 0
   avg_peak_count = 0.0
   avg_peptide_len = 0.0
+  entry_list = []
+  spectrum_mz_list = []
+  spectrum_intensity_list = []
+  peptide_mass_list = []
+  peak_count_read = 0
+  peak_count_kept = 0
 
   if data_format == "mgf":
     keyword = "BEGIN IONS"
 
   for location_info in spectra_locations:
 
-    file_handle = open(file_names[location_info[0]], 'r')
-
     location = location_info[1]
 
-    file_handle.seek(location)
-    line = file_handle.readline()
-    assert (keyword in line), "ERROR: read_spectra(); wrong format"
+    with open(file_names[location_info[0]], 'rb') as file_handle:
+      (header_dict,
+       block,
+       peak_start) = deepnovo_mgf_io.read_header(file_handle, location)
 
     unknown_modification = False
     unknown_AA = False
@@ -545,28 +639,10 @@ def read_spectra_from_multiple_files(data_format, file_names, spectra_locations)
     # READ AN ENTRY
     if data_format == "mgf":
 
-      # header TITLE
-      line = file_handle.readline()
-
-      # header PEPMASS
-      line = file_handle.readline()
-      peptide_ion_mz = float(re.split('=|\n', line)[1])
-
-      # header CHARGE
-      line = file_handle.readline()
-      charge = float(re.split('=|\+', line)[1]) # pylint: disable=anomalous-backslash-in-string,line-too-long
-
-      # header SCANS
-      line = file_handle.readline()
-      #~ scan = int(re.split('=', line)[1])
-      scan = re.split('=|\n', line)[1]
-
-      # header RTINSECONDS
-      line = file_handle.readline()
-
-      # header SEQ
-      line = file_handle.readline()
-      raw_sequence = re.split('=|\n|\r', line)[1]
+      peptide_ion_mz = float(header_dict['PEPMASS'].split(' ')[0])
+      charge = float(header_dict['CHARGE'].split('+')[0])
+      scan = deepnovo_mgf_io.header_scan(header_dict)
+      raw_sequence = header_dict['SEQ']
       raw_sequence_len = len(raw_sequence)
       peptide = []
       index = 0
@@ -647,21 +723,17 @@ def read_spectra_from_multiple_files(data_format, file_names, spectra_locations)
         counter_skipped += 1
         continue
 
-      # read spectrum
-      spectrum_mz = []
-      spectrum_intensity = []
-      line = file_handle.readline()
-      while not "END IONS" in line:
-        # parse pairs of "mz intensity"
-        mz, intensity = re.split(' |\n', line)[:2]
-        intensity_float = float(intensity)
-        mz_float = float(mz)
-        if mz_float > deepnovo_config.MZ_MAX: # skip this peak
-          line = file_handle.readline()
-          continue
-        spectrum_mz.append(mz_float)
-        spectrum_intensity.append(intensity_float)
-        line = file_handle.readline()
+    # read spectrum, convert the peak list in bulk
+    spectrum_mz, spectrum_intensity = deepnovo_mgf_io.parse_peaks(
+        block,
+        peak_start,
+        deepnovo_config.MZ_MAX)
+    if deepnovo_config.peak_filter.enabled:
+      peak_count_read += len(spectrum_mz)
+      spectrum_mz, spectrum_intensity = deepnovo_config.peak_filter.filter(
+          spectrum_mz,
+          spectrum_intensity)
+      peak_count_kept += len(spectrum_mz)
 
     # AN ENTRY FOUND
     counter += 1
@@ -675,145 +747,25 @@ def read_spectra_from_multiple_files(data_format, file_names, spectra_locations)
     # Average peptide length
     avg_peptide_len += peptide_len
 
-    # PRE-PROCESS SPECTRUM
-    (spectrum_holder,
-     spectrum_original_forward,
-     spectrum_original_backward) = process_spectrum(spectrum_mz,
-                                                    spectrum_intensity,
-                                                    peptide_mass)
-
-    ################################################################
-    # (spectrum_holder_debug,
-    #  spectrum_original_forward_debug,
-    #  spectrum_original_backward_debug) = deepnovo_debug.process_spectrum(spectrum_mz,
-    #                                                                spectrum_intensity,
-    #                                                                peptide_mass)
-
-    # assert np.array_equal(spectrum_holder_debug, spectrum_holder) & \
-    #        np.array_equal(spectrum_original_forward_debug, spectrum_original_forward) & \
-    #        np.array_equal(spectrum_original_backward_debug, spectrum_original_backward), \
-    #   "[ERR] deepnovo_debug.process_spectrum is different from the original."
-    ################################################################
-
-    # PRE-PROCESS decoder_input
-    for bucket_id, target_size in enumerate(deepnovo_config._buckets):
-      if peptide_len + 2 <= target_size: # +2 to include GO and EOS
-        break
-    decoder_size = deepnovo_config._buckets[bucket_id]
-    # parse peptide AA sequence to list of ids
-    peptide_ids = [deepnovo_config.vocab[x] for x in peptide]
-    # PADDING
-    pad_size = decoder_size - (len(peptide_ids) + 2)
-    # forward
-    if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_forward = peptide_ids[:]
-      peptide_ids_forward.insert(0, deepnovo_config.GO_ID)
-      peptide_ids_forward.append(deepnovo_config.EOS_ID)
-      peptide_ids_forward += [deepnovo_config.PAD_ID] * pad_size
-    # backward
-    if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_backward = peptide_ids[::-1]
-      peptide_ids_backward.insert(0, deepnovo_config.EOS_ID)
-      peptide_ids_backward.append(deepnovo_config.GO_ID)
-      peptide_ids_backward += [deepnovo_config.PAD_ID] * pad_size
-
-    #~ # for testing
-    #~ start_time = time.time()
-
-    # PRE-PROCESS candidate_intensity
-    if not deepnovo_config.FLAGS.beam_search:
-
-      # forward
-      if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_forward = []
-        prefix_mass = 0.0
-        for index in range(decoder_size):
-
-          prefix_mass += deepnovo_config.mass_ID[peptide_ids_forward[index]]
-          candidate_intensity = get_candidate_intensity(
-            spectrum_original_forward,
-            peptide_mass,
-            prefix_mass,
-            0)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #   spectrum_original_forward,
-          #   peptide_mass,
-          #   prefix_mass,
-          #   0)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_forward.append(candidate_intensity)
-
-      # backward
-      if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_backward = []
-        suffix_mass = 0.0
-        for index in range(decoder_size):
-
-          suffix_mass += deepnovo_config.mass_ID[peptide_ids_backward[index]]
-          candidate_intensity = get_candidate_intensity(
-              spectrum_original_backward,
-              peptide_mass,
-              suffix_mass,
-              1)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #     spectrum_original_backward,
-          #     peptide_mass,
-          #     suffix_mass,
-          #     1)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_backward.append(candidate_intensity)
-
-    #~ # for testing
-    #~ test_time += time.time() - start_time
-
-    # assign data to buckets
-    if deepnovo_config.FLAGS.beam_search:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    peptide_mass,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
-    else:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
-    file_handle.close()
+    # the spectrum is pre-processed below with the whole stack
+    entry_list.append((scan, peptide))
+    spectrum_mz_list.append(spectrum_mz)
+    spectrum_intensity_list.append(spectrum_intensity)
+    peptide_mass_list.append(peptide_mass)
+
+  # PRE-PROCESS SPECTRUM
+  # all spectra of the stack are pre-processed by one kernel call; beam search
+  # keeps a whole stack of spectra, hence they are kept sparse as
+  # (location, intensity) and densified batch by batch
+  spectra_iterator = iter_process_spectrum_stack(
+      spectrum_mz_list,
+      spectrum_intensity_list,
+      peptide_mass_list,
+      sparse=deepnovo_config.FLAGS.beam_search)
+  for (scan, peptide), peptide_mass, spectra in zip(entry_list,
+                                                    peptide_mass_list,
+                                                    spectra_iterator):
+    append_data_set(data_set, scan, spectra, peptide_mass, peptide)
 
   #~ # for testing
   #~ print("test_time = {0:.2f}".format(test_time))
@@ -828,6 +780,9 @@ def read_spectra_from_multiple_files(data_format, file_names, spectra_locations)
         % counter_skipped_mass_precision)
 
   print("  average #peaks per spectrum %.1f" % (avg_peak_count/counter))
+  if deepnovo_config.peak_filter.enabled:
+    print("  total peaks dropped by peak filter %d/%d"
+          % (peak_count_read - peak_count_kept, peak_count_read))
   print("  average peptide length %.1f" % (avg_peptide_len/counter))
 
   return data_set, [counter,
@@ -859,6 +814,10 @@ def read_spectra_from_multiple_pickles(all_spectra_in_memory, all_sequence_in_me
   counter_skipped_mass_precision = 0
   avg_peak_count = 0.0
   avg_peptide_len = 0.0
+  entry_list = []
+  spectrum_mz_list = []
+  spectrum_intensity_list = []
+  peptide_mass_list = []
 
   for location_info in spectra_locations:
     # location_info: [file_idx, spectra_idx]
@@ -941,144 +900,25 @@ def read_spectra_from_multiple_pickles(all_spectra_in_memory, all_sequence_in_me
     # Average peptide length
     avg_peptide_len += peptide_len
 
-    # PRE-PROCESS SPECTRUM
-    (spectrum_holder,
-     spectrum_original_forward,
-     spectrum_original_backward) = process_spectrum(spectrum_mz,
-                                                    spectrum_intensity,
-                                                    peptide_mass)
-
-    ################################################################
-    # (spectrum_holder_debug,
-    #  spectrum_original_forward_debug,
-    #  spectrum_original_backward_debug) = deepnovo_debug.process_spectrum(spectrum_mz,
-    #                                                                spectrum_intensity,
-    #                                                                peptide_mass)
-
-    # assert np.array_equal(spectrum_holder_debug, spectrum_holder) & \
-    #        np.array_equal(spectrum_original_forward_debug, spectrum_original_forward) & \
-    #        np.array_equal(spectrum_original_backward_debug, spectrum_original_backward), \
-    #   "[ERR] deepnovo_debug.process_spectrum is different from the original."
-    ################################################################
-
-    # PRE-PROCESS decoder_input
-    for bucket_id, target_size in enumerate(deepnovo_config._buckets):
-      if peptide_len + 2 <= target_size: # +2 to include GO and EOS
-        break
-    decoder_size = deepnovo_config._buckets[bucket_id]
-    # parse peptide AA sequence to list of ids
-    peptide_ids = [deepnovo_config.vocab[x] for x in peptide]
-    # PADDING
-    pad_size = decoder_size - (len(peptide_ids) + 2)
-    # forward
-    if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_forward = peptide_ids[:]
-      peptide_ids_forward.insert(0, deepnovo_config.GO_ID)
-      peptide_ids_forward.append(deepnovo_config.EOS_ID)
-      peptide_ids_forward += [deepnovo_config.PAD_ID] * pad_size
-    # backward
-    if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-      peptide_ids_backward = peptide_ids[::-1]
-      peptide_ids_backward.insert(0, deepnovo_config.EOS_ID)
-      peptide_ids_backward.append(deepnovo_config.GO_ID)
-      peptide_ids_backward += [deepnovo_config.PAD_ID] * pad_size
-
-    #~ # for testing
-    #~ start_time = time.time()
-
-    # PRE-PROCESS candidate_intensity
-    if not deepnovo_config.FLAGS.beam_search:
-
-      # forward
-      if deepnovo_config.FLAGS.direction == 0 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_forward = []
-        prefix_mass = 0.0
-        for index in range(decoder_size):
-
-          prefix_mass += deepnovo_config.mass_ID[peptide_ids_forward[index]]
-          candidate_intensity = get_candidate_intensity(
-            spectrum_original_forward,
-            peptide_mass,
-            prefix_mass,
-            0)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #   spectrum_original_forward,
-          #   peptide_mass,
-          #   prefix_mass,
-          #   0)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_forward.append(candidate_intensity)
-
-      # backward
-      if deepnovo_config.FLAGS.direction == 1 or deepnovo_config.FLAGS.direction == 2:
-
-        candidate_intensity_list_backward = []
-        suffix_mass = 0.0
-        for index in range(decoder_size):
-
-          suffix_mass += deepnovo_config.mass_ID[peptide_ids_backward[index]]
-          candidate_intensity = get_candidate_intensity(
-              spectrum_original_backward,
-              peptide_mass,
-              suffix_mass,
-              1)
-          ################################################################
-          # candidate_intensity_debug = deepnovo_debug.get_candidate_intensity(
-          #     spectrum_original_backward,
-          #     peptide_mass,
-          #     suffix_mass,
-          #     1)
-
-          # assert np.array_equal(candidate_intensity_debug, candidate_intensity), \
-          #   "[ERR] deepnovo_debug.get_candidate_intensity() is different from the original."
-          ################################################################
-          candidate_intensity_list_backward.append(candidate_intensity)
-
-    #~ # for testing
-    #~ test_time += time.time() - start_time
-
-    # assign data to buckets
-    if deepnovo_config.FLAGS.beam_search:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    peptide_mass,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([scan,
-                                    spectrum_holder,
-                                    spectrum_original_forward,
-                                    spectrum_original_backward,
-                                    peptide_mass,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
-    else:
-      if deepnovo_config.FLAGS.direction == 0:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    peptide_ids_forward])
-      elif deepnovo_config.FLAGS.direction == 1:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_backward])
-      else:
-        data_set[bucket_id].append([spectrum_holder,
-                                    candidate_intensity_list_forward,
-                                    candidate_intensity_list_backward,
-                                    peptide_ids_forward,
-                                    peptide_ids_backward])
+    # the spectrum is pre-processed below with the whole stack
+    entry_list.append((scan, peptide))
+    spectrum_mz_list.append(spectrum_mz)
+    spectrum_intensity_list.append(spectrum_intensity)
+    peptide_mass_list.append(peptide_mass)
+
+  # PRE-PROCESS SPECTRUM
+  # all spectra of the stack are pre-processed by one kernel call; beam search
+  # keeps a whole stack of spectra, hence they are kept sparse as
+  # (location, intensity) and densified batch by batch
+  spectra_iterator = iter_process_spectrum_stack(
+      spectrum_mz_list,
+      spectrum_intensity_list,
+      peptide_mass_list,
+      sparse=deepnovo_config.FLAGS.beam_search)
+  for (scan, peptide), peptide_mass, spectra in zip(entry_list,
+                                                    peptide_mass_list,
+                                                    spectra_iterator):
+    append_data_set(data_set, scan, spectra, peptide_mass, peptide)
 
   print("  total peptide read %d" % counter)
   print("  total peptide skipped %d" % counter_skipped)
@@ -1122,12 +962,11 @@ def read_random_stack_for_multiple_files(data_format, file_index, spectra_locati
   random_idx = random.sample(range(file_index[1][-1]), min(stack_size, file_index[1][-1]))
   # random_locations = random.sample(spectra_locations,
   #                                  min(stack_size, len(spectra_locations)))
-  random_locations = []
-  f_idx = np.array(file_index[1])
-  for i in random_idx:
-    idx = np.where((f_idx > i))[0][0]
-    filename = file_index[0][idx]
-    random_locations.append([idx, spectra_locations[i]])
+  # file_index[1] holds cumulative spectrum counts, so one binary search
+  # gives the file of every sampled spectrum
+  f_idx = np.searchsorted(np.array(file_index[1]), random_idx, side='right')
+  random_locations = [[idx, spectra_locations[i]]
+                      for idx, i in zip(f_idx.tolist(), random_idx)]
   return read_spectra_from_multiple_files(data_format, file_index[0], random_locations)
 
 
@@ -1886,55 +1725,29 @@ def knapsack_example():
 
 
 def knapsack_build():
-  """TODO(nh2tran): docstring."""
-
-  peptide_mass = deepnovo_config.MZ_MAX
-  peptide_mass = peptide_mass - (deepnovo_config.mass_C_terminus + deepnovo_config.mass_H)
-  print("peptide_mass = ", peptide_mass)
-
-  peptide_mass_round = int(round(peptide_mass
-                                 * deepnovo_config.KNAPSACK_AA_RESOLUTION))
-  print("peptide_mass_round = ", peptide_mass_round)
-
-  #~ peptide_mass_upperbound = (peptide_mass_round
-                             #~ + deepnovo_config.KNAPSACK_MASS_PRECISION_TOLERANCE)
-  peptide_mass_upperbound = (peptide_mass_round
-                             + deepnovo_config.KNAPSACK_AA_RESOLUTION)
-
-  knapsack_matrix = np.zeros(shape=(deepnovo_config.vocab_size,
-                                    peptide_mass_upperbound),
-                             dtype=bool)
-
-  for aa_id in range(3, deepnovo_config.vocab_size): # excluding PAD, GO, EOS
-
-    mass_aa_round = int(round(deepnovo_config.mass_ID[aa_id]
-                              * deepnovo_config.KNAPSACK_AA_RESOLUTION))
-    print(deepnovo_config.vocab_reverse[aa_id], mass_aa_round)
-
-    for col in range(peptide_mass_upperbound):
-
-      # col 0 ~ mass 1
-      # col + 1 = mass
-      # col = mass - 1
-      current_mass = col + 1
-
-      if current_mass < mass_aa_round:
-        knapsack_matrix[aa_id, col] = False
-
-      if current_mass == mass_aa_round:
-        knapsack_matrix[aa_id, col] = True
-
-      if current_mass > mass_aa_round:
-        sub_mass = current_mass - mass_aa_round
-        sub_col = sub_mass - 1
-        if np.sum(knapsack_matrix[:, sub_col]) > 0:
-          knapsack_matrix[aa_id, col] = True
-          knapsack_matrix[:, col] = np.logical_or(knapsack_matrix[:, col],
-                                                  knapsack_matrix[:, sub_col])
-        else:
-          knapsack_matrix[aa_id, col] = False
-
-  np.save("knapsack.npy", knapsack_matrix)
+  """Build the knapsack store of --knapsack_file, see deepnovo_knapsack.
+
+     If --knapsack_file is an existing knapsack matrix, check that the new
+     store has the same columns.
+  """
+
+  start_time = time.time()
+  column_count = deepnovo_knapsack.knapsack_column_count()
+  print("knapsack columns = ", column_count)
+  column_mask = deepnovo_knapsack.build_column_mask(column_count)
+  knapsack_index = deepnovo_knapsack.KnapsackIndex(column_mask,
+                                                   deepnovo_config.vocab_size)
+  store_dir = deepnovo_knapsack.store_name(deepnovo_config.knapsack_file)
+  deepnovo_knapsack.save_store(store_dir, knapsack_index)
+  print("knapsack store {0:s}, {1:.2f} s".format(store_dir,
+                                                 time.time() - start_time))
+
+  if os.path.isfile(deepnovo_config.knapsack_file):
+    diff_count = deepnovo_knapsack.check_knapsack(deepnovo_config.knapsack_file,
+                                                  column_mask)
+    if diff_count:
+      print("WARNING: the knapsack store differs from {0:s}".format(
+          deepnovo_config.knapsack_file))
 
 
 def knapsack_search(knapsack_matrix, peptide_mass, mass_precision_tolerance):
@@ -2428,113 +2241,205 @@ def decode_beam_select_2(output_top_paths):
   return outputs
 
 
+def encode_spectra(sess, model, data_set, directions=(0, 1)):
+  """Run the spectrum encoder on data_set for the given directions.
+
+     lstm_state0 only depends on the spectrum holder data_set[x][1], so it
+     can be computed once and shared by all the candidate masses of
+     decode_beam_search_2(). The spectrum CNN runs once per block for all
+     directions. Returns a list of (c_state0, h_state0), one per direction.
+  """
+
+  output_feed = [model.output_forward["lstm_state0"] if direction == 0
+                 else model.output_backward["lstm_state0"]
+                 for direction in directions]
+  decode_block_size = deepnovo_config.batch_size
+
+  state0_list = [([], []) for _ in directions]
+  for start in range(0, len(data_set), decode_block_size):
+    block_spectrum = densify_spectrum_batch(
+        [x[1] for x in data_set[start:start+decode_block_size]])
+    input_feed = {}
+    input_feed[model.input_dict["spectrum"].name] = block_spectrum
+    block_state0 = sess.run(fetches=output_feed, feed_dict=input_feed)
+    for (c_state0, h_state0), (stack_c_state0, stack_h_state0) in zip(
+        state0_list, block_state0):
+      c_state0.append(stack_c_state0)
+      h_state0.append(stack_h_state0)
+
+  return [(np.vstack(c_state0), np.vstack(h_state0))
+          for c_state0, h_state0 in state0_list]
+
+
+def precursor_mass_tolerance(peptide_mass):
+  """Precursor mass window (Da) of each peptide_mass: precursor_mass_ppm of
+     it if --precursor_ppm is set, else PRECURSOR_MASS_PRECISION_TOLERANCE.
+  """
+
+  peptide_mass = np.asarray(peptide_mass, dtype=np.float64)
+  if deepnovo_config.FLAGS.precursor_ppm > 0:
+    return deepnovo_config.precursor_mass_ppm * peptide_mass
+  return np.full(peptide_mass.shape,
+                 deepnovo_config.PRECURSOR_MASS_PRECISION_TOLERANCE)
+
+
+def knapsack_mass_tolerance(peptide_mass):
+  """Knapsack window of the suffix masses of each peptide_mass, in
+     1/KNAPSACK_AA_RESOLUTION Da: its ppm precursor mass window rounded up
+     if --precursor_ppm is set, else KNAPSACK_MASS_PRECISION_TOLERANCE.
+  """
+
+  peptide_mass = np.asarray(peptide_mass, dtype=np.float64)
+  if deepnovo_config.FLAGS.precursor_ppm > 0:
+    return np.ceil(precursor_mass_tolerance(peptide_mass)
+                   * deepnovo_config.KNAPSACK_AA_RESOLUTION).astype(np.int64)
+  return np.full(peptide_mass.shape,
+                 deepnovo_config.KNAPSACK_MASS_PRECISION_TOLERANCE,
+                 dtype=np.int64)
+
+
 def decode_beam_search_01(sess,
                           model,
                           knapsack_matrix,
                           direction,
                           prefix_mass_list,
-                          precursor_mass_precision,
                           knapsack_precision,
-                          data_set):
-  """TODO(nh2tran): docstring."""
+                          data_set,
+                          lstm_state0=None):
+  """Beam search the paths of data_set in one direction from prefix_mass_list.
+
+     lstm_state0 is the (c_state0, h_state0) of data_set from
+     encode_spectra(), it is computed here if None.
+  """
 
   print("decode_beam_search_01(), direction={0}".format(direction))
 
+  # spectrum_holder >> lstm_state0; process in stacks
+  if lstm_state0 is None:
+    lstm_state0 = encode_spectra(sess, model, data_set, [direction])[0]
+
+  return decode_beam_search_searches(sess,
+                                     model,
+                                     knapsack_matrix,
+                                     [[direction,
+                                       prefix_mass_list,
+                                       knapsack_precision,
+                                       data_set,
+                                       lstm_state0]])[0]
+
+
+def decode_beam_search_searches(sess, model, knapsack_matrix, search_list):
+  """Run several beam searches of decode_beam_search_01() together.
+
+     search_list holds the [direction, prefix_mass_list, knapsack_precision,
+     data_set, lstm_state0] of each search, knapsack_precision is a scalar
+     or a list over data_set. The spectra of all the searches
+     of a direction are decoded batch_size at a time. If both directions are
+     present, their paths are stacked into one batch, forward paths first,
+     and each step is a single sess.run() fetching the outputs of both
+     directions, model.input_dict["forward_size"] telling the model where
+     the backward paths start. A search gives the same paths as on its own.
+     knapsack_matrix is best a deepnovo_knapsack.KnapsackIndex, a matrix is
+     indexed at each call. Return the output_top_paths of each search.
+     A path ends when its prefix mass is within precursor_mass_tolerance()
+     of the peptide mass. The paths pruned by that check, by the knapsack
+     and by the beam size are counted and reported per step.
+  """
+
   # for testing
   test_time_decode = 0.0
   test_time_tf = 0.0
   test_time = 0.0
+  test_step_count = 0
+  test_pruned_precursor = 0
+  test_pruned_knapsack = 0
+  test_pruned_beam = 0
 
   # for testing
   start_time_decode = time.time()
 
   # FORWARD/BACKWARD setting
-  if direction == 0:
+  model_output = [model.output_forward, model.output_backward]
+  FIRST_LABEL = np.array([deepnovo_config.GO_ID, deepnovo_config.EOS_ID])
+  LAST_LABEL = np.array([deepnovo_config.EOS_ID, deepnovo_config.GO_ID])
 
-    model_lstm_state0 = model.output_forward["lstm_state0"]
-    model_output_log_prob = model.output_forward["logprob"]
-    model_lstm_state = model.output_forward["lstm_state"]
-
-    FIRST_LABEL = deepnovo_config.GO_ID
-    LAST_LABEL = deepnovo_config.EOS_ID
-
-  elif direction == 1:
-
-    model_lstm_state0 = model.output_backward["lstm_state0"]
-    model_output_log_prob = model.output_backward["logprob"]
-    model_lstm_state = model.output_backward["lstm_state"]
-
-    FIRST_LABEL = deepnovo_config.EOS_ID
-    LAST_LABEL = deepnovo_config.GO_ID
-
-  data_set_len = len(data_set)
   # recall that a data_set[spectrum_id] includes the following
   #     scan                # 0
-  #     spectrum_holder     # 1
-  #     spectrum_original   # 2
+  #     spectrum_holder     # 1, sparse (location, intensity)
+  #     spectrum_original   # 2, sparse (location, intensity)
   #     peptide_mass        # 3
 
   # our TARGET
-  output_top_paths = [[] for x in range(data_set_len)]
-
-  # how many spectra to process at 1 block-run
-  decode_block_size = deepnovo_config.batch_size
-
-  # for testing
-  start_time_tf = time.time()
-
-  # spectrum_holder >> lstm_state0; process in stacks
-  data_set_index_list = range(data_set_len)
-  data_set_index_stack_list = [data_set_index_list[i:i+decode_block_size]
-                               for i in range(0,
-                                              data_set_len,
-                                              decode_block_size)]
-
-  block_c_state0 = []
-  block_h_state0 = []
-
-  for stack in data_set_index_stack_list:
-
-    block_spectrum = np.array([data_set[x][1] for x in stack])
-    input_feed = {}
-    input_feed[model.input_dict["spectrum"].name] = block_spectrum
-    output_feed = model_lstm_state0
-    stack_c_state0, stack_h_state0 = sess.run(fetches=output_feed,
-                                              feed_dict=input_feed)
-    block_c_state0.append(stack_c_state0)
-    block_h_state0.append(stack_h_state0)
-
-  block_c_state0 = np.vstack(block_c_state0)
-  block_h_state0 = np.vstack(block_h_state0)
-
-  # for testing
-  test_time_tf += time.time() - start_time_tf
+  output_top_paths = [[[] for x in search[3]] for search in search_list]
 
+  knapsack_index = deepnovo_knapsack.as_knapsack_index(knapsack_matrix)
 
-
-
-
-
-  # hold the spectra & their paths under processing
-  active_search = []
-
-  #### JOON ###########
-  # BUG: error happens when len(prefix_mass_list) < decode_block_size
-  init_size = min(decode_block_size, data_set_len)
-  #### JOON ###########
-
-  # fill in the first entries of active_search
-  for spectrum_id in range(init_size):
-    active_search.append([])
-    active_search[-1].append(spectrum_id)
-    active_search[-1].append([[[FIRST_LABEL], # current_paths
-                               prefix_mass_list[spectrum_id],
-                               0.0,
-                               block_c_state0[spectrum_id],
-                               block_h_state0[spectrum_id]]])
-
-  # how many spectra that have been put into active_search
-  spectrum_count = init_size
+  # how many spectra to process at 1 block-run, for each direction
+  decode_block_size = deepnovo_config.batch_size
+  beam_size = deepnovo_config.FLAGS.beam_size
+  mass_ID_array = np.array(deepnovo_config.mass_ID, dtype=np.float64)
+
+  # the spectra of all searches are the entries of the beam search, an
+  #   entry id indexes the following arrays
+  entry_search = np.concatenate([np.full(len(search[3]), search_index)
+                                 for search_index, search
+                                 in enumerate(search_list)]).astype(np.int64)
+  entry_spectrum_id = np.concatenate([np.arange(len(search[3]))
+                                      for search in search_list]).astype(np.int64)
+  entry_direction = np.concatenate([np.full(len(search[3]), search[0])
+                                    for search in search_list]).astype(np.int64)
+  entry_prefix_mass = np.concatenate([np.array(search[1], dtype=np.float64)
+                                      for search in search_list])
+  entry_knapsack_precision = np.concatenate([np.broadcast_to(search[2],
+                                                             len(search[3]))
+                                             for search in search_list])
+  entry_peptide_mass = np.array([x[3] for search in search_list
+                                 for x in search[3]], dtype=np.float64)
+  entry_precursor_tolerance = precursor_mass_tolerance(entry_peptide_mass)
+  entry_c_state0 = np.concatenate([search[4][0] for search in search_list])
+  entry_h_state0 = np.concatenate([search[4][1] for search in search_list])
+
+  # spectrum_original of all entries packed for get_candidate_intensity_batch
+  (spectrum_location,
+   spectrum_intensity,
+   spectrum_offset) = pack_sparse_spectra([x[2] for search in search_list
+                                           for x in search[3]])
+
+  # hold the paths under processing, see deepnovo_beam.Beam; one beam for
+  #   each direction, an entry is active while it has paths, at most
+  #   decode_block_size entries of at most beam_size paths each
+  path_tree = deepnovo_beam.PathTree()
+  direction_list = sorted(set(entry_direction.tolist()))
+  direction_entry = [np.flatnonzero(entry_direction == direction)
+                     for direction in direction_list]
+  beam_list, next_beam_list = [
+      [deepnovo_beam.Beam(max_paths=decode_block_size * max(beam_size, 1),
+                          num_units=entry_c_state0.shape[1],
+                          state_dtype=entry_c_state0.dtype)
+       for _ in direction_list]
+      for _ in range(2)]
+
+  def append_new_entries(beam, new_entry):
+    """Start the paths [FIRST_LABEL] of the entries new_entry."""
+
+    new_first_label = FIRST_LABEL[entry_direction[new_entry]]
+    new_node = path_tree.add(np.full(len(new_entry), -1), new_first_label)
+    beam.append(spectrum_id=new_entry,
+                node=new_node,
+                AA_id_1=new_first_label,
+                AA_id_2=new_first_label,
+                prefix_mass=entry_prefix_mass[new_entry],
+                score=0.0,
+                c_state=entry_c_state0[new_entry],
+                h_state=entry_h_state0[new_entry])
+
+  # fill in the first entries
+  # how many entries of each direction that have been put into the beam
+  entry_count = []
+  for beam, entry in zip(beam_list, direction_entry):
+    init_size = min(decode_block_size, len(entry))
+    append_new_entries(beam, entry[:init_size])
+    entry_count.append(init_size)
 
 
 
@@ -2542,188 +2447,166 @@ def decode_beam_search_01(sess,
   # MAIN LOOP; break when the block-run is empty
   while True:
 
-    # block-data for model-step-run
-    block_AA_ID_1 = [] # nobi
-    block_AA_ID_2 = [] # nobi
-    block_c_state = []
-    block_h_state = []
-    block_candidate_intensity = []
-
-    # data to construct new_paths
-    block_path_0 = []
-    block_prefix_mass = []
-    block_score = []
-    block_mass_filter_candidate = []
-
-    # store the number of paths of each entry (spectrum) in the big blocks
-    entry_block_size = []
-
-    # gather data into blocks
-    for entry in active_search:
-
-      spectrum_id = entry[0]
-      current_paths = entry[1]
-      peptide_mass = data_set[spectrum_id][3]
-      spectrum_original = data_set[spectrum_id][2]
-
-      path_count = 0
-
-      for path in current_paths:
-
-        AA_ID_2 = path[0][-1] # nobi
-        if len(path[0]) > 1:
-          AA_ID_1 = path[0][-2]
-        else:
-          AA_ID_1 = AA_ID_2 # nobi
-
-        prefix_mass = path[1]
-        score = path[2]
-        c_state = path[3]
-        h_state = path[4]
-
-        # reach LAST_LABEL >> check mass
-        if AA_ID_2 == LAST_LABEL: # nobi
-          if (abs(prefix_mass - peptide_mass)
-              <= deepnovo_config.PRECURSOR_MASS_PRECISION_TOLERANCE):
-            output_top_paths[spectrum_id].append([path[0], path[2], direction])
-          continue
-
-        # for testing
-        start_time = time.time()
-
-        # CANDIDATE INTENSITY
-        candidate_intensity = get_candidate_intensity(spectrum_original,
-                                                      peptide_mass,
-                                                      prefix_mass,
-                                                      direction)
-
-        # for testing
-        test_time += time.time() - start_time
-
-        # SUFFIX MASS filter
-        suffix_mass = (peptide_mass - prefix_mass
-                       - deepnovo_config.mass_ID[LAST_LABEL])
-        mass_filter_candidate = knapsack_search(knapsack_matrix,
-                                                suffix_mass,
-                                                knapsack_precision)
-
-        if not mass_filter_candidate: # not enough mass left to extend
-          mass_filter_candidate.append(LAST_LABEL) # try to end the sequence
-
-        # gather BLOCK-data
-        block_AA_ID_1.append(AA_ID_1) # nobi
-        block_AA_ID_2.append(AA_ID_2) # nobi
-        block_c_state.append(c_state)
-        block_h_state.append(h_state)
-        block_candidate_intensity.append(candidate_intensity)
+    # the paths of all directions, forward first
+    path_entry = np.concatenate([beam.spectrum_id[:beam.size]
+                                 for beam in beam_list])
+    path_node = np.concatenate([beam.node[:beam.size] for beam in beam_list])
+    path_AA_id_1 = np.concatenate([beam.AA_id_1[:beam.size]
+                                   for beam in beam_list])
+    path_AA_id_2 = np.concatenate([beam.AA_id_2[:beam.size]
+                                   for beam in beam_list])
+    path_prefix_mass = np.concatenate([beam.prefix_mass[:beam.size]
+                                       for beam in beam_list])
+    path_score = np.concatenate([beam.score[:beam.size] for beam in beam_list])
+    path_direction = entry_direction[path_entry]
+    path_peptide_mass = entry_peptide_mass[path_entry]
+    path_last_label = LAST_LABEL[path_direction]
+
+    # reach LAST_LABEL >> check mass
+    path_end = path_AA_id_2 == path_last_label
+    path_found = path_end & (np.abs(path_prefix_mass - path_peptide_mass)
+                             <= entry_precursor_tolerance[path_entry])
+    # for testing
+    test_pruned_precursor += np.count_nonzero(path_end & ~path_found)
+    for index in np.flatnonzero(path_found).tolist():
+      entry = path_entry[index]
+      output_top_paths[entry_search[entry]][entry_spectrum_id[entry]].append(
+          [path_tree.path(path_node[index]),
+           float(path_score[index]),
+           int(path_direction[index])])
+
+    # the other paths are extended by a model-step-run
+    block_index = np.flatnonzero(~path_end)
+    block_len = len(block_index)
+    block_entry = path_entry[block_index]
+    block_direction = path_direction[block_index]
+    block_peptide_mass = path_peptide_mass[block_index]
+    block_prefix_mass = path_prefix_mass[block_index]
+    block_last_label = path_last_label[block_index]
+
+    # SUFFIX MASS filter, the knapsack_search() of all paths in one lookup
+    block_suffix_mass = (block_peptide_mass - block_prefix_mass
+                         - mass_ID_array[block_last_label])
+    block_search_mask = knapsack_index.search_mask(
+        block_suffix_mass,
+        entry_knapsack_precision[block_entry])
+    # not enough mass left to extend >> try to end the sequence
+    block_search_mask = np.where(block_search_mask > 0,
+                                 block_search_mask,
+                                 np.left_shift(np.uint32(1),
+                                               block_last_label.astype(np.uint32)))
 
-        block_path_0.append(path[0])
-        block_prefix_mass.append(prefix_mass)
-        block_score.append(score)
-        block_mass_filter_candidate.append(mass_filter_candidate)
+    # RUN tf blocks if not empty
+    if block_len > 0:
 
-        # record the block size for each entry
-        path_count += 1
+      # for testing
+      start_time = time.time()
 
-      entry_block_size.append(path_count)
+      # CANDIDATE INTENSITY of all paths in one call
+      block_candidate_intensity = get_candidate_intensity_batch(
+          spectrum_location,
+          spectrum_intensity,
+          spectrum_offset,
+          block_entry,
+          block_peptide_mass,
+          block_prefix_mass,
+          block_direction)
 
-    # RUN tf blocks if not empty
-    if block_AA_ID_1:
+      # for testing
+      test_time += time.time() - start_time
 
       # for testing
       start_time_tf = time.time()
 
       # FEED and RUN TensorFlow-model
-      block_AA_ID_1 = np.array(block_AA_ID_1) # nobi
-      block_AA_ID_2 = np.array(block_AA_ID_2) # nobi
-      block_c_state = np.array(block_c_state)
-      block_h_state = np.array(block_h_state)
-      block_candidate_intensity = np.array(block_candidate_intensity)
-
       input_feed = {}
-      input_feed[model.input_dict["AAid"][0].name] = block_AA_ID_1 # nobi
-      input_feed[model.input_dict["AAid"][1].name] = block_AA_ID_2 # nobi
+      input_feed[model.input_dict["AAid"][0].name] = path_AA_id_1[block_index] # nobi
+      input_feed[model.input_dict["AAid"][1].name] = path_AA_id_2[block_index] # nobi
       input_feed[model.input_dict["intensity"].name] = block_candidate_intensity
-      input_feed[model.input_dict["lstm_state"][0].name] = block_c_state
-      input_feed[model.input_dict["lstm_state"][1].name] = block_h_state
-
-      output_feed = [model_output_log_prob, model_lstm_state] # lstm.len_full
-      #~ output_feed = model_output_log_prob # nobi
-
-      current_log_prob, (current_c_state, current_h_state) = sess.run(
-          output_feed,
-          input_feed) # lstm.len_full
-      #~ current_log_prob = sess.run(output_feed,input_feed) # nobi
+      input_feed[model.input_dict["lstm_state"][0].name] = np.concatenate(
+          [beam.c_state[:beam.size] for beam in beam_list])[block_index]
+      input_feed[model.input_dict["lstm_state"][1].name] = np.concatenate(
+          [beam.h_state[:beam.size] for beam in beam_list])[block_index]
+      if len(direction_list) > 1:
+        input_feed[model.input_dict["forward_size"].name] = np.count_nonzero(
+            block_direction == 0)
+
+      output_feed = [[model_output[direction]["logprob"],
+                      model_output[direction]["lstm_state"]] # lstm.len_full
+                     for direction in direction_list]
+
+      output = sess.run(output_feed, input_feed) # lstm.len_full
+      current_log_prob = np.concatenate([x[0] for x in output])
+      current_c_state = np.concatenate([x[1][0] for x in output])
+      current_h_state = np.concatenate([x[1][1] for x in output])
 
       # for testing
       test_time_tf += time.time() - start_time_tf
 
-    # find new_paths for each entry
-    block_index = 0
-    for entry_index, entry in enumerate(active_search):
-
-      new_paths = []
-
-      for index in range(block_index,
-                          block_index + entry_block_size[entry_index]):
-
-        for aa_id in block_mass_filter_candidate[index]:
+      # new paths: each block path extended by each of its candidates, the
+      #   top BEAM_SIZE of each entry are picked for all entries at once
+      candidate_mask = knapsack_index.candidate_mask(block_search_mask)
+      candidate_score = np.array(current_log_prob, dtype=np.float64)
+      candidate_score[:, :3] = 0.0 # do NOT add score of GO, EOS, PAD
+
+      (selected_block_index,
+       selected_AA_id,
+       selected_score) = deepnovo_beam.select_top_paths(
+           path_score[block_index],
+           candidate_score,
+           candidate_mask,
+           block_entry,
+           beam_size)
 
-          new_paths.append([])
-          new_paths[-1].append(block_path_0[index] + [aa_id])
-          new_paths[-1].append(block_prefix_mass[index]
-                               + deepnovo_config.mass_ID[aa_id])
-
-          if aa_id > 2: # do NOT add score of GO, EOS, PAD
-            new_paths[-1].append(block_score[index]
-                                 + current_log_prob[index][aa_id])
-          else:
-            new_paths[-1].append(block_score[index])
-
-          new_paths[-1].append(current_c_state[index]) # lstm.len_full
-          new_paths[-1].append(current_h_state[index]) # lstm.len_full
-          #~ new_paths[-1].append(block_c_state[index]) # nobi
-          #~ new_paths[-1].append(block_h_state[index]) # nobi
-
-      # pick the top BEAM_SIZE
-      if len(new_paths) > deepnovo_config.FLAGS.beam_size:
-        new_path_scores = np.array([x[2] for x in new_paths])
-        #~ new_path_lengths = np.array([len(x[0])-1 for x in new_paths])
-        top_k_indices = np.argpartition(-new_path_scores, deepnovo_config.FLAGS.beam_size)[:deepnovo_config.FLAGS.beam_size] # pylint: disable=line-too-long
-        #~ top_k_indices = np.argpartition(-new_path_scores/new_path_lengths,deepnovo_config.FLAGS.beam_size)[:deepnovo_config.FLAGS.beam_size] # pylint: disable=line-too-long
-        entry[1] = [new_paths[top_k_indices[x]]
-                    for x in range(deepnovo_config.FLAGS.beam_size)]
-      else:
-        entry[1] = new_paths[:]
-
-      # update the accumulated block_index
-      block_index += entry_block_size[entry_index]
-
-    # update active_search
-    #   by removing empty entries
-    active_search = [entry for entry in active_search if entry[1]]
-    #   and adding new entries
-    active_search_len = len(active_search)
-    if active_search_len < decode_block_size and spectrum_count < data_set_len:
-
-      new_spectrum_count = min(spectrum_count
-                               + decode_block_size
-                               - active_search_len,
-                               data_set_len)
-
-      for spectrum_id in range(spectrum_count, new_spectrum_count):
-        active_search.append([])
-        active_search[-1].append(spectrum_id)
-        active_search[-1].append([[[FIRST_LABEL], # current_paths
-                                   prefix_mass_list[spectrum_id],
-                                   0.0,
-                                   block_c_state0[spectrum_id],
-                                   block_h_state0[spectrum_id]]])
-
-      spectrum_count = new_spectrum_count
+      # for testing
+      #   extensions by an AA rejected by the suffix mass filter, and new
+      #   paths that did not make the beam
+      test_step_count += 1
+      test_pruned_knapsack += (block_len * (knapsack_index.vocab_size - 3)
+                               - np.count_nonzero(candidate_mask[:, 3:]))
+      test_pruned_beam += (np.count_nonzero(candidate_mask)
+                           - len(selected_block_index))
+      selected_node = path_tree.add(path_node[block_index][selected_block_index],
+                                    selected_AA_id)
+      selected_direction = block_direction[selected_block_index]
+      for direction, next_beam in zip(direction_list, next_beam_list):
+        next_beam.clear()
+        selected = np.flatnonzero(selected_direction == direction)
+        index = selected_block_index[selected]
+        next_beam.append(spectrum_id=block_entry[index],
+                         node=selected_node[selected],
+                         AA_id_1=path_AA_id_2[block_index][index],
+                         AA_id_2=selected_AA_id[selected],
+                         prefix_mass=(block_prefix_mass[index]
+                                      + mass_ID_array[selected_AA_id[selected]]),
+                         score=selected_score[selected],
+                         c_state=current_c_state[index], # lstm.len_full
+                         h_state=current_h_state[index]) # lstm.len_full
+    else:
+      for next_beam in next_beam_list:
+        next_beam.clear()
+    beam_list, next_beam_list = next_beam_list, beam_list
+
+    # update the entries of each direction
+    for direction_index, beam in enumerate(beam_list):
+      #   entries without new paths are removed
+      active_search_len = len(deepnovo_beam.segment_starts(
+          beam.spectrum_id[:beam.size]))
+      #   and new entries are added
+      entry = direction_entry[direction_index]
+      if (active_search_len < decode_block_size
+          and entry_count[direction_index] < len(entry)):
+
+        new_entry_count = min(entry_count[direction_index]
+                              + decode_block_size
+                              - active_search_len,
+                              len(entry))
+        append_new_entries(beam,
+                           entry[entry_count[direction_index]:new_entry_count])
+        entry_count[direction_index] = new_entry_count
 
     # STOP decoding if no path
-    if not active_search:
+    if all(beam.size == 0 for beam in beam_list):
       break
 
 
@@ -2738,6 +2621,12 @@ def decode_beam_search_01(sess,
   print("  test_time_tf = %.2f" % (test_time_tf))
   print("  test_time_decode = %.2f" % (test_time_decode))
   print("  test_time = %.2f" % (test_time))
+  step_count = max(test_step_count, 1)
+  print("  pruned paths per step (%d steps): precursor %.1f, knapsack %.1f,"
+        " beam %.1f" % (test_step_count,
+                        test_pruned_precursor / step_count,
+                        test_pruned_knapsack / step_count,
+                        test_pruned_beam / step_count))
 
   return output_top_paths
 
@@ -2753,6 +2642,9 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
   data_set_backward = [[x[0], x[1], x[3], x[4]] for x in data_set]
   data_set_len = len(data_set_forward)
   peptide_mass_list = [x[4] for x in data_set]
+  # precursor and knapsack windows of GO/EOS, see --precursor_ppm
+  precursor_tolerance_list = precursor_mass_tolerance(peptide_mass_list)
+  knapsack_tolerance_list = knapsack_mass_tolerance(peptide_mass_list)
 
   candidate_mass_list = []
 
@@ -2763,8 +2655,7 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
   suffix_mass_list = [(x-mass_GO) for x in peptide_mass_list]
   candidate_mass_list.append([prefix_mass_list,
                               suffix_mass_list,
-                              0.01, # precursor_mass_precision
-                              100]) # knapsack_precision
+                              knapsack_tolerance_list]) # knapsack_precision
 
   # Pick EOS mass
   # EOS has only one option: suffix_mass
@@ -2773,8 +2664,7 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
   suffix_mass_list = [mass_EOS] * data_set_len
   candidate_mass_list.append([prefix_mass_list,
                               suffix_mass_list,
-                              0.01, # precursor_mass_precision
-                              100]) # knapsack_precision
+                              knapsack_tolerance_list]) # knapsack_precision
 
   # Pick a middle mass
   num_position = deepnovo_config.num_position
@@ -2782,13 +2672,14 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
   argmax_mass_complement_list = []
 
   # by choosing the location of max intensity from (0, peptide_mass_C_location)
+  spectrum_forward = np.zeros(shape=deepnovo_config.MZ_SIZE, dtype=np.float32)
   for spectrum_id in range(data_set_len):
 
     peptide_mass = peptide_mass_list[spectrum_id]
     peptide_mass_C = peptide_mass - mass_EOS
     peptide_mass_C_location = int(round(peptide_mass_C
                                         * deepnovo_config.SPECTRUM_RESOLUTION))
-    spectrum_forward = data_set[spectrum_id][2]
+    densify_spectrum(data_set[spectrum_id][2], out=spectrum_forward)
     argmax_location = np.argpartition(-spectrum_forward[:peptide_mass_C_location], num_position)[:num_position] # pylint: disable=line-too-long
     # !!! LOWER precision 0.1 Da !!!
     argmax_mass = argmax_location / deepnovo_config.SPECTRUM_RESOLUTION
@@ -2808,45 +2699,87 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
     argmax_mass_complement_list.append(argmax_mass_complement)
 
   # Add the mass and its complement to candidate_mass_list
+  #   the knapsack window is wider, the end-of-path check of every search
+  #   uses precursor_mass_tolerance()
   for position in range(num_position):
 
     prefix_mass_list = [x[position] for x in argmax_mass_list]
     suffix_mass_list = [x[position] for x in argmax_mass_complement_list]
     candidate_mass_list.append([prefix_mass_list,
                                 suffix_mass_list,
-                                0.1, # precursor_mass_precision
                                 1000]) # knapsack_precision
 
     prefix_mass_list = [x[position] for x in argmax_mass_complement_list]
     suffix_mass_list = [x[position] for x in argmax_mass_list]
     candidate_mass_list.append([prefix_mass_list,
                                 suffix_mass_list,
-                                0.1, # precursor_mass_precision
                                 1000]) # knapsack_precision
 
+  # the spectrum encoder is shared by all candidate masses and both
+  #   directions, run it once
+  # for testing
+  start_time_encoder = time.time()
+  lstm_state0_forward, lstm_state0_backward = encode_spectra(sess,
+                                                             model,
+                                                             data_set)
+  # for testing
+  test_time_encoder = time.time() - start_time_encoder
+
+  # the forward and backward searches of all candidate masses advance
+  #   together, one sess.run() per step, if the model can split a step
+  #   between the directions
+  if (deepnovo_config.FLAGS.fused_bidirectional
+      and "forward_size" in model.input_dict):
+    search_list = ([[0,
+                     candidate_mass[0], # prefix_mass_list
+                     candidate_mass[2], # knapsack_precision
+                     data_set_forward,
+                     lstm_state0_forward]
+                    for candidate_mass in candidate_mass_list]
+                   + [[1,
+                       candidate_mass[1], # suffix_mass_list
+                       candidate_mass[2], # knapsack_precision
+                       data_set_backward,
+                       lstm_state0_backward]
+                      for candidate_mass in candidate_mass_list])
+    print("decode_beam_search_searches(), {0:d} searches".format(
+        len(search_list)))
+    top_paths_list = decode_beam_search_searches(sess,
+                                                 model,
+                                                 knapsack_matrix,
+                                                 search_list)
+  else:
+    top_paths_list = None
+
   # Start decoding for each candidate_mass
   output_top_paths = [[] for x in range(data_set_len)]
-  for candidate_mass in candidate_mass_list:
-
-    top_paths_forward = decode_beam_search_01(
-        sess,
-        model,
-        knapsack_matrix,
-        0,
-        candidate_mass[0], # prefix_mass_list
-        candidate_mass[2], # precursor_mass_precision
-        candidate_mass[3], # knapsack_precision
-        data_set_forward)
-
-    top_paths_backward = decode_beam_search_01(
-        sess,
-        model,
-        knapsack_matrix,
-        1,
-        candidate_mass[1], # suffix_mass_list
-        candidate_mass[2], # precursor_mass_precision
-        candidate_mass[3], # knapsack_precision
-        data_set_backward)
+  for candidate_index, candidate_mass in enumerate(candidate_mass_list):
+
+    if top_paths_list is not None:
+      top_paths_forward = top_paths_list[candidate_index]
+      top_paths_backward = top_paths_list[len(candidate_mass_list)
+                                          + candidate_index]
+    else:
+
+      top_paths_forward = decode_beam_search_01(
+          sess,
+          model,
+          knapsack_matrix,
+          0,
+          candidate_mass[0], # prefix_mass_list
+          candidate_mass[2], # knapsack_precision
+          data_set_forward,
+          lstm_state0_forward)
+
+      top_paths_backward = decode_beam_search_01(
+          sess,
+          model,
+          knapsack_matrix,
+          1,
+          candidate_mass[1], # suffix_mass_list
+          candidate_mass[2], # knapsack_precision
+          data_set_backward,
+          lstm_state0_backward)
 
     for spectrum_id in range(data_set_len):
 
@@ -2865,6 +2798,18 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
             direction = candidate_mass[0][0]
             output_top_paths[spectrum_id].append([seq, score, direction])
 
+  # for testing
+  #   each of the 2 * len(candidate_mass_list) searches used to run the
+  #   encoder of its direction, which costs at most the shared run; the
+  #   saving is not measured (that would take an extra encoder run), only
+  #   bounded by (search_count - 1) shared runs
+  search_count = 2 * len(candidate_mass_list)
+  print("  test_time_encoder = %.2f (shared by %d searches,"
+        " test_time_encoder_saved_bound = %.2f)" % (
+            test_time_encoder,
+            search_count,
+            (search_count - 1) * test_time_encoder))
+
   #~ return output_top_paths
 
   # Refinement using peptide_mass_list, especially for middle mass
@@ -2875,7 +2820,8 @@ def decode_beam_search_2(sess, model, data_set, knapsack_matrix):
       seq = path[0]
       seq_mass = sum(deepnovo_config.mass_ID[x] for x in seq)
       seq_mass += mass_GO + mass_EOS
-      if abs(seq_mass - peptide_mass_list[spectrum_id]) <= 0.01:
+      if (abs(seq_mass - peptide_mass_list[spectrum_id])
+          <= precursor_tolerance_list[spectrum_id]):
         output_top_paths_refined[spectrum_id].append(path)
 
 
@@ -2955,12 +2901,12 @@ def decode_beam_search(sess,
 def decode(input_file=deepnovo_config.decode_test_file):
   """TODO(nh2tran): docstring."""
 
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config(inference=True)) as sess:
 
     # DECODING MODEL
     print("DECODING MODEL")
     #~ model = deepnovo_model.DecodingModel()
-    model = deepnovo_model.ModelInference()
+    model = deepnovo_model.inference_model()
     model.build_model()
     model.restore_model(sess)
 
@@ -2978,6 +2924,9 @@ def decode(input_file=deepnovo_config.decode_test_file):
       #~ print("ERROR: model parameters not found.")
       #~ sys.exit()
 
+    # load/compile the numba kernels before the first spectra are read
+    warm_up()
+
     # FIND SPECTRA LOCATIONS
     spectra_file_location = inspect_file_location(deepnovo_config.data_format,
                                                   input_file)
@@ -2989,7 +2938,8 @@ def decode(input_file=deepnovo_config.decode_test_file):
 
       print("Load knapsack_matrix from default: knapsack.npy")
       #knapsack_matrix = np.load("/people/leej324/DeepNovo/DeepNovo_data_01152018/knapsack.npy")
-      knapsack_matrix = np.load(deepnovo_config.knapsack_file)
+      knapsack_matrix = deepnovo_knapsack.load_knapsack_index(
+          deepnovo_config.knapsack_file)
 
       # READ & DECODE in stacks
       print("READ & DECODE in stacks")
@@ -3015,7 +2965,7 @@ def decode(input_file=deepnovo_config.decode_test_file):
               file=output_file_handle,
               end="")
 
-        with open(input_file, 'r') as input_file_handle:
+        with open_spectra_file(input_file) as input_file_handle:
 
           counter_peptide = 0
           for stack in spectra_file_location_stack_list:
@@ -3068,7 +3018,7 @@ def decode(input_file=deepnovo_config.decode_test_file):
 
       print("READING SPECTRA")
       start_time = time.time()
-      with open(input_file, 'r') as file_handle:
+      with open_spectra_file(input_file) as file_handle:
         data_set, _ = read_spectra(file_handle,
                                    deepnovo_config.data_format,
                                    spectra_file_location)
@@ -3092,18 +3042,354 @@ def decode(input_file=deepnovo_config.decode_test_file):
         print("  accuracy_len %.4f" % (num_len_match))
         print("  spectrum_time %.4f" % (spectrum_time))
 
+def build_spectrum_stores(input_dir=deepnovo_config.input_mgf_dir):
+  """Convert mgf files into binary spectrum stores next to them."""
+
+  if os.path.isdir(input_dir):
+    mgf_files = sorted(glob.glob(input_dir + "/*.mgf"))
+  else:
+    mgf_files = [input_dir]
+  print('num. of mgf files:{0}'.format(len(mgf_files)))
+
+  for i, input_file in enumerate(mgf_files):
+    print('[{0:3d}/{1:3d}] {2}'.format(i+1, len(mgf_files), input_file))
+    deepnovo_spectrum_store.convert_mgf(input_file)
+
+
+def export_frozen_model():
+  """Restore the model from train_dir and write it as a frozen graph."""
+
+  frozen_file = deepnovo_config.FLAGS.frozen_model
+  if not frozen_file:
+    frozen_file = os.path.join(deepnovo_config.FLAGS.train_dir,
+                               "frozen_model.pb")
+
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
+    model = deepnovo_model.ModelInference()
+    model.build_model()
+    model.restore_model(sess)
+    model.export_frozen_model(sess, frozen_file)
+
+
+def benchmark_stages(input_dir=deepnovo_config.input_mgf_dir, repeat=10):
+  """Time the stages of a decoding step, see deepnovo_model.ModelStages.
+
+     The first batch_size spectra of the first mgf file of input_dir are
+     encoded, then the first step of both directions is run stage by stage
+     and in one run, each repeat times after a warm-up run.
+  """
+
+  if not deepnovo_config.FLAGS.beam_search:
+    print("Error: benchmark_stages() needs --beam_search.")
+    sys.exit()
+  if os.path.isdir(input_dir):
+    input_file = sorted(glob.glob(input_dir + "/*.mgf"))[0]
+  else:
+    input_file = input_dir
+  print("benchmark_stages(), {0}".format(input_file))
+
+  spectra_file_location = inspect_file_location(deepnovo_config.data_format,
+                                                input_file)
+  block_size = deepnovo_config.batch_size
+  stack_data_set, _, _ = next(read_stack_data_sets(
+      input_file,
+      spectra_file_location[:block_size],
+      block_size))
+  data_set = sum(stack_data_set, [])
+  block_len = len(data_set)
+  # data_set[x]: scan, spectrum_holder, spectrum_original_forward,
+  #   spectrum_original_backward, peptide_mass, ...
+  block_peptide_mass = np.array([x[4] for x in data_set], dtype=np.float64)
+
+  def time_stage(stage_function, *args):
+    stage_function(*args)
+    start_time = time.time()
+    for _ in range(repeat):
+      stage_function(*args)
+    return (time.time() - start_time) / repeat
+
+  with tf.compat.v1.Session(config=deepnovo_config.session_config(inference=True)) as sess:
+    model = deepnovo_model.inference_model()
+    model.build_model()
+    model.restore_model(sess)
+
+    stage_time = collections.OrderedDict()
+    stage_time["encode, both directions"] = time_stage(
+        encode_spectra, sess, model, data_set)
+
+    for direction, first_label in [(0, deepnovo_config.GO_ID),
+                                   (1, deepnovo_config.EOS_ID)]:
+      stages = deepnovo_model.ModelStages(sess, model, direction)
+      name = ["forward", "backward"][direction]
+      block_spectrum = densify_spectrum_batch([x[1] for x in data_set])
+      c_state0, h_state0 = stages.encode(block_spectrum)
+
+      # the first step: every path is [first_label]
+      block_AA_id = np.full(block_len, first_label, dtype=np.int32)
+      block_prefix_mass = np.full(block_len,
+                                  deepnovo_config.mass_ID[first_label],
+                                  dtype=np.float64)
+      (spectrum_location,
+       spectrum_intensity,
+       spectrum_offset) = pack_sparse_spectra([x[2 + direction]
+                                               for x in data_set])
+      intensity_args = (spectrum_location,
+                        spectrum_intensity,
+                        spectrum_offset,
+                        np.arange(block_len, dtype=np.int64),
+                        block_peptide_mass,
+                        block_prefix_mass,
+                        np.full(block_len, direction, dtype=np.int64))
+      block_intensity = get_candidate_intensity_batch(*intensity_args)
+      cnn_ion_feature = stages.cnn_ion(block_intensity)
+      lstm_feature, _ = stages.lstm(block_AA_id, block_AA_id, c_state0, h_state0)
+
+      stage_time["encode, " + name] = time_stage(stages.encode, block_spectrum)
+      stage_time["candidate intensity, " + name] = time_stage(
+          get_candidate_intensity_batch, *intensity_args)
+      stage_time["cnn_ion, " + name] = time_stage(stages.cnn_ion,
+                                                  block_intensity)
+      stage_time["lstm, " + name] = time_stage(stages.lstm,
+                                               block_AA_id,
+                                               block_AA_id,
+                                               c_state0,
+                                               h_state0)
+      stage_time["head, " + name] = time_stage(stages.head,
+                                               cnn_ion_feature,
+                                               lstm_feature)
+      stage_time["step (cnn_ion + lstm + head), " + name] = time_stage(
+          stages.step,
+          block_AA_id,
+          block_AA_id,
+          block_intensity,
+          c_state0,
+          h_state0)
+
+  print("{0:d} spectra, {1:d} runs per stage".format(block_len, repeat))
+  print("stage\tseconds\tms/spectrum")
+  for stage, seconds in stage_time.items():
+    print("{0}\t{1:.4f}\t{2:.3f}".format(stage,
+                                        seconds,
+                                        1000.0 * seconds / max(block_len, 1)))
+
+
 # @profile
+def decode_stack_data_set(sess, model, knapsack_matrix, stack_data_set, output_file_handle):
+  """Decode a stack read by read_spectra() with beam search.
+
+     The decoded peptides are printed to output_file_handle. Returns the
+     outputs of decode_beam_search() and the number of decoded spectra.
+  """
+
+  # concatenate data buckets
+  stack_data_set = sum(stack_data_set, [])
+
+  if deepnovo_config.FLAGS.topk:
+    decode_result = decode_beam_search_for_topk(sess,
+                                                model,
+                                                stack_data_set,
+                                                knapsack_matrix,
+                                                output_file_handle)
+  else:
+    decode_result = decode_beam_search(sess,
+                                       model,
+                                       stack_data_set,
+                                       knapsack_matrix,
+                                       output_file_handle)
+  return decode_result, len(stack_data_set)
+
+
+def decode_stacks(sess, model, knapsack_matrix, stack_data_sets, output_file_handle):
+  """Decode the stacks of read_stack_data_sets() one by one.
+
+     Yields (counts, stack_len, decode_result, decode_len) of each stack,
+     see read_spectra() and decode_stack_data_set().
+  """
+
+  with contextlib.closing(stack_data_sets):
+    for stack_data_set, counts, stack_len in stack_data_sets:
+      decode_result, decode_len = decode_stack_data_set(sess,
+                                                        model,
+                                                        knapsack_matrix,
+                                                        stack_data_set,
+                                                        output_file_handle)
+      yield counts, stack_len, decode_result, decode_len
+
+
+# Decoding workers
+# With --num_workers, the stacks of a file are decoded by a pool of spawned
+# processes, each with its own session and model. The results are merged in
+# stack order, so the output rows are in the same order as with a single
+# process. Each worker runs TF with its share of the cores as intra-op
+# threads, so the scores may differ from a single process in the last digits.
+
+_decode_worker = {}
+
+
+def init_decode_worker(num_threads, worker_counter):
+  """Pool initializer: build the model of a decoding worker.
+
+     The worker uses num_threads numba threads and TF intra-op threads
+     (unless --intra_op_threads is set) and, where supported, is pinned to its
+     own num_threads cores.
+  """
+
+  with worker_counter.get_lock():
+    worker_index = worker_counter.value
+    worker_counter.value += 1
+  if hasattr(os, "sched_setaffinity"):
+    cores = sorted(os.sched_getaffinity(0))
+    worker_cores = cores[worker_index * num_threads:(worker_index + 1) * num_threads]
+    if worker_cores:
+      os.sched_setaffinity(0, worker_cores)
+  import numba
+  numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+  print("init_decode_worker(), worker {0:d}, {1:d} threads".format(worker_index,
+                                                                   num_threads))
+  session_config = deepnovo_config.session_config(intra_op_threads=num_threads,
+                                                  inter_op_threads=1,
+                                                  inference=True)
+  sess = tf.compat.v1.Session(config=session_config)
+  model = deepnovo_model.inference_model()
+  model.build_model()
+  model.restore_model(sess)
+  _decode_worker["sess"] = sess
+  _decode_worker["model"] = model
+  _decode_worker["knapsack_matrix"] = deepnovo_knapsack.load_knapsack_index(
+      deepnovo_config.knapsack_file)
+  warm_up()
+
+
+def decode_stack_task(task):
+  """Read and decode one stack in a decoding worker.
+
+     task is an item of read_stack_tasks(). Returns the text printed to the
+     output file, then (counts, stack_len, decode_result, decode_len) like
+     decode_stacks().
+  """
+
+  input_file, spectrum_stack, stack = task
+  if spectrum_stack is not None:
+    stack_data_set, counts = read_spectra(spectrum_stack,
+                                          deepnovo_config.data_format,
+                                          stack)
+  else:
+    with open_spectra_file(input_file) as input_file_handle:
+      stack_data_set, counts = read_spectra(input_file_handle,
+                                            deepnovo_config.data_format,
+                                            stack)
+  output_buffer = io.StringIO()
+  decode_result, decode_len = decode_stack_data_set(_decode_worker["sess"],
+                                                    _decode_worker["model"],
+                                                    _decode_worker["knapsack_matrix"],
+                                                    stack_data_set,
+                                                    output_buffer)
+  return output_buffer.getvalue(), (counts, len(stack), decode_result, decode_len)
+
+
+def read_stack_tasks(input_file, spectra_file_location, stack_size, file_index=0):
+  """Yield the decode_stack_task() tasks of input_file, one per stack.
+
+     mgf files and spectrum stores are opened by the workers, only the stack
+     locations are sent. mzML stacks are streamed here and sent whole.
+  """
+
+  if deepnovo_mzml.is_mzml(input_file):
+    for spectrum_stack in deepnovo_mzml.iter_spectrum_stacks(input_file,
+                                                             stack_size,
+                                                             file_index):
+      yield input_file, spectrum_stack, spectrum_stack.get_location()
+  else:
+    for i in range(0, len(spectra_file_location), stack_size):
+      yield input_file, None, spectra_file_location[i:i+stack_size]
+
+
+def start_decode_pool(num_workers):
+  """Start num_workers decoding processes sharing the cores of this one."""
+
+  if hasattr(os, "sched_getaffinity"):
+    num_cores = len(os.sched_getaffinity(0))
+  else:
+    num_cores = multiprocessing.cpu_count()
+  num_threads = max(1, num_cores // num_workers)
+  print("start_decode_pool(), {0:d} workers x {1:d} threads".format(num_workers,
+                                                                    num_threads))
+  context = multiprocessing.get_context("spawn")
+  return context.Pool(num_workers,
+                      initializer=init_decode_worker,
+                      initargs=(num_threads, context.Value("i", 0)))
+
+
+def decode_stacks_parallel(decode_pool, num_workers, stack_tasks, output_file_handle):
+  """Same as decode_stacks() for the stack_tasks decoded by decode_pool.
+
+     At most 2 stacks per worker are in flight, which bounds the memory of
+     streamed mzML stacks. The outputs are written in the order of the stacks.
+  """
+
+  max_pending = 2 * num_workers
+  pending = collections.deque()
+  for task in stack_tasks:
+    pending.append(decode_pool.apply_async(decode_stack_task, (task,)))
+    while len(pending) >= max_pending or (pending and pending[0].ready()):
+      output_text, stack_result = pending.popleft().get()
+      output_file_handle.write(output_text)
+      yield stack_result
+  while pending:
+    output_text, stack_result = pending.popleft().get()
+    output_file_handle.write(output_text)
+    yield stack_result
+
+
+def collect_input_files(input_dir):
+  """Return the files of input_dir decoded by multi_decode(), sorted.
+
+     These are the mgf files, or their binary spectrum stores if built, the
+     spectrum stores and the mzML(.gz) files of input_dir, or input_dir
+     itself if it is a file or a store.
+  """
+
+  if deepnovo_spectrum_store.is_store(input_dir):
+    print("Single spectrum store passed\n")
+    print('store path:', input_dir)
+    mgf_files = [input_dir]
+  elif os.path.isdir(input_dir):
+    print('mgf file path:', input_dir + "/*.mgf")
+    mgf_files = glob.glob(input_dir + "/*.mgf")
+    # use the binary spectrum store of an mgf file if it has been built
+    store_files = [x for x in glob.glob(input_dir + "/*" + deepnovo_spectrum_store.STORE_SUFFIX)
+                   if deepnovo_spectrum_store.is_store(x)]
+    mgf_files = [x for x in mgf_files
+                 if deepnovo_spectrum_store.store_name(x) not in store_files]
+    mgf_files += store_files
+    # mzML files are decoded directly, without an intermediate mgf
+    mgf_files += glob.glob(input_dir + "/*.mzML") + glob.glob(input_dir + "/*.mzML.gz")
+    mgf_files = sorted(mgf_files)
+    print('num. of mgf files:{0}'.format(len(mgf_files)))
+  elif os.path.isfile(input_dir):
+    print("Single mgf file passed\n")
+    print('mgf file path:', input_dir)
+    mgf_files = [input_dir]
+  return mgf_files
+
+
 def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
   """TODO(nh2tran): docstring."""
 
-  with tf.compat.v1.Session() as sess:
+  # with --num_workers, the model and knapsack are loaded by the workers
+  decode_in_workers = (deepnovo_config.FLAGS.beam_search
+                       and deepnovo_config.FLAGS.num_workers > 1)
+
+  with tf.compat.v1.Session(config=deepnovo_config.session_config(inference=True)) as sess:
 
     # DECODING MODEL
-    print("DECODING MODEL")
-    #~ model = deepnovo_model.DecodingModel()
-    model = deepnovo_model.ModelInference()
-    model.build_model()
-    model.restore_model(sess)
+    if not decode_in_workers:
+      print("DECODING MODEL")
+      #~ model = deepnovo_model.DecodingModel()
+      model = deepnovo_model.inference_model()
+      model.build_model()
+      model.restore_model(sess)
 
 #~     test_writer = tf.train.SummaryWriter("test_log", sess.graph)
 #~     test_writer.close()
@@ -3119,21 +3405,17 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
       #~ print("ERROR: model parameters not found.")
       #~ sys.exit()
 
-    if deepnovo_config.FLAGS.beam_search:
+    if deepnovo_config.FLAGS.beam_search and not decode_in_workers:
       print("Load knapsack_matrix from default: knapsack.npy")
-      knapsack_matrix = np.load(deepnovo_config.knapsack_file)
+      knapsack_matrix = deepnovo_knapsack.load_knapsack_index(
+          deepnovo_config.knapsack_file)
+
+    # load/compile the numba kernels before the first spectra are read
+    warm_up()
 
     ### collect data (mgf) files to test
-    if os.path.isdir(input_dir):
-      print('mgf file path:', input_dir + "/*.mgf")
-      mgf_files = glob.glob(input_dir + "/*.mgf")
-      num_mgf_files = len(mgf_files)
-      print('num. of mgf files:{0}'.format(num_mgf_files))
-    elif os.path.isfile(input_dir):
-      print("Single mgf file passed\n")
-      print('mgf file path:', input_dir)
-      mgf_files = [input_dir]
-      num_mgf_files = len(mgf_files)
+    mgf_files = collect_input_files(input_dir)
+    num_mgf_files = len(mgf_files)
 
     # print to output file
     decode_all_log = "{0}/mgf_test/log.txt".format(deepnovo_config.FLAGS.train_dir)
@@ -3156,20 +3438,49 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
       "\tavg_peptide_len\n",
       file=decode_all_log_file_handler)
 
+    # decode the stacks in worker processes, they also read them
+    decode_pool = None
+    prefetcher = None
+    if decode_in_workers:
+      decode_pool = start_decode_pool(deepnovo_config.FLAGS.num_workers)
+    # or read the spectrum stacks of all files ahead in a background process
+    elif deepnovo_config.FLAGS.beam_search and deepnovo_config.FLAGS.prefetch_depth > 0:
+      prefetcher = deepnovo_prefetch.Prefetcher(
+          read_all_stack_data_sets,
+          args=(mgf_files, deepnovo_config.test_stack_size),
+          depth=deepnovo_config.FLAGS.prefetch_depth)
+      prefetch_iterator = iter(prefetcher)
+
+    # the file_index of the SCANS ids of mzML spectra, see mzml2kaiko.py
+    mzml_file_index = deepnovo_mzml.mzml_file_index(mgf_files)
+
     start_time = time.time()
 
     # decode multiple files
     for i, input_file in enumerate(mgf_files):
       # for debug
-      common_name = os.path.basename(input_file).rsplit('.mgf')[0]
+      if deepnovo_mzml.is_mzml(input_file):
+        common_name = deepnovo_mzml.mzml_name(input_file)
+      else:
+        common_name = os.path.splitext(os.path.basename(input_file))[0]
       print('[{0:3d}/{1:3d}] {2}'.format(i+1,num_mgf_files,common_name))
       print('{0:3d}\t{1}\t'.format(i,common_name))
 
       # FIND SPECTRA LOCATIONS
-      spectra_file_location = inspect_file_location(deepnovo_config.data_format,
-                                                    input_file)
-      data_set_len = len(spectra_file_location)
-      print("Total number of spectra = {0:d}".format(data_set_len))
+      if prefetcher is not None:
+        # the prefetching process finds them and reads the stacks
+        _, data_set_len = next(prefetch_iterator)
+        print("Total number of spectra = {0}".format(data_set_len))
+      elif deepnovo_mzml.is_mzml(input_file):
+        # mzML spectra are streamed, their number is only known at the end
+        spectra_file_location = None
+        data_set_len = "?"
+        print("Streaming spectra from mzML")
+      else:
+        spectra_file_location = inspect_file_location(deepnovo_config.data_format,
+                                                      input_file)
+        data_set_len = len(spectra_file_location)
+        print("Total number of spectra = {0:d}".format(data_set_len))
 
       # DECODE with BEAM SEARCH
       if deepnovo_config.FLAGS.beam_search:
@@ -3180,9 +3491,6 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
         # READ & DECODE in stacks
         print("READ & DECODE in stacks")
         decode_stack_size = deepnovo_config.test_stack_size
-        spectra_file_location_stack_list = [
-            spectra_file_location[i:i+decode_stack_size]
-            for i in range(0, data_set_len, decode_stack_size)]
 
         total_accuracy_AA = 0.0
         total_accuracy_AA_lbyl = 0.0
@@ -3215,16 +3523,34 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
                 file=output_file_handle,
                 end="")
 
-          with open(input_file, 'r') as input_file_handle:
-
-            counter_peptide = 0
-            for stack in spectra_file_location_stack_list:
+          if decode_pool is not None:
+            stack_results = decode_stacks_parallel(
+                decode_pool,
+                deepnovo_config.FLAGS.num_workers,
+                read_stack_tasks(input_file,
+                                 spectra_file_location,
+                                 decode_stack_size,
+                                 file_index=mzml_file_index.get(input_file, 0)),
+                output_file_handle)
+          else:
+            if prefetcher is not None:
+              stack_data_sets = iter_file_stack_data_sets(prefetch_iterator)
+            else:
+              stack_data_sets = read_stack_data_sets(input_file,
+                                                     spectra_file_location,
+                                                     decode_stack_size,
+                                                     file_index=mzml_file_index.get(input_file, 0))
+            stack_results = decode_stacks(sess,
+                                          model,
+                                          knapsack_matrix,
+                                          stack_data_sets,
+                                          output_file_handle)
 
-              _start_time = time.time()
+          with contextlib.closing(stack_results):
 
-              stack_data_set, counts = read_spectra(input_file_handle,
-                                               deepnovo_config.data_format,
-                                               stack)
+            counter_peptide = 0
+            _start_time = time.time()
+            for counts, stack_len, decode_result, decode_len in stack_results:
 
               counter += counts[0]
               counter_skipped += counts[1]
@@ -3236,39 +3562,19 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
               avg_peak_count += counts[7]
               avg_peptide_len += counts[8]
 
-              counter_peptide += len(stack)
-              print("Read {0:d}/{1:d} spectra, reading time = {2:.2f}".format(
+              counter_peptide += stack_len
+              print("Decoded {0:d}/{1} spectra, stack time = {2:.2f}".format(
                   counter_peptide,
                   data_set_len,
                   time.time() - _start_time))
 
-              # concatenate data buckets
-              stack_data_set = sum(stack_data_set, [])
-
-              if deepnovo_config.FLAGS.topk:
-                (batch_accuracy_AA,
-                 batch_accuracy_AA_lbyl,
-                 batch_len_AA,
-                 batch_len_decode,
-                 num_exact_match,
-                 num_len_match,
-                 spectrum_time) = decode_beam_search_for_topk(sess,
-                                                     model,
-                                                     stack_data_set,
-                                                     knapsack_matrix,
-                                                     output_file_handle)
-              else:
-                (batch_accuracy_AA,
-                 batch_accuracy_AA_lbyl,
-                 batch_len_AA,
-                 batch_len_decode,
-                 num_exact_match,
-                 num_len_match,
-                 spectrum_time) = decode_beam_search(sess,
-                                                     model,
-                                                     stack_data_set,
-                                                     knapsack_matrix,
-                                                     output_file_handle)
+              (batch_accuracy_AA,
+               batch_accuracy_AA_lbyl,
+               batch_len_AA,
+               batch_len_decode,
+               num_exact_match,
+               num_len_match,
+               spectrum_time) = decode_result
 
               total_accuracy_AA += batch_accuracy_AA
               total_accuracy_AA_lbyl += batch_accuracy_AA_lbyl
@@ -3277,7 +3583,9 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
               total_exact_match += num_exact_match
               total_len_match += num_len_match
               total_spectrum_time += spectrum_time
-              total_peptide_decode += len(stack_data_set)
+              total_peptide_decode += decode_len
+
+              _start_time = time.time()
 
         print("ACCURACY SUMMARY (%.2f min)" % ((time.time() - start_time)/60))
         print("  recall_AA %.4f" % (total_accuracy_AA/total_len_AA))
@@ -3311,8 +3619,9 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
       else:
 
         print("READING SPECTRA")
+        assert spectra_file_location is not None, "ERROR: true feeding needs annotated mgf input"
         start_time = time.time()
-        with open(input_file, 'r') as file_handle:
+        with open_spectra_file(input_file) as file_handle:
           data_set, _ = read_spectra(file_handle,
                                      deepnovo_config.data_format,
                                      spectra_file_location)
@@ -3336,6 +3645,13 @@ def multi_decode(input_dir=deepnovo_config.input_mgf_dir):
           print("  accuracy_len %.4f" % (num_len_match))
           print("  spectrum_time %.4f" % (spectrum_time))
 
+    if prefetcher is not None:
+      print(prefetcher.summary())
+      prefetcher.close()
+    if decode_pool is not None:
+      decode_pool.close()
+      decode_pool.join()
+
 
 def train_cycle(model,
                 sess,
@@ -3637,7 +3953,7 @@ def train():
 
   # read RANDOM stacks to valid_set
   print("read RANDOM stacks to valid_set")
-  with open(deepnovo_config.input_file_valid, 'r') as file_handle:
+  with open_spectra_file(deepnovo_config.input_file_valid) as file_handle:
     valid_set, set_len = read_random_stack(
         file_handle,
         deepnovo_config.data_format,
@@ -3651,7 +3967,7 @@ def train():
         #~ resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000)
 
   # TRAINING on train_set
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
   #~ print("RESOURCE-sess: ",
           #~ resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000)
 
@@ -3661,7 +3977,7 @@ def train():
           #~ resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000)
 
     # Open train_set
-    input_handle_train = open(deepnovo_config.input_file_train, 'r')
+    input_handle_train = open_spectra_file(deepnovo_config.input_file_train)
     print("Open train_set: ", deepnovo_config.input_file_train)
 
     # Open log_file
@@ -3756,13 +4072,13 @@ def test_true_feeding():
     #~ valid_set, _ = read_spectra(file_handle,
                                 #~ deepnovo_config.data_format,
                                 #~ spectra_file_location_valid)
-  with open(deepnovo_config.input_file_test, 'r') as file_handle:
+  with open_spectra_file(deepnovo_config.input_file_test) as file_handle:
     test_set, _ = read_spectra(file_handle,
                                deepnovo_config.data_format,
                                spectra_file_location_test)
 
   # Testing
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
 
     print("Create model for testing")
     model = create_model(sess, training_mode=False)
@@ -3881,7 +4197,7 @@ def multi_train_for_sigopt(hyperparams,
 
   # TRAINING on train_set
   tf.compat.v1.reset_default_graph()
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
     print("Create model for training")
     model = create_model(sess, training_mode=True)
 
@@ -4002,7 +4318,7 @@ def multi_train():
   valid_bucket_pos_id = np.nonzero(valid_bucket_len)[0]
 
   # TRAINING on train_set
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
     print("Create model for training")
     model = create_model(sess, training_mode=True)
 
@@ -4399,7 +4715,7 @@ def multi_train_pickles():
   valid_bucket_pos_id = np.nonzero(valid_bucket_len)[0]
 
   # TRAINING on train_set
-  with tf.compat.v1.Session() as sess:
+  with tf.compat.v1.Session(config=deepnovo_config.session_config()) as sess:
     print("Create model for training")
     model = create_model(sess, training_mode=True)
 
@@ -0,0 +1,339 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Fast access to spectra stored in MGF files.
+
+This module only depends on numpy so that it can be shared by the decoder,
+the WorkerIO classes and the stand-alone tools.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import mmap
+import os
+
+import numpy as np
+
+
+# sidecar index written next to each MGF file
+INDEX_SUFFIX = ".mgfidx"
+INDEX_VERSION = 1
+# number of leading bytes hashed to detect a rewritten file of the same size
+INDEX_HEADER_BYTES = 65536
+
+
+def locate_spectra(input_file, keyword=b"BEGIN IONS"):
+  """Return the byte offsets of all spectra in input_file.
+
+     The file is memory-mapped and swept with bytes.find() instead of being
+     read line by line, which keeps the cost close to a plain memory scan.
+     Only matches at the beginning of a line are accepted.
+     The result is an int64 array of offsets suitable for file.seek().
+  """
+
+  if not isinstance(keyword, bytes):
+    keyword = keyword.encode("ascii")
+
+  # mmap cannot map an empty file
+  if os.path.getsize(input_file) == 0:
+    return np.zeros(0, dtype=np.int64)
+
+  location_list = []
+  with open(input_file, mode="rb") as file_handle:
+    with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      find = mm.find
+      position = find(keyword, 0)
+      while position >= 0:
+        if position == 0 or mm[position - 1] == 0x0A: # "\n"
+          location_list.append(position)
+        position = find(keyword, position + len(keyword))
+
+  return np.array(location_list, dtype=np.int64)
+
+
+def parse_header(block, start=0):
+  """Parse the header lines of one spectrum block.
+
+     block is the bytes of a spectrum starting at start, i.e. at its
+     "BEGIN IONS" line. Returns the header as a dict of str and the offset
+     of the first peak line (or of "END IONS" if there is no peak).
+  """
+
+  header_dict = {}
+  position = block.index(b"\n", start) + 1
+  while position < len(block):
+    # stop at the first peak line or at END IONS
+    if (block[position:position+1].isdigit()
+        or block.startswith(b"END IONS", position)):
+      break
+    line_end = block.find(b"\n", position)
+    if line_end < 0:
+      line_end = len(block)
+    line = block[position:line_end].rstrip(b"\r").decode("ascii", "replace")
+    if "=" in line:
+      var_name, var_value = line.split("=", 1)
+      header_dict[var_name] = var_value
+    position = line_end + 1
+  return header_dict, position
+
+
+def read_spectrum_block(file_handle, location, chunk_size=65536):
+  """Return the bytes of the spectrum at location, up to "END IONS".
+
+     file_handle may be opened in text or binary mode, the bytes are always
+     read from the underlying binary buffer.
+  """
+
+  raw_handle = getattr(file_handle, "buffer", file_handle)
+  raw_handle.seek(location)
+  block = raw_handle.read(chunk_size)
+  end = block.find(b"END IONS")
+  while end < 0:
+    chunk = raw_handle.read(chunk_size)
+    if not chunk:
+      end = len(block)
+      break
+    search_start = max(len(block) - len(b"END IONS"), 0)
+    block += chunk
+    end = block.find(b"END IONS", search_start)
+  return block[:end]
+
+
+def parse_peaks(block, start=0, mz_max=None):
+  """Convert the "mz intensity" lines of block[start:] into two arrays.
+
+     The whole peak list is converted by a single np.fromstring() call,
+     peaks with mz > mz_max are dropped by a vectorized mask.
+     Returns (mz, intensity) as float64 arrays.
+  """
+
+  text = block[start:]
+  line_count = text.count(b"\n")
+  if text and not text.endswith(b"\n"):
+    line_count += 1
+  peaks = np.fromstring(text, dtype=np.float64, sep=" ")
+  if peaks.size == 2 * line_count:
+    peaks = peaks.reshape(-1, 2)
+  else:
+    # extra columns or blank lines, fall back to one split per line
+    peaks = np.array([line.split()[:2] for line in text.splitlines()
+                      if line.strip()],
+                     dtype=np.float64).reshape(-1, 2)
+  mz = peaks[:, 0]
+  intensity = peaks[:, 1]
+  if mz_max is not None:
+    mask = mz <= mz_max
+    mz = mz[mask]
+    intensity = intensity[mask]
+  return mz, intensity
+
+
+def read_header(file_handle, location):
+  """Read the spectrum at location and parse its header only.
+
+     Returns (header_dict, block, peak_start), the peaks can be converted
+     later by parse_peaks(block, peak_start) if the spectrum is kept.
+  """
+
+  block = read_spectrum_block(file_handle, location)
+  assert block.startswith(b"BEGIN IONS"), "ERROR: read_spectrum(); wrong format"
+  header_dict, peak_start = parse_header(block)
+  return header_dict, block, peak_start
+
+
+def read_spectrum(file_handle, location, mz_max=None):
+  """Read the spectrum at location.
+
+     Returns (header_dict, mz, intensity), see parse_header and parse_peaks.
+  """
+
+  header_dict, block, peak_start = read_header(file_handle, location)
+  mz, intensity = parse_peaks(block, peak_start, mz_max)
+  return header_dict, mz, intensity
+
+
+def header_scan(header_dict):
+  """Spectrum id following the SCANS, TITLE scan=, TITLE rules of read_spectra."""
+
+  if "SCANS" in header_dict:
+    return header_dict["SCANS"]
+  elif "scan=" in header_dict["TITLE"]:
+    return "scan" + header_dict["TITLE"].split("scan=")[1]
+  else:
+    return "scan_" + header_dict["TITLE"]
+
+
+class MgfWriter(object):
+  """Buffered writer of MGF spectra.
+
+     The peak table of a spectrum is formatted by a single string operation
+     and spectra are accumulated in memory, then written in chunks of about
+     buffer_size characters instead of one write per line.
+     With precision=None the peaks are written as "{mz} {intensity}", i.e.
+     the same text as print(); otherwise with precision decimals ("%.*f"),
+     which makes smaller files.
+  """
+
+
+  def __init__(self, file_handle, precision=None, buffer_size=1 << 20):
+    """file_handle is a text file object opened for writing."""
+
+    self.file_handle = file_handle
+    self.precision = precision
+    self.buffer_size = buffer_size
+    self.buffer = []
+    self.buffer_length = 0
+    if precision is None:
+      self.peak_format = "%s %s\n"
+    else:
+      self.peak_format = "%.{0:d}f %.{0:d}f\n".format(precision)
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.flush()
+
+
+  def format_peaks(self, mz, intensity):
+    """Return the peak lines of a spectrum as one string."""
+
+    assert len(mz) == len(intensity), "Error: mz/intensity size mismatch"
+    # Python numbers format like "{0}".format() of numpy scalars
+    peaks = [None] * (2 * len(mz))
+    peaks[0::2] = np.asarray(mz).tolist()
+    peaks[1::2] = np.asarray(intensity).tolist()
+    return (self.peak_format * len(mz)) % tuple(peaks)
+
+
+  def write_spectrum(self, header, mz, intensity):
+    """Append a spectrum, header is a list of (name, value) pairs."""
+
+    text = "".join(["BEGIN IONS\n"]
+                   + ["{0}={1}\n".format(name, value) for name, value in header]
+                   + [self.format_peaks(mz, intensity), "END IONS\n"])
+    self.buffer.append(text)
+    self.buffer_length += len(text)
+    if self.buffer_length >= self.buffer_size:
+      self.flush()
+
+
+  def flush(self):
+    """Write the buffered spectra to the file."""
+
+    if self.buffer:
+      self.file_handle.write("".join(self.buffer))
+      self.buffer = []
+      self.buffer_length = 0
+
+
+def index_file(input_file):
+  """Return the sidecar index path of input_file."""
+
+  return input_file + INDEX_SUFFIX
+
+
+def _index_key(input_file):
+  """Return (size, mtime_ns, header_hash) used to detect a stale index."""
+
+  file_stat = os.stat(input_file)
+  with open(input_file, mode="rb") as file_handle:
+    header_hash = hashlib.sha1(file_handle.read(INDEX_HEADER_BYTES)).hexdigest()
+  return file_stat.st_size, file_stat.st_mtime_ns, header_hash
+
+
+def build_index(input_file):
+  """Scan input_file once and collect the per-spectrum index columns.
+
+     Returns a dict of numpy arrays:
+       offsets, scans, precursor_mz, charge, rtinseconds, seq, peak_count.
+  """
+
+  offsets = locate_spectra(input_file)
+  spectrum_count = len(offsets)
+  scans = []
+  seqs = []
+  precursor_mz = np.zeros(spectrum_count, dtype=np.float64)
+  charge = np.zeros(spectrum_count, dtype=np.float64)
+  rtinseconds = np.zeros(spectrum_count, dtype=np.float64)
+  peak_count = np.zeros(spectrum_count, dtype=np.int32)
+
+  if spectrum_count > 0:
+    with open(input_file, mode="rb") as file_handle:
+      with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        block_ends = offsets[1:].tolist() + [len(mm)]
+        for i, (start, end) in enumerate(zip(offsets.tolist(), block_ends)):
+          block = mm[start:end]
+          header_dict, peak_start = parse_header(block)
+          peak_end = block.find(b"END IONS", peak_start)
+          if peak_end < 0:
+            peak_end = len(block)
+          scans.append(header_scan(header_dict))
+          seqs.append(header_dict.get("SEQ", ""))
+          precursor_mz[i] = float(header_dict["PEPMASS"].split()[0])
+          charge[i] = float(header_dict.get("CHARGE", "0").split("+")[0])
+          rtinseconds[i] = float(header_dict.get("RTINSECONDS", "nan"))
+          peak_count[i] = block.count(b"\n", peak_start, peak_end)
+
+  return {"offsets": offsets,
+          "scans": np.array(scans, dtype=np.str_),
+          "precursor_mz": precursor_mz,
+          "charge": charge,
+          "rtinseconds": rtinseconds,
+          "seq": np.array(seqs, dtype=np.str_),
+          "peak_count": peak_count}
+
+
+def write_index(input_file, index):
+  """Write index next to input_file, tagged with the current file key."""
+
+  size, mtime_ns, header_hash = _index_key(input_file)
+  # write to a temporary file first so that readers never see a partial index,
+  # several decoding processes may index the same file concurrently
+  temp_file = "{0}.{1:d}.tmp".format(index_file(input_file), os.getpid())
+  with open(temp_file, mode="wb") as file_handle:
+    np.savez(file_handle,
+             version=np.int64(INDEX_VERSION),
+             size=np.int64(size),
+             mtime_ns=np.int64(mtime_ns),
+             header_hash=np.str_(header_hash),
+             **index)
+  os.replace(temp_file, index_file(input_file))
+
+
+def load_index(input_file):
+  """Load the sidecar index of input_file, or return None if missing/stale."""
+
+  try:
+    with np.load(index_file(input_file), allow_pickle=False) as data:
+      size, mtime_ns, header_hash = _index_key(input_file)
+      if (int(data["version"]) != INDEX_VERSION
+          or int(data["size"]) != size
+          or int(data["mtime_ns"]) != mtime_ns
+          or str(data["header_hash"]) != header_hash):
+        return None
+      return {name: data[name] for name in data.files
+              if name not in ("version", "size", "mtime_ns", "header_hash")}
+  except (OSError, ValueError, KeyError):
+    return None
+
+
+def get_index(input_file):
+  """Return the index of input_file, building and saving it if needed."""
+
+  index = load_index(input_file)
+  if index is None:
+    print("get_index(), building", index_file(input_file))
+    index = build_index(input_file)
+    try:
+      write_index(input_file, index)
+    except OSError as e: # e.g. read-only input directory
+      print("get_index(), cannot write index:", e)
+  return index
@@ -31,6 +31,7 @@ from __future__ import division
 from __future__ import print_function
 
 import sys
+import time
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
@@ -289,16 +290,22 @@ class ModelNetwork(object):
          input_dict["intensity"]: [batch_size, vocab_size, num_ion, WINDOW_SIZE].
          input_dict["lstm_state"]: tuple of 2 tensors [batch_size, num_units]
          input_dict["AAid"]: list of 2 tensors [batch_size]
+         input_dict["forward_size"]: optional scalar, if >= 0 the first
+           forward_size rows of the step inputs (intensity, lstm_state, AAid)
+           are decoded forward and the others backward, else all rows are
+           decoded in both directions
          dropout_keep["conv"]: keep_prob of dropout after convolutional layers
          dropout_keep["dense"]: keep_prob of dropout after dense layers
 
        Outputs:
          Output tensors are grouped into 2 dictionaries, output_forward and
-         output_backward, each has 4 tensors:
+         output_backward, each has 6 tensors:
          ["logit"]: [batch_size, vocab_size], to compute loss in training
          ["logprob"]: [batch_size, vocab_size], to compute score in inference
          ["lstm_state"]: [batch_size, num_units], to compute next iteration
          ["lstm_state0"]: [batch_size, num_units], state from cnn_spectrum
+         ["cnn_ion_feature"]: [batch_size, num_units], from cnn_ion
+         ["lstm_feature"]: [batch_size, num_units], from the lstm cell
     """
 
     print("".join(["="] * 80)) # section-separating line
@@ -308,6 +315,7 @@ class ModelNetwork(object):
 
     cnn_spectrum_feature = self._build_cnn_spectrum(input_dict["spectrum"])
     embedding_AAid = self._build_embedding_AAid(input_dict["AAid"])
+    forward_size = input_dict.get("forward_size")
 
     output_forward = {}
     output_backward = {}
@@ -320,14 +328,18 @@ class ModelNetwork(object):
 
         # cnn_ion model
         cnn_ion_feature, cnn_ion_logit = self._build_cnn_ion(
-            input_dict["intensity"],
+            self._direction_rows(input_dict["intensity"],
+                                 forward_size,
+                                 direction),
             direction)
 
         # lstm model
         lstm_feature, lstm_logit, lstm_state0, lstm_state = self._build_lstm(
             cnn_spectrum_feature,
-            input_dict["lstm_state"],
-            embedding_AAid,
+            tuple(self._direction_rows(x, forward_size, direction)
+                  for x in input_dict["lstm_state"]),
+            [self._direction_rows(x, forward_size, direction)
+             for x in embedding_AAid],
             direction)
 
         # combine cnn_ion and lstm features
@@ -377,10 +389,26 @@ class ModelNetwork(object):
         output["logprob"] = logprob
         output["lstm_state"] = lstm_state
         output["lstm_state0"] = lstm_state0
+        output["cnn_ion_feature"] = cnn_ion_feature
+        output["lstm_feature"] = lstm_feature
 
     return output_forward, output_backward
 
 
+  def _direction_rows(self, step_input, forward_size, direction):
+    """Rows of step_input decoded in direction, see input_dict["forward_size"]."""
+
+    if forward_size is None:
+      return step_input
+    if direction == "forward":
+      end = tf.where(forward_size < 0,
+                     array_ops.shape(step_input)[0],
+                     forward_size)
+      return step_input[:end]
+    else:
+      return step_input[tf.maximum(forward_size, 0):]
+
+
   def _build_cnn_ion(self, input_intensity, direction):
     """TODO(nh2tran): docstring.
 
@@ -451,7 +479,9 @@ class ModelNetwork(object):
     dense1 = tf.nn.relu(tf.matmul(dense1_input, dense1_weight) + dense1_bias)
     dense1 = tf.nn.dropout(dense1, 1 - (self.dropout_keep["dense"]), name="dropout1") # TODO(nh2tran): remove name
 
-    cnn_ion_feature = dense1
+    # named to be fed/fetched when the stages are run separately
+    with tf.compat.v1.name_scope(stage_scope(direction)):
+      cnn_ion_feature = tf.identity(dense1, name="cnn_ion_feature")
 
     # linear transform to logit [128, 26], in case only cnn_ion model is used
     # TODO(nh2tran): replace _linear and remove scope
@@ -638,6 +668,10 @@ class ModelNetwork(object):
       # lstm.len_full model: standard lstm
       lstm_feature, lstm_state = cell(inputs=AA_2_project, state=input_lstm_state)
 
+    # named to be fed/fetched when the stages are run separately
+    with tf.compat.v1.name_scope(stage_scope(direction)):
+      lstm_feature = tf.identity(lstm_feature, name="lstm_feature")
+
     # linear transform to logit [128, 26], in case only lstm model is used
     # TODO(nh2tran): replace _linear and remove scope
     with tf.compat.v1.variable_scope("lstm_output_projected"):
@@ -710,6 +744,13 @@ class ModelInference(object):
                                tf.compat.v1.placeholder(dtype=tf.int32,
                                               shape=[None],
                                               name="input_AA_id_2")] # to change to "input_AAid_2"
+    # number of leading rows of the step inputs decoded forward, the others
+    #   are decoded backward, so that both directions run in one step;
+    #   -1 (default) decodes all rows in both directions
+    self.input_dict["forward_size"] = tf.compat.v1.placeholder_with_default(
+        tf.constant(-1, dtype=tf.int32),
+        shape=[],
+        name="input_forward_size")
 
     # the keep_prob probability of dropout layers
     #   for inference model, they are const 1.0
@@ -727,6 +768,7 @@ class ModelInference(object):
     #   ["logprob"]: shape [batch_size, vocab_size], to compute score in inference
     #   ["lstm_state"]: shape [batch_size, num_units], to compute next iteration
     #   ["lstm_state0"]: shape [batch_size, num_units], state from cnn_spectrum
+    #   and the features of the stages, see ModelNetwork.build_network()
     # they will be built and loaded by build_model() and restore_model()
     self.output_forward = None
     self.output_backward = None
@@ -815,3 +857,221 @@ class ModelInference(object):
       print("Error: model not found.")
       sys.exit()
 
+
+  def export_frozen_model(self, session, frozen_file):
+    """Write the restored inference graph as a frozen GraphDef.
+
+       Variables are converted to constants and the graph is pruned to the
+       inputs of the logprob, lstm_state0 and lstm_state outputs, so the
+       training-only "logit" branches are dropped. Load it with ModelFrozen.
+    """
+
+    print("".join(["="] * 80)) # section-separating line
+    print("ModelInference: export_frozen_model()")
+
+    # fixed node names for the outputs, the inputs keep their placeholder names
+    output_node_names = []
+    for direction, output in zip(["forward", "backward"],
+                                 [self.output_forward, self.output_backward]):
+      for key in FROZEN_OUTPUT_KEYS:
+        name = frozen_output_name(direction, key)
+        if key == "logprob":
+          tf.identity(output[key], name=name)
+          output_node_names.append(name)
+        else:
+          for part, tensor in zip(["c", "h"], output[key]):
+            tf.identity(tensor, name=name + "_" + part)
+            output_node_names.append(name + "_" + part)
+
+    graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+        session,
+        session.graph.as_graph_def(),
+        output_node_names)
+    # the stage features are Identity ops too, keep them to be fed/fetched
+    stage_node_names = [stage_scope(direction) + key
+                        for direction in ["forward", "backward"]
+                        for key in STAGE_FEATURE_KEYS]
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(
+        graph_def,
+        protected_nodes=output_node_names + stage_node_names)
+
+    with tf.io.gfile.GFile(frozen_file, "wb") as file_handle:
+      file_handle.write(graph_def.SerializeToString())
+    print("export frozen model to {0:s}, {1:d} nodes".format(frozen_file,
+                                                         len(graph_def.node)))
+
+
+# outputs of the frozen inference graph, see export_frozen_model()
+FROZEN_OUTPUT_KEYS = ["logprob", "lstm_state0", "lstm_state"]
+# features between the stages of a decoding step, see ModelStages
+STAGE_FEATURE_KEYS = ["cnn_ion_feature", "lstm_feature"]
+
+
+def stage_scope(direction):
+  """Absolute name scope of the stage features of a direction."""
+
+  return "stage_{0:s}/".format(direction)
+
+
+def frozen_output_name(direction, key):
+  """Node name of an output of the frozen inference graph."""
+
+  return "output_{0:s}_{1:s}".format(direction, key)
+
+
+class ModelFrozen(object):
+  """ModelInference loaded from a frozen graph.
+
+     The graph written by ModelInference.export_frozen_model() holds the
+     weights as constants, so build_model() only imports it into the default
+     graph and restore_model() has nothing to do: the network is not rebuilt
+     and no checkpoint is read. input_dict, output_forward and output_backward
+     are the same as for ModelInference, without the training "logit".
+  """
+
+  def __init__(self, frozen_file):
+    """frozen_file is read by build_model()."""
+
+    print("".join(["="] * 80)) # section-separating line
+    print("ModelFrozen: __init__()")
+
+    self.frozen_file = frozen_file
+    self.input_dict = {}
+    self.output_forward = None
+    self.output_backward = None
+
+
+  def build_model(self):
+    """Import the frozen graph and look up its input and output tensors."""
+
+    print("".join(["="] * 80)) # section-separating line
+    print("ModelFrozen: build_model()")
+
+    start_time = time.time()
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.io.gfile.GFile(self.frozen_file, "rb") as file_handle:
+      graph_def.ParseFromString(file_handle.read())
+    tf.import_graph_def(graph_def, name="")
+    get_tensor = tf.compat.v1.get_default_graph().get_tensor_by_name
+
+    self.input_dict["spectrum"] = get_tensor("input_spectrum:0")
+    self.input_dict["intensity"] = get_tensor("input_intensity:0")
+    self.input_dict["lstm_state"] = (get_tensor("input_c_state:0"),
+                                     get_tensor("input_h_state:0"))
+    self.input_dict["AAid"] = [get_tensor("input_AA_id_1:0"),
+                               get_tensor("input_AA_id_2:0")]
+    try:
+      self.input_dict["forward_size"] = get_tensor("input_forward_size:0")
+    except KeyError: # exported before the input was added
+      pass
+
+    self.output_forward = {}
+    self.output_backward = {}
+    for direction, output in zip(["forward", "backward"],
+                                 [self.output_forward, self.output_backward]):
+      for key in FROZEN_OUTPUT_KEYS:
+        name = frozen_output_name(direction, key)
+        if key == "logprob":
+          output[key] = get_tensor(name + ":0")
+        else:
+          output[key] = tf.compat.v1.nn.rnn_cell.LSTMStateTuple(
+              get_tensor(name + "_c:0"),
+              get_tensor(name + "_h:0"))
+      for key in STAGE_FEATURE_KEYS:
+        try:
+          output[key] = get_tensor(stage_scope(direction) + key + ":0")
+        except KeyError: # exported before the stage features were added
+          pass
+
+    print("load frozen model from {0:s}, {1:.2f} s".format(
+        self.frozen_file,
+        time.time() - start_time))
+
+
+  def restore_model(self, session):
+    """Nothing to restore, the weights are constants of the graph."""
+
+    pass
+
+
+def inference_model():
+  """Return a ModelFrozen if --frozen_model is set, else a ModelInference."""
+
+  if deepnovo_config.FLAGS.frozen_model:
+    return ModelFrozen(deepnovo_config.FLAGS.frozen_model)
+  return ModelInference()
+
+
+class ModelStages(object):
+  """Run the stages of the inference model of one direction separately.
+
+     encode: spectrum >> lstm_state0, once per spectrum,
+     cnn_ion: candidate intensity >> cnn_ion_feature,
+     lstm: AAid, lstm_state >> lstm_feature, next lstm_state,
+     head: cnn_ion_feature, lstm_feature >> logprob.
+     step() runs cnn_ion, lstm and head in one call as the decoder does.
+     A stage is run by feeding the tensors at its boundary, TensorFlow then
+     only computes the ops between them. The head combines both features,
+     i.e. the default use_intensity and use_lstm setting.
+  """
+
+  def __init__(self, session, model, direction):
+    """direction is 0 (forward) or 1 (backward)."""
+
+    self.session = session
+    self.input_dict = model.input_dict
+    if direction == 0:
+      self.output = model.output_forward
+    else:
+      self.output = model.output_backward
+    # a frozen graph exported before the stage features has none
+    assert all(key in self.output for key in STAGE_FEATURE_KEYS), (
+        "Error: the model has no stage features, export the frozen model"
+        " again with --export_frozen_model")
+
+
+  def encode(self, spectrum):
+    """Return (c_state0, h_state0) of a [batch_size, MZ_SIZE] spectrum."""
+
+    input_feed = {self.input_dict["spectrum"]: spectrum}
+    return self.session.run(self.output["lstm_state0"], input_feed)
+
+
+  def cnn_ion(self, intensity):
+    """Return cnn_ion_feature of the candidate intensity."""
+
+    input_feed = {self.input_dict["intensity"]: intensity}
+    return self.session.run(self.output["cnn_ion_feature"], input_feed)
+
+
+  def lstm(self, AA_id_1, AA_id_2, c_state, h_state):
+    """Return (lstm_feature, (c_state, h_state)) of the next iteration."""
+
+    input_feed = {self.input_dict["AAid"][0]: AA_id_1,
+                  self.input_dict["AAid"][1]: AA_id_2,
+                  self.input_dict["lstm_state"][0]: c_state,
+                  self.input_dict["lstm_state"][1]: h_state}
+    return self.session.run([self.output["lstm_feature"],
+                             self.output["lstm_state"]],
+                            input_feed)
+
+
+  def head(self, cnn_ion_feature, lstm_feature):
+    """Return logprob of the combined features."""
+
+    input_feed = {self.output["cnn_ion_feature"]: cnn_ion_feature,
+                  self.output["lstm_feature"]: lstm_feature}
+    return self.session.run(self.output["logprob"], input_feed)
+
+
+  def step(self, AA_id_1, AA_id_2, intensity, c_state, h_state):
+    """Return (logprob, (c_state, h_state)) in one run."""
+
+    input_feed = {self.input_dict["AAid"][0]: AA_id_1,
+                  self.input_dict["AAid"][1]: AA_id_2,
+                  self.input_dict["intensity"]: intensity,
+                  self.input_dict["lstm_state"][0]: c_state,
+                  self.input_dict["lstm_state"][1]: h_state}
+    return self.session.run([self.output["logprob"],
+                             self.output["lstm_state"]],
+                            input_feed)
@@ -0,0 +1,156 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Streaming access to MS2 spectra in mzML(.gz) files.
+
+Spectra are yielded one at a time so that memory stays bounded by a single
+spectrum (or a single decoding stack), whatever the size of the run.
+pyteomics is only needed when an mzML file is actually read.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import os
+import time
+
+import deepnovo_spectrum_store
+
+
+MZML_SUFFIXES = (".mzML.gz", ".mzML")
+# charge written when the precursor has no charge state
+UNKNOWN_CHARGE = 999
+
+
+def is_mzml(input_file):
+  """Return True if input_file is an mzML or mzML.gz file."""
+
+  return input_file.endswith(MZML_SUFFIXES)
+
+
+def mzml_name(input_file):
+  """Return the basename of input_file without its .mzML(.gz) suffix."""
+
+  name = os.path.basename(input_file)
+  for suffix in MZML_SUFFIXES:
+    if name.endswith(suffix):
+      return name[:-len(suffix)]
+  return name
+
+
+def mzml_file_index(input_files):
+  """Return {input_file: file_index} for the mzML(.gz) files of input_files.
+
+     mzml2kaiko.py numbers the sorted .mzML (or .mzML.gz) files of a folder
+     from 0, the file_index goes into the TITLE and SCANS ids of their
+     spectra. The same numbering is used here whatever other files are in
+     input_files, so that a spectrum gets the same id whether its mzML file
+     is converted first or decoded directly.
+  """
+
+  file_index = {}
+  for suffix in MZML_SUFFIXES:
+    mzml_files = sorted(x for x in input_files if x.endswith(suffix))
+    for i, input_file in enumerate(mzml_files):
+      file_index[input_file] = i
+  return file_index
+
+
+def parse_ms2_spectrum(spectrum, file_index=0):
+  """Extract the MGF fields of a pyteomics mzML spectrum.
+
+     Returns None if the spectrum is not MS2, otherwise a dict with the keys
+     title, scan, pepmass, charge, rtinseconds, mz, intensity, following the
+     MGF files written by mzml2kaiko.py.
+  """
+
+  if spectrum['ms level'] != 2:
+    return None
+  scan = int(spectrum['id'].split('scan=')[1])
+  selected_ion = (spectrum['precursorList']['precursor'][0]
+                  ['selectedIonList']['selectedIon'][0])
+  mz = spectrum['m/z array']
+  intensity = spectrum['intensity array']
+  assert len(mz) == len(intensity), "[ERR] Wrong data format: len(mz_arr) != len(int_arr)"
+  if 'charge state' in selected_ion:
+    charge = int(selected_ion['charge state'])
+  else:
+    charge = UNKNOWN_CHARGE
+  return {"title": "{0}.{1}".format(file_index, scan),
+          "scan": "{0}:{1}".format(file_index, scan),
+          "pepmass": selected_ion['selected ion m/z'],
+          "charge": charge,
+          "rtinseconds": 60.0 * spectrum['scanList']['scan'][0]['scan start time'],
+          "mz": mz,
+          "intensity": intensity}
+
+
+def iter_ms2_spectra(input_file, file_index=0):
+  """Yield the MS2 spectra of input_file one by one, see parse_ms2_spectrum."""
+
+  from pyteomics import mzml
+
+  if input_file.endswith(".gz"):
+    file_handle = gzip.open(input_file, 'rb')
+  else:
+    file_handle = open(input_file, 'rb')
+  with file_handle:
+    for spectrum in mzml.read(file_handle):
+      try:
+        ms2_spectrum = parse_ms2_spectrum(spectrum, file_index)
+      except (KeyError, IndexError, AssertionError) as e:
+        print('[ERR]', spectrum.get('id'), e)
+        continue
+      if ms2_spectrum is not None:
+        yield ms2_spectrum
+
+
+def iter_spectrum_stacks(input_file, stack_size, file_index=0):
+  """Yield in-memory SpectrumStack objects of up to stack_size MS2 spectra."""
+
+  stack = deepnovo_spectrum_store.SpectrumStack()
+  for spectrum in iter_ms2_spectra(input_file, file_index):
+    stack.append(scan=spectrum["scan"],
+                 pepmass=spectrum["pepmass"],
+                 charge=spectrum["charge"],
+                 rtinseconds=spectrum["rtinseconds"],
+                 seq="",
+                 mz=spectrum["mz"],
+                 intensity=spectrum["intensity"])
+    if len(stack) == stack_size:
+      yield stack
+      stack = deepnovo_spectrum_store.SpectrumStack()
+  if len(stack) > 0:
+    yield stack
+
+
+def convert_mzml(input_file, store_dir, file_index=0):
+  """Stream the MS2 spectra of input_file into a spectrum store.
+
+     Returns the number of spectra written.
+  """
+
+  print("convert_mzml(), {0} -> {1}".format(input_file, store_dir))
+
+  start_time = time.time()
+  num_spectra = 0
+  with deepnovo_spectrum_store.SpectrumStoreWriter(store_dir) as writer:
+    for spectrum in iter_ms2_spectra(input_file, file_index):
+      writer.append(scan=spectrum["scan"],
+                    pepmass=spectrum["pepmass"],
+                    charge=spectrum["charge"],
+                    rtinseconds=spectrum["rtinseconds"],
+                    seq="",
+                    mz=spectrum["mz"],
+                    intensity=spectrum["intensity"])
+      num_spectra += 1
+  run_time = time.time() - start_time
+  print("  {0:d} spectra, {1:.2f} s, {2:.1f} spectra/s".format(
+      num_spectra,
+      run_time,
+      num_spectra / max(run_time, 1e-9)))
+  return num_spectra
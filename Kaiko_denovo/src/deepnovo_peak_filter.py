@@ -0,0 +1,115 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Peak picking to drop low-intensity noise peaks from spectra.
+
+The filter can be applied when spectra are converted (mzml2kaiko.py) or when
+they are read for decoding/training (see the peak_* flags in deepnovo_config).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class PeakFilter(object):
+  """Keep the most intense peaks of a spectrum.
+
+     A peak is kept if it passes all the enabled rules:
+       min_intensity_ratio: intensity >= ratio * the base peak intensity,
+       window_top_k: it is among the k most intense peaks of its
+                     window_size (Da) m/z window,
+       top_n: it is among the n most intense peaks of the spectrum
+              (applied after the two rules above).
+     A rule set to None (or 0) is disabled. Kept peaks stay in their original
+     m/z order. The filter counts the spectra and peaks seen and kept.
+  """
+
+
+  def __init__(self,
+               top_n=None,
+               window_top_k=None,
+               window_size=100.0,
+               min_intensity_ratio=None):
+    """The rules are given as in the class docstring, 0 disables a rule."""
+
+    self.top_n = top_n or None
+    self.window_top_k = window_top_k or None
+    self.window_size = window_size
+    self.min_intensity_ratio = min_intensity_ratio or None
+    self.spectrum_count = 0
+    self.peak_count = 0
+    self.peak_count_kept = 0
+
+
+  @property
+  def enabled(self):
+    return (self.top_n is not None
+            or self.window_top_k is not None
+            or self.min_intensity_ratio is not None)
+
+
+  @property
+  def peak_count_dropped(self):
+    return self.peak_count - self.peak_count_kept
+
+
+  def keep_mask(self, mz, intensity):
+    """Return a boolean mask of the peaks to keep."""
+
+    peak_count = len(intensity)
+    keep = np.ones(peak_count, dtype=bool)
+    if peak_count == 0:
+      return keep
+
+    if self.min_intensity_ratio is not None:
+      keep &= intensity >= self.min_intensity_ratio * intensity.max()
+
+    if self.window_top_k is not None:
+      window = np.floor(mz / self.window_size).astype(np.int64)
+      # sort by window, then by decreasing intensity, and rank inside windows
+      order = np.lexsort((-intensity, window))
+      sorted_window = window[order]
+      window_start = np.flatnonzero(np.r_[True, sorted_window[1:] != sorted_window[:-1]])
+      window_length = np.diff(np.r_[window_start, peak_count])
+      rank = np.arange(peak_count) - np.repeat(window_start, window_length)
+      keep[order[rank >= self.window_top_k]] = False
+
+    if self.top_n is not None and np.count_nonzero(keep) > self.top_n:
+      candidates = np.flatnonzero(keep)
+      top = np.argpartition(-intensity[candidates], self.top_n - 1)[:self.top_n]
+      keep[:] = False
+      keep[candidates[top]] = True
+
+    return keep
+
+
+  def filter(self, mz, intensity):
+    """Return the (mz, intensity) arrays of the kept peaks."""
+
+    mz = np.asarray(mz)
+    intensity = np.asarray(intensity)
+    self.spectrum_count += 1
+    self.peak_count += len(mz)
+    if self.enabled:
+      keep = self.keep_mask(mz, intensity)
+      mz = mz[keep]
+      intensity = intensity[keep]
+    self.peak_count_kept += len(mz)
+    return mz, intensity
+
+
+  def summary(self):
+    """Return a one-line report of the peaks dropped so far."""
+
+    return ("peak filter: {0:d} spectra, {1:d}/{2:d} peaks kept,"
+            " {3:d} dropped ({4:.1f}%)".format(
+                self.spectrum_count,
+                self.peak_count_kept,
+                self.peak_count,
+                self.peak_count_dropped,
+                100.0 * self.peak_count_dropped / max(self.peak_count, 1)))
@@ -0,0 +1,146 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Run a producer generator in a worker process, ahead of its consumer.
+
+multi_decode() uses it to read and pre-process the next spectrum stacks while
+the current one is decoded. The worker is started with "spawn" so that it
+does not inherit the TensorFlow session of the decoding process.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import time
+import traceback
+
+from six.moves import queue
+
+
+def _produce(generator_function, args, item_queue):
+  """Worker process: put the items of generator_function(*args) on item_queue.
+
+     The last message is ("done", seconds blocked on a full queue), or
+     ("error", traceback) if the generator raised.
+  """
+
+  put_wait = 0.0
+  try:
+    for item in generator_function(*args):
+      start_time = time.time()
+      item_queue.put(("item", item))
+      put_wait += time.time() - start_time
+  except BaseException:
+    item_queue.put(("error", traceback.format_exc()))
+  else:
+    item_queue.put(("done", put_wait))
+
+
+class Prefetcher(object):
+  """Iterate the items of generator_function(*args) computed in a worker.
+
+     The worker runs at most depth items ahead of the consumer (a bounded
+     queue). The consumer records how long it stalled waiting for an item and
+     the queue depth at each item, the worker how long it was blocked on a full
+     queue; see summary().
+     generator_function must be importable by the worker, i.e. a module-level
+     function, and its items picklable.
+  """
+
+
+  def __init__(self, generator_function, args=(), depth=2):
+    """The worker is started by start() or by the first iteration."""
+
+    self.generator_function = generator_function
+    self.args = args
+    self.depth = depth
+    self.process = None
+    self.item_queue = None
+    self.item_count = 0
+    self.stall_time = 0.0
+    self.queue_depth_sum = 0
+    self.producer_wait = None
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def start(self):
+    """Start the worker process."""
+
+    context = multiprocessing.get_context("spawn")
+    self.item_queue = context.Queue(maxsize=self.depth)
+    self.process = context.Process(target=_produce,
+                                   args=(self.generator_function,
+                                         self.args,
+                                         self.item_queue))
+    self.process.daemon = True
+    self.process.start()
+
+
+  def _get(self):
+    """Wait for the next message of the worker, check that it is alive."""
+
+    while True:
+      try:
+        return self.item_queue.get(timeout=1.0)
+      except queue.Empty:
+        if not self.process.is_alive():
+          raise RuntimeError("Prefetcher: worker exited with code {0}".format(
+              self.process.exitcode))
+
+
+  def __iter__(self):
+    if self.process is None:
+      self.start()
+    while True:
+      try:
+        self.queue_depth_sum += self.item_queue.qsize()
+      except NotImplementedError: # e.g. macOS
+        pass
+      start_time = time.time()
+      message, value = self._get()
+      self.stall_time += time.time() - start_time
+      if message == "item":
+        self.item_count += 1
+        yield value
+      elif message == "done":
+        self.producer_wait = value
+        self.close()
+        return
+      else:
+        self.close()
+        raise RuntimeError("Prefetcher: worker failed\n" + value)
+
+
+  def close(self):
+    """Stop the worker process."""
+
+    if self.process is not None:
+      if self.process.is_alive():
+        self.process.terminate()
+      self.process.join()
+      self.process = None
+
+
+  def summary(self):
+    """Return a one-line report of the prefetching."""
+
+    text = ("prefetch: {0:d} items, consumer stalled {1:.2f} s,"
+            " average queue depth {2:.2f}/{3:d}".format(
+                self.item_count,
+                self.stall_time,
+                self.queue_depth_sum / max(self.item_count, 1),
+                self.depth))
+    if self.producer_wait is not None:
+      text += ", producer blocked {0:.2f} s".format(self.producer_wait)
+    return text
@@ -0,0 +1,314 @@
+# Copyright 2017 Hieu Tran. All Rights Reserved.
+#
+# DeepNovo is publicly available for non-commercial uses.
+# ==============================================================================
+
+"""Columnar binary spectrum store, an alternative to text MGF input.
+
+A store is a directory "<name>.kspec" holding
+  mz.bin, intensity.bin: all peaks of all spectra as flat float32 arrays,
+  offsets.npy: int64 array of size n+1, peaks of spectrum i are
+               [offsets[i], offsets[i+1]),
+  scan.npy, pepmass.npy, charge.npy, rtinseconds.npy, seq.npy: metadata,
+  store.json: format version and counts.
+The peak arrays are opened with np.memmap, so reading a spectrum is a slice.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import deepnovo_mgf_io
+
+
+STORE_SUFFIX = ".kspec"
+STORE_VERSION = 1
+PEAK_DTYPE = np.dtype("<f4")
+
+
+def is_store(path):
+  """Return True if path is a spectrum store directory."""
+
+  return os.path.isfile(os.path.join(path, "store.json"))
+
+
+def store_name(input_file):
+  """Return the default store path of an input (e.g. mgf) file."""
+
+  return os.path.splitext(input_file)[0] + STORE_SUFFIX
+
+
+class SpectrumStoreWriter(object):
+  """Stream spectra into a new store.
+
+     Peaks are appended to the flat arrays as they come, only the small
+     metadata columns are kept in memory. The store is written into a
+     temporary directory and renamed on close(), so a store is never seen
+     half-written.
+  """
+
+
+  def __init__(self, store_dir):
+    """Open the peak files of store_dir in a fresh temporary directory."""
+
+    self.store_dir = store_dir
+    self.temp_dir = "{0}.{1:d}.tmp".format(store_dir, os.getpid())
+    if os.path.exists(self.temp_dir):
+      shutil.rmtree(self.temp_dir)
+    os.makedirs(self.temp_dir)
+
+    self.mz_handle = open(os.path.join(self.temp_dir, "mz.bin"), "wb")
+    self.intensity_handle = open(os.path.join(self.temp_dir, "intensity.bin"),
+                                 "wb")
+    self.offsets = [0]
+    self.scan = []
+    self.pepmass = []
+    self.charge = []
+    self.rtinseconds = []
+    self.seq = []
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+
+  def append(self, scan, pepmass, charge, rtinseconds, seq, mz, intensity):
+    """Append one spectrum, seq is "" if the peptide is unknown."""
+
+    mz = np.asarray(mz, dtype=PEAK_DTYPE)
+    intensity = np.asarray(intensity, dtype=PEAK_DTYPE)
+    assert mz.shape == intensity.shape, "Error: mz/intensity size mismatch"
+    self.mz_handle.write(mz.tobytes())
+    self.intensity_handle.write(intensity.tobytes())
+    self.offsets.append(self.offsets[-1] + mz.size)
+    self.scan.append(scan)
+    self.pepmass.append(pepmass)
+    self.charge.append(charge)
+    self.rtinseconds.append(rtinseconds)
+    self.seq.append(seq)
+
+
+  def close(self):
+    """Write the metadata and move the store into place."""
+
+    self.mz_handle.close()
+    self.intensity_handle.close()
+    columns = {"offsets": np.array(self.offsets, dtype=np.int64),
+               "scan": np.array(self.scan, dtype=np.str_),
+               "pepmass": np.array(self.pepmass, dtype=np.float64),
+               "charge": np.array(self.charge, dtype=np.float64),
+               "rtinseconds": np.array(self.rtinseconds, dtype=np.float64),
+               "seq": np.array(self.seq, dtype=np.str_)}
+    for name, column in columns.items():
+      np.save(os.path.join(self.temp_dir, name + ".npy"), column)
+    with open(os.path.join(self.temp_dir, "store.json"), "w") as handle:
+      json.dump({"version": STORE_VERSION,
+                 "spectrum_count": len(self.scan),
+                 "peak_count": self.offsets[-1]},
+                handle)
+    if os.path.exists(self.store_dir):
+      shutil.rmtree(self.store_dir)
+    os.rename(self.temp_dir, self.store_dir)
+
+
+  def abort(self):
+    """Discard a partially written store."""
+
+    self.mz_handle.close()
+    self.intensity_handle.close()
+    shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+class SpectrumStore(object):
+  """Read-only access to a spectrum store.
+
+     Spectra are addressed by their index in the store, which plays the role
+     of the file location of an MGF spectrum.
+  """
+
+
+  def __init__(self, store_dir):
+    """Load the metadata columns of store_dir and memory-map its peaks."""
+
+    self.store_dir = store_dir
+    with open(os.path.join(store_dir, "store.json")) as handle:
+      info = json.load(handle)
+    assert info["version"] == STORE_VERSION, "Error: unknown store version"
+    self.spectrum_count = info["spectrum_count"]
+    self.peak_count = info["peak_count"]
+
+    self.offsets = np.load(os.path.join(store_dir, "offsets.npy"))
+    self.scan = np.load(os.path.join(store_dir, "scan.npy"))
+    self.pepmass = np.load(os.path.join(store_dir, "pepmass.npy"))
+    self.charge = np.load(os.path.join(store_dir, "charge.npy"))
+    self.rtinseconds = np.load(os.path.join(store_dir, "rtinseconds.npy"))
+    self.seq = np.load(os.path.join(store_dir, "seq.npy"))
+    # np.memmap cannot map an empty file
+    if self.peak_count > 0:
+      self.mz = np.memmap(os.path.join(store_dir, "mz.bin"),
+                          dtype=PEAK_DTYPE,
+                          mode="r")
+      self.intensity = np.memmap(os.path.join(store_dir, "intensity.bin"),
+                                 dtype=PEAK_DTYPE,
+                                 mode="r")
+    else:
+      self.mz = np.zeros(0, dtype=PEAK_DTYPE)
+      self.intensity = np.zeros(0, dtype=PEAK_DTYPE)
+
+
+  def __len__(self):
+    return self.spectrum_count
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def close(self):
+    """Release the memory maps."""
+
+    self.mz = None
+    self.intensity = None
+
+
+  def get_location(self):
+    """Return the locations of all spectra, i.e. their indices."""
+
+    return list(range(self.spectrum_count))
+
+
+  def get_peaks(self, location, mz_max=None):
+    """Return (mz, intensity) float32 arrays of the spectrum at location."""
+
+    start = self.offsets[location]
+    end = self.offsets[location + 1]
+    # plain arrays rather than memmap slices for the numba kernels
+    mz = np.array(self.mz[start:end])
+    intensity = np.array(self.intensity[start:end])
+    if mz_max is not None:
+      mask = mz <= mz_max
+      mz = mz[mask]
+      intensity = intensity[mask]
+    return mz, intensity
+
+
+  def get_header(self, location):
+    """Return the metadata of the spectrum at location as an MGF header dict."""
+
+    # the store keeps no TITLE, the scan id is used instead
+    header_dict = {"TITLE": str(self.scan[location]),
+                   "PEPMASS": repr(float(self.pepmass[location])),
+                   "CHARGE": repr(float(self.charge[location])),
+                   "SCANS": str(self.scan[location]),
+                   "RTINSECONDS": repr(float(self.rtinseconds[location]))}
+    if self.seq[location]:
+      header_dict["SEQ"] = str(self.seq[location])
+    return header_dict
+
+
+  def read_spectrum(self, location, mz_max=None):
+    """Same as deepnovo_mgf_io.read_spectrum() for a store."""
+
+    mz, intensity = self.get_peaks(location, mz_max)
+    return self.get_header(location), mz, intensity
+
+
+class SpectrumStack(SpectrumStore):
+  """An in-memory SpectrumStore, filled by append() like SpectrumStoreWriter.
+
+     Used to feed streamed spectra (e.g. from mzML) to read_spectra() one
+     stack at a time without writing them to disk.
+  """
+
+
+  def __init__(self):
+    """Start an empty stack, its peaks are kept as lists of arrays."""
+
+    self.store_dir = None
+    self.spectrum_count = 0
+    self.peak_count = 0
+    self.mz = []
+    self.intensity = []
+    self.scan = []
+    self.pepmass = []
+    self.charge = []
+    self.rtinseconds = []
+    self.seq = []
+
+
+  def append(self, scan, pepmass, charge, rtinseconds, seq, mz, intensity):
+    """Append one spectrum, seq is "" if the peptide is unknown."""
+
+    mz = np.asarray(mz, dtype=PEAK_DTYPE)
+    intensity = np.asarray(intensity, dtype=PEAK_DTYPE)
+    assert mz.shape == intensity.shape, "Error: mz/intensity size mismatch"
+    self.mz.append(mz)
+    self.intensity.append(intensity)
+    self.scan.append(scan)
+    self.pepmass.append(pepmass)
+    self.charge.append(charge)
+    self.rtinseconds.append(rtinseconds)
+    self.seq.append(seq)
+    self.spectrum_count += 1
+    self.peak_count += mz.size
+
+
+  def close(self):
+    """Nothing to release."""
+
+    pass
+
+
+  def get_peaks(self, location, mz_max=None):
+    """Return (mz, intensity) float32 arrays of the spectrum at location."""
+
+    mz = self.mz[location]
+    intensity = self.intensity[location]
+    if mz_max is not None:
+      mask = mz <= mz_max
+      mz = mz[mask]
+      intensity = intensity[mask]
+    return mz, intensity
+
+
+def convert_mgf(mgf_file, store_dir=None):
+  """Convert an MGF file into a spectrum store, return the store path."""
+
+  if store_dir is None:
+    store_dir = store_name(mgf_file)
+  print("convert_mgf(), {0} -> {1}".format(mgf_file, store_dir))
+
+  start_time = time.time()
+  index = deepnovo_mgf_io.get_index(mgf_file)
+  with open(mgf_file, "rb") as file_handle:
+    with SpectrumStoreWriter(store_dir) as writer:
+      for i, location in enumerate(index["offsets"].tolist()):
+        _, mz, intensity = deepnovo_mgf_io.read_spectrum(file_handle, location)
+        writer.append(scan=index["scans"][i],
+                      pepmass=index["precursor_mz"][i],
+                      charge=index["charge"][i],
+                      rtinseconds=index["rtinseconds"][i],
+                      seq=index["seq"][i],
+                      mz=mz,
+                      intensity=intensity)
+  print("  {0:d} spectra, {1:.2f} s".format(len(index["offsets"]),
+                                            time.time() - start_time))
+  return store_dir
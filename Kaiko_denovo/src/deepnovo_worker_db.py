@@ -20,7 +20,8 @@ import numpy as np
 import tensorflow as tf
 
 import deepnovo_config
-from deepnovo_debug import get_candidate_intensity
+from deepnovo_debug import sparsify_spectrum, pack_sparse_spectra
+from deepnovo_debug import get_candidate_intensity_batch
 # from deepnovo_cython_modules import get_candidate_intensity
 
 
@@ -139,7 +140,7 @@ class WorkerDB(object):
         denovo_peptide_dict[scan] = sequence
 
     print("WorkerDB: search_db() - open tensorflow session")
-    session = tf.compat.v1.Session()
+    session = tf.compat.v1.Session(config=deepnovo_config.session_config(inference=True))
     model.restore_model(session)
 
     worker_io.open_input()
@@ -164,6 +165,8 @@ class WorkerDB(object):
     print("  read: {0:d}".format(worker_io.spectrum_count["read"]))
     print("  skipped: {0:d}".format(worker_io.spectrum_count["skipped"]))
     print("    by mass: {0:d}".format(worker_io.spectrum_count["skipped_mass"]))
+    if deepnovo_config.peak_filter.enabled:
+      print("  " + deepnovo_config.peak_filter.summary())
 
     worker_io.close_input()
     worker_io.close_output()
@@ -290,6 +293,14 @@ class WorkerDB(object):
     # mass of each candidate, will be accumulated everytime an AA is appended
     minibatch_prefix_mass = np.zeros(minibatch_size)
 
+    # all candidates read the same spectrum, packed once for the batch kernel
+    (spectrum_location,
+     spectrum_intensity,
+     spectrum_offset) = pack_sparse_spectra([sparsify_spectrum(spectrum_original)])
+    minibatch_spectrum_index = np.zeros(minibatch_size, dtype=np.int64)
+    minibatch_precursor_mass = np.full(minibatch_size, precursor_mass, dtype=np.float64)
+    minibatch_direction = np.full(minibatch_size, direction, dtype=np.int64)
+
     # output is a list of candidate_len arrays of shape [minibatch_size, 26]
     # each row is log of probability distribution over 26 classes/symbols
     output_logprob_list = []
@@ -303,14 +314,16 @@ class WorkerDB(object):
         AA = candidate[position]
         minibatch_AA_id[index] = AA
         minibatch_prefix_mass[index] += deepnovo_config.mass_ID[AA]
-      # this is the most time-consuming ~70-75%
-      minibatch_intensity = [get_candidate_intensity(spectrum_original,
-                                                     precursor_mass,
-                                                     prefix_mass,
-                                                     direction)
-                             for prefix_mass in np.nditer(minibatch_prefix_mass)]
+      # this used to be the most time-consuming ~70-75%, now one call
       # final shape [minibatch_size, 26, 8, 10]
-      minibatch_intensity = np.array(minibatch_intensity)
+      minibatch_intensity = get_candidate_intensity_batch(
+          spectrum_location,
+          spectrum_intensity,
+          spectrum_offset,
+          minibatch_spectrum_index,
+          minibatch_precursor_mass,
+          minibatch_prefix_mass,
+          minibatch_direction)
 
       # model feed
       input_feed = {}
@@ -21,6 +21,7 @@ import numpy as np
 import tensorflow as tf
 
 import deepnovo_config
+import deepnovo_knapsack
 
 from deepnovo_debug import get_candidate_intensity
 # from deepnovo_cython_modules import get_candidate_intensity
@@ -94,7 +95,7 @@ class WorkerDenovo(object):
       self.knapsack_matrix = self._build_knapsack()
 
     print("WorkerDenovo: search_denovo() - open tensorflow session")
-    session = tf.compat.v1.Session()
+    session = tf.compat.v1.Session(config=deepnovo_config.session_config(inference=True))
     model.restore_model(session)
 
     worker_io.open_input()
@@ -117,6 +118,8 @@ class WorkerDenovo(object):
     print("  read: {0:d}".format(worker_io.spectrum_count["read"]))
     print("  skipped: {0:d}".format(worker_io.spectrum_count["skipped"]))
     print("    by mass: {0:d}".format(worker_io.spectrum_count["skipped_mass"]))
+    if deepnovo_config.peak_filter.enabled:
+      print("  " + deepnovo_config.peak_filter.summary())
 
     worker_io.close_input()
     worker_io.close_output()
@@ -143,39 +146,15 @@ class WorkerDenovo(object):
     # allow error tolerance up to 1 Dalton
     max_mass_upperbound = max_mass_round + self.KNAPSACK_AA_RESOLUTION
 
-    knapsack_matrix = np.zeros(shape=(self.vocab_size, max_mass_upperbound),
-                               dtype=bool)
+    # the dynamic programming of the columns is vectorized, see
+    #   deepnovo_knapsack.build_column_mask()
+    column_mask = deepnovo_knapsack.build_column_mask(
+        max_mass_upperbound,
+        mass_ID=self.mass_ID,
+        resolution=self.KNAPSACK_AA_RESOLUTION)
+    knapsack_matrix = deepnovo_knapsack.unpack_columns(column_mask,
+                                                       self.vocab_size)
 
-    # fill up the knapsack_matrix by rows and columns, using dynamic programming
-    for AAid in xrange(3, self.vocab_size): # excluding PAD, GO, EOS
-
-      mass_AA = int(round(self.mass_ID[AAid] * self.KNAPSACK_AA_RESOLUTION))
-
-      for col in xrange(max_mass_upperbound):
-  
-        # col 0 ~ mass 1
-        # col + 1 = mass
-        # col = mass - 1
-        current_mass = col + 1
-  
-        if current_mass < mass_AA:
-          knapsack_matrix[AAid, col] = False
-
-        elif current_mass == mass_AA:
-          knapsack_matrix[AAid, col] = True
-
-        elif current_mass > mass_AA:
-          sub_mass = current_mass - mass_AA
-          sub_col = sub_mass - 1
-          # check if the sub_mass can be formed by a combination of amino acids
-          # TODO(nh2tran): change np.sum to np.any
-          if np.sum(knapsack_matrix[:, sub_col]) > 0:
-            knapsack_matrix[AAid, col] = True
-            knapsack_matrix[:, col] = np.logical_or(knapsack_matrix[:, col],
-                                                    knapsack_matrix[:, sub_col])
-          else:
-            knapsack_matrix[AAid, col] = False
-  
     np.save(self.knapsack_file, knapsack_matrix)
     return knapsack_matrix
 
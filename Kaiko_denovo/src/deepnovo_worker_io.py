@@ -9,11 +9,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import re
-
 import deepnovo_config
+import deepnovo_mgf_io
+import deepnovo_spectrum_store
 
 from deepnovo_debug import get_candidate_intensity
+from deepnovo_debug import iter_process_spectrum_stack
 # from deepnovo_cython_modules import process_spectrum
 
 
@@ -40,6 +41,8 @@ class WorkerIO(object):
 
     self.input_file = input_file
     self.output_file = output_file
+    # the input_file could also be a binary spectrum store (.kspec)
+    self.input_store = deepnovo_spectrum_store.is_store(input_file)
     print("input_file = {0:s}".format(self.input_file))
     print("output_file = {0:s}".format(self.output_file))
     # keep the file handles open throughout the process to read/write batches
@@ -84,6 +87,8 @@ class WorkerIO(object):
     #~ print("WorkerIO: get_spectrum()")
 
     spectrum_list = []
+    mz_batch = []
+    intensity_batch = []
     for location in location_batch:
 
       # parse a spectrum
@@ -102,20 +107,30 @@ class WorkerIO(object):
         continue
       self.spectrum_count["read"] += 1
 
-      # pre-process spectrum
-      (spectrum_holder,
-       spectrum_original_forward,
-       spectrum_original_backward) = process_spectrum(mz_list,
-                                                      intensity_list,
-                                                      precursor_mass)
+      # peak picking, see the peak_* flags
+      if deepnovo_config.peak_filter.enabled:
+        mz_list, intensity_list = deepnovo_config.peak_filter.filter(
+            mz_list,
+            intensity_list)
 
       # update dataset
       spectrum = {"scan": scan,
-                  "precursor_mass": precursor_mass,
-                  "spectrum_holder": spectrum_holder,
-                  "spectrum_original_forward": spectrum_original_forward,
-                  "spectrum_original_backward": spectrum_original_backward}
+                  "precursor_mass": precursor_mass}
       spectrum_list.append(spectrum)
+      mz_batch.append(mz_list)
+      intensity_batch.append(intensity_list)
+
+    # pre-process the spectra of the batch in one call
+    spectra_iterator = iter_process_spectrum_stack(
+        mz_batch,
+        intensity_batch,
+        [spectrum["precursor_mass"] for spectrum in spectrum_list])
+    for spectrum, (spectrum_holder,
+                   spectrum_original_forward,
+                   spectrum_original_backward) in zip(spectrum_list, spectra_iterator):
+      spectrum["spectrum_holder"] = spectrum_holder
+      spectrum["spectrum_original_forward"] = spectrum_original_forward
+      spectrum["spectrum_original_backward"] = spectrum_original_backward
 
     return spectrum_list
 
@@ -126,14 +141,11 @@ class WorkerIO(object):
     print("".join(["="] * 80)) # section-separating line
     print("WorkerIO: get_location()")
 
-    location_list = []
-    keyword = "BEGIN IONS"
-    line = True
-    while line:
-      location = self.input_handle.tell()
-      line = self.input_handle.readline()
-      if keyword in line:
-        location_list.append(location)
+    if self.input_store:
+      location_list = self.input_handle.get_location()
+    else:
+      index = deepnovo_mgf_io.get_index(self.input_file)
+      location_list = index["offsets"].tolist()
 
     self.location_list = location_list
     self.spectrum_count["total"] = len(location_list)
@@ -145,7 +157,10 @@ class WorkerIO(object):
     print("".join(["="] * 80)) # section-separating line
     print("WorkerIO: open_input()")
 
-    self.input_handle = open(self.input_file, 'r')
+    if self.input_store:
+      self.input_handle = deepnovo_spectrum_store.SpectrumStore(self.input_file)
+    else:
+      self.input_handle = open(self.input_file, 'rb')
 
 
   def open_output(self):
@@ -203,72 +218,63 @@ class WorkerIO(object):
     #~ print("".join(["="] * 80)) # section-separating line
     #~ print("WorkerIO: _parse_spectrum()")
 
-    self.input_handle.seek(location)
-    # BEGIN IONS
-    line = self.input_handle.readline()
-    assert "BEGIN IONS" in line, "Error: wrong input BEGIN IONS"
-    precursor_mz, charge, scan, raw_sequence = self._parse_spectrum_header()
-    mz_list, intensity_list = self._parse_spectrum_ion()
+    if self.input_store:
+      header_dict, mz_list, intensity_list = self.input_handle.read_spectrum(
+          location,
+          self.MZ_MAX)
+      precursor_mz, charge, scan, raw_sequence = self._parse_spectrum_header(
+          header_dict)
+    else:
+      # read the whole spectrum block, from BEGIN IONS to END IONS
+      block = deepnovo_mgf_io.read_spectrum_block(self.input_handle, location)
+      assert block.startswith(b"BEGIN IONS"), "Error: wrong input BEGIN IONS"
+      header_dict, peak_start = deepnovo_mgf_io.parse_header(block)
+      precursor_mz, charge, scan, raw_sequence = self._parse_spectrum_header(
+          header_dict)
+      mz_list, intensity_list = self._parse_spectrum_ion(block, peak_start)
 
     return precursor_mz, charge, scan, raw_sequence, mz_list, intensity_list
 
 
-  def _parse_spectrum_header(self):
+  def _parse_spectrum_header(self, header_dict):
     """TODO(nh2tran): docstring."""
 
     #~ print("".join(["="] * 80)) # section-separating line
     #~ print("WorkerIO: _parse_spectrum_header()")
 
     # header TITLE
-    line = self.input_handle.readline()
-    assert "TITLE=" in line, "Error: wrong input TITLE"
+    assert "TITLE" in header_dict, "Error: wrong input TITLE"
     # header PEPMASS
-    line = self.input_handle.readline()
-    assert "PEPMASS=" in line, "Error: wrong input PEPMASS"
-    precursor_mz = float(re.split('=|\n', line)[1])
+    assert "PEPMASS" in header_dict, "Error: wrong input PEPMASS"
+    precursor_mz = float(header_dict["PEPMASS"].split(" ")[0])
     # header CHARGE
-    line = self.input_handle.readline()
-    assert "CHARGE=" in line, "Error: wrong input CHARGE"
-    charge = float(re.split('=|\+', line)[1])
+    assert "CHARGE" in header_dict, "Error: wrong input CHARGE"
+    charge = float(header_dict["CHARGE"].split("+")[0])
     # header SCANS
-    line = self.input_handle.readline()
-    assert "SCANS=" in line, "Error: wrong input SCANS"
-    scan = re.split('=|\n', line)[1]
+    assert "SCANS" in header_dict, "Error: wrong input SCANS"
+    scan = header_dict["SCANS"]
     # header RTINSECONDS
-    line = self.input_handle.readline()
-    assert "RTINSECONDS=" in line, "Error: wrong input RTINSECONDS"
+    assert "RTINSECONDS" in header_dict, "Error: wrong input RTINSECONDS"
     # header SEQ
     if self.header_seq:
-      line = self.input_handle.readline()
-      assert "SEQ=" in line, "Error: wrong input SEQ"
-      raw_sequence = re.split('=|\n', line)[1]
+      assert "SEQ" in header_dict, "Error: wrong input SEQ"
+      raw_sequence = header_dict["SEQ"]
     else:
       raw_sequence = ""
 
     return precursor_mz, charge, scan, raw_sequence
 
 
-  def _parse_spectrum_ion(self):
+  def _parse_spectrum_ion(self, block, peak_start):
     """TODO(nh2tran): docstring."""
 
     #~ print("".join(["="] * 80)) # section-separating line
     #~ print("WorkerIO: _parse_spectrum_ion()")
 
-    # ion
-    mz_list = []
-    intensity_list = []
-    line = self.input_handle.readline()
-    while not "END IONS" in line:
-      mz, intensity = re.split(' |\n', line)[:2]
-      mz_float = float(mz)
-      intensity_float = float(intensity)
-      # skip an ion if its mass > MZ_MAX
-      if mz_float > self.MZ_MAX:
-        line = self.input_handle.readline()
-        continue
-      mz_list.append(mz_float)
-      intensity_list.append(intensity_float)
-      line = self.input_handle.readline()
+    # ion, skip an ion if its mass > MZ_MAX
+    mz_list, intensity_list = deepnovo_mgf_io.parse_peaks(block,
+                                                          peak_start,
+                                                          self.MZ_MAX)
 
     return mz_list, intensity_list
 
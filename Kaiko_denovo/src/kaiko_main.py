@@ -24,6 +24,12 @@ def main(_):
 
   if deepnovo_config.FLAGS.knapsack_build:
     deepnovo_main_modules.knapsack_build()
+  elif deepnovo_config.FLAGS.build_spectrum_store:
+    deepnovo_main_modules.build_spectrum_stores()
+  elif deepnovo_config.FLAGS.export_frozen_model:
+    deepnovo_main_modules.export_frozen_model()
+  elif deepnovo_config.FLAGS.benchmark_stages:
+    deepnovo_main_modules.benchmark_stages()
   elif deepnovo_config.FLAGS.train:
     deepnovo_main_modules.train()
   elif deepnovo_config.FLAGS.test_true_feeding:
@@ -40,7 +46,7 @@ def main(_):
   elif deepnovo_config.FLAGS.sigopt:
     deepnovo_main_modules.sigopt()
   elif deepnovo_config.FLAGS.search_denovo:
-    model = deepnovo_model.ModelInference()
+    model = deepnovo_model.inference_model()
     model.build_model()
     worker_io = deepnovo_worker_io.WorkerIO(
         input_file=deepnovo_config.denovo_input_file,
@@ -48,7 +54,7 @@ def main(_):
     worker_denovo = deepnovo_worker_denovo.WorkerDenovo()
     worker_denovo.search_denovo(model, worker_io)
   elif deepnovo_config.FLAGS.search_db:
-    model = deepnovo_model.ModelInference()
+    model = deepnovo_model.inference_model()
     model.build_model()
     worker_io = deepnovo_worker_io.WorkerIO(
         input_file=deepnovo_config.db_input_file,
@@ -57,7 +63,7 @@ def main(_):
     worker_db.build_db()
     worker_db.search_db(model, worker_io)
   elif deepnovo_config.FLAGS.search_hybrid:
-    model = deepnovo_model.ModelInference()
+    model = deepnovo_model.inference_model()
     model.build_model()
     # denovo search
     worker_io = deepnovo_worker_io.WorkerIO(
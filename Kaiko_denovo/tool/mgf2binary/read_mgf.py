@@ -1,4 +1,10 @@
-import re
+import os
+import sys
+
+# share the spectrum locator with the decoder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "src"))
+import deepnovo_mgf_io
 
 vocab_reverse = ['A',
                  'R',
@@ -70,22 +76,14 @@ PRECURSOR_MASS_PRECISION_INPUT_FILTER = 100
 
 def inspect_mgf_location(input_file):
 	print("inspect_mgf_location(), input_file = ", input_file)
-	keyword = "BEGIN IONS"
-	spectra_file_location = []
-	with open(input_file, mode="r") as file_handle:
-		line = True
-		while line:
-			file_location = file_handle.tell()
-			line = file_handle.readline()
-			if keyword in line:
-				spectra_file_location.append(file_location)
+	spectra_file_location = deepnovo_mgf_io.locate_spectra(input_file).tolist()
 	print('find # spectra_locations:', len(spectra_file_location))
 	return spectra_file_location
 
 
 def read_mgf(input_file):
 	spectra_locations = inspect_mgf_location(input_file)
-	file_handle = open(input_file, mode="r")
+	file_handle = open(input_file, mode="rb")
 	data_set = []
 
 	counter = 0
@@ -101,39 +99,22 @@ def read_mgf(input_file):
 	keyword = "BEGIN IONS"
 
 	for location in spectra_locations:
-		file_handle.seek(location)
-		line = file_handle.readline()
-		assert (keyword in line), "ERROR: read_spectra(); wrong format"
+		header_dict, block, peak_start = deepnovo_mgf_io.read_header(
+			file_handle, location)
 
 		unknown_modification = False
 		unknown_AA = False
 
-		# header TITLE
-		line = file_handle.readline()
-
-		# header PEPMASS
-		line = file_handle.readline()
-		peptide_ion_mz = float(re.split('=|\n', line)[1])
-
-		# header CHARGE
-		line = file_handle.readline()
-		charge = float(re.split('=|\+', line)[1])
+		peptide_ion_mz = float(header_dict['PEPMASS'].split(' ')[0])
+		charge = float(header_dict['CHARGE'].split('+')[0])
 
 		# compute peptide_mass
 		peptide_mass = peptide_ion_mz*charge - charge*mass_H
 
-		# header SCANS
-		line = file_handle.readline()
-		scan = re.split('=|\n', line)[1]
-
+		scan = header_dict['SCANS']
 		scan_number = scan.split(':')[1]
 
-		# header RTINSECONDS
-		line = file_handle.readline()
-
-		# header SEQ
-		line = file_handle.readline()
-		raw_sequence = re.split('=|\n|\r', line)[1]
+		raw_sequence = header_dict['SEQ']
 		
 		###########################
 		## for unknown sequences ##
@@ -209,20 +190,10 @@ def read_mgf(input_file):
 				continue
 
 		# read spectrum
-		spectrum_mz = []
-		spectrum_intensity = []
-		line = file_handle.readline()
-		while not "END IONS" in line:
-			# parse pairs of "mz intensity"
-			mz, intensity = re.split(' |\n', line)[:2]
-			intensity_float = float(intensity)
-			mz_float = float(mz)
-			if mz_float > MZ_MAX: # skip this peak
-				line = file_handle.readline()
-				continue
-			spectrum_mz.append(mz_float)
-			spectrum_intensity.append(intensity_float)
-			line = file_handle.readline()
+		spectrum_mz, spectrum_intensity = deepnovo_mgf_io.parse_peaks(
+			block, peak_start, MZ_MAX)
+		spectrum_mz = spectrum_mz.tolist()
+		spectrum_intensity = spectrum_intensity.tolist()
 
 		data_set.append((scan_number, peptide_mass, spectrum_mz, spectrum_intensity, peptide))
 	
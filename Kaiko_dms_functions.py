@@ -10,6 +10,11 @@ import argparse
 from pathlib import PureWindowsPath, Path
 from pyteomics import mzml, auxiliary
 
+# share the mgf writer and the peak filter with the decoder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Kaiko_denovo', 'src'))
+import deepnovo_mgf_io
+import deepnovo_peak_filter
+
 def get_request_dataset_paths(job_req_id):
     cnxn = pyodbc.connect("DRIVER={SQL Server};SERVER=gigasax;DATABASE=dms5;")
     # cnxn = pyodbc.connect(f"DRIVER={pyodbc.drivers()[0]};SERVER=gigasax;DATABASE=dms5;")
@@ -51,19 +56,21 @@ def get_request_dataset_paths(job_req_id):
 
 
 def inspect_mzML_file(fpath, gzipped=True):
-    spectra = []
+    # yield spectra one at a time, so that memory does not grow with the run size
     if gzipped:
         f = gzip.open(fpath, 'rb')
     else:
-        f = fpath
-    for obj in mzml.read(f):
-        spectra.append(obj)
-    if gzipped: f.close()
-    return spectra
-
-def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=500, out_file='out.mgf'):
+        f = open(fpath, 'rb')
+    with f:
+        for obj in mzml.read(f):
+            yield obj
+
+def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=None, out_file='out.mgf', precision=None, peak_filter=None):
+    # ntops: keep the ntops most intense peaks, peak_filter: any other peak picking
+    if peak_filter is None:
+        peak_filter = deepnovo_peak_filter.PeakFilter(top_n=ntops)
     num_spectra = 0
-    with open(out_file, 'w') as f:
+    with open(out_file, 'w') as f, deepnovo_mgf_io.MgfWriter(f, precision=precision) as writer:
         for spectrum in mzml_spectra:
             if spectrum['ms level'] != 2:
                 continue
@@ -76,29 +83,28 @@ def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=500, out_f
                 selectedIon = spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]
 
                 assert len(mz_arr) == len(int_arr), "[ERR] Wrong data format: len(mz_arr) != len(int_arr)"
+                mz_arr, int_arr = peak_filter.filter(mz_arr, int_arr)
 
-                print("BEGIN IONS", file=f)
-                print("TITLE={0}.{1}".format(file_index, scan), file=f)
-                print("PEPMASS={0}".format(selectedIon['selected ion m/z']), file=f)
                 # sometimes they don't have a charge info. if so, we use the annotation file
                 if 'charge state' in selectedIon:
-                    print("CHARGE={0:d}+".format(int(selectedIon['charge state'])), file=f)
+                    charge = int(selectedIon['charge state'])
                 else:
-                    print("CHARGE={0:d}+".format(999), file=f)
-                print("SCANS={0}:{1}".format(file_index, scan), file=f)
-                print("RTINSECONDS={0}".format(rtsec), file=f)
-                print("SEQ=UNKNOWN", file=f)
-                for i in range(len(mz_arr)):
-                    print("{0} {1}".format(mz_arr[i], int_arr[i]), file=f)
-                print("END IONS", file=f)
+                    charge = 999
+                header = [("TITLE", "{0}.{1}".format(file_index, scan)),
+                          ("PEPMASS", selectedIon['selected ion m/z']),
+                          ("CHARGE", "{0:d}+".format(charge)),
+                          ("SCANS", "{0}:{1}".format(file_index, scan)),
+                          ("RTINSECONDS", rtsec),
+                          ("SEQ", "UNKNOWN")]
+                writer.write_spectrum(header, mz_arr, int_arr)
                 num_spectra += 1
             except:
                 print('[ERR]', scan, spectrum)
                 continue
                     
-        return num_spectra
+    return num_spectra
 
-def generate_mgf_files(data_dir, dest_dir = './', dataset_pattern = '', gzipped = True):
+def generate_mgf_files(data_dir, dest_dir = './', dataset_pattern = '', gzipped = True, precision = None):
     # collect mzML.gz files
     if dataset_pattern != '':
         if gzipped:
@@ -135,21 +141,24 @@ def generate_mgf_files(data_dir, dest_dir = './', dataset_pattern = '', gzipped
                 continue
 
             num_spectra = 0
+            file_start_time = time.time()
             mzml_spectra = inspect_mzML_file(mzML_file, gzipped)
             num_spectra = generate_mgf_without_annotation(mzml_spectra,
                                                             file_index=f'{dataset_pattern}--{i}',
-                                                            out_file=dest_dir + '/' + common_name + '.mgf')
+                                                            out_file=dest_dir + '/' + common_name + '.mgf',
+                                                            precision=precision)
             num_scans = num_spectra
             total_scans += num_spectra
             msg = "SUCCESS"
-            print('[{0:3d}/{1:3d}] {2}, {3:d}/{4:d}/{5:d}, {6:.2f}sec' \
+            print('[{0:3d}/{1:3d}] {2}, {3:d}/{4:d}/{5:d}, {6:.2f}sec, {7:.1f} spectra/sec' \
                       .format(i+1,
                               num_mzML_files,
                               common_name,
                               num_spectra,
                               num_scans,
                               total_scans,
-                              time.time()-start_time))
+                              time.time()-start_time,
+                              num_spectra/max(time.time()-file_start_time, 1e-9)))
             print("{0}\t{1}\t{2}\t{3}".format(i, common_name, num_spectra, total_scans), file=mzML_log_handler)
             sys.stdout.flush()
         except Exception as e:
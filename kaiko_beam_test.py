@@ -0,0 +1,110 @@
+import sys
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_beam
+
+class TestBeam(unittest.TestCase):
+
+    def test_path_tree(self):
+        ## A small capacity makes add() grow the arrays.
+        path_tree = deepnovo_beam.PathTree(capacity = 2)
+        root = path_tree.add([-1, -1], [1, 2])
+        self.assertEqual(root.tolist(), [0, 1])
+        child = path_tree.add([root[0], root[0], root[1]], [3, 4, 5])
+        grandchild = path_tree.add([child[1], child[2]], [6, 7])
+        self.assertEqual(path_tree.size, 7)
+        self.assertEqual(path_tree.path(root[1]), [2])
+        self.assertEqual(path_tree.path(child[0]), [1, 3])
+        self.assertEqual(path_tree.path(grandchild[0]), [1, 4, 6])
+        self.assertEqual(path_tree.path(grandchild[1]), [2, 5, 7])
+
+    def test_beam_append(self):
+        beam = deepnovo_beam.Beam(max_paths = 4, num_units = 3)
+        beam.append(spectrum_id = [0, 0],
+                    node = [5, 6],
+                    AA_id_1 = 1,
+                    AA_id_2 = [3, 4],
+                    prefix_mass = [1.5, 2.5],
+                    score = 0.0,
+                    c_state = np.ones((2, 3)),
+                    h_state = np.zeros((2, 3)))
+        beam.append(spectrum_id = [1],
+                    node = [7],
+                    AA_id_1 = 2,
+                    AA_id_2 = [5],
+                    prefix_mass = [3.5],
+                    score = [-1.0],
+                    c_state = np.full((1, 3), 2.0),
+                    h_state = np.full((1, 3), 3.0))
+        self.assertEqual(beam.size, 3)
+        self.assertEqual(beam.spectrum_id[:beam.size].tolist(), [0, 0, 1])
+        self.assertEqual(beam.AA_id_1[:beam.size].tolist(), [1, 1, 2])
+        self.assertEqual(beam.prefix_mass[:beam.size].tolist(), [1.5, 2.5, 3.5])
+        self.assertEqual(beam.score[:beam.size].tolist(), [0.0, 0.0, -1.0])
+        self.assertEqual(beam.c_state[2].tolist(), [2.0, 2.0, 2.0])
+        self.assertEqual(deepnovo_beam.segment_starts(beam.spectrum_id[:beam.size]).tolist(), [0, 2])
+
+        ## The arrays are preallocated, more than max_paths paths is an error.
+        with self.assertRaises(AssertionError):
+            beam.append(spectrum_id = [2, 2],
+                        node = [8, 9],
+                        AA_id_1 = 1,
+                        AA_id_2 = [3, 4],
+                        prefix_mass = [1.5, 2.5],
+                        score = 0.0,
+                        c_state = np.ones((2, 3)),
+                        h_state = np.zeros((2, 3)))
+
+        beam.clear()
+        self.assertEqual(beam.size, 0)
+        self.assertEqual(deepnovo_beam.segment_starts(beam.spectrum_id[:beam.size]).tolist(), [])
+
+    def test_select_top_paths(self):
+        rng = np.random.default_rng(0)
+        vocab_size, beam_size = 26, 5
+        ## 4 spectra of 3, 5, 1 and 2 paths.
+        spectrum_id = np.repeat([0, 1, 2, 3], [3, 5, 1, 2])
+        path_count = len(spectrum_id)
+        ## Distinct scores, so that the top beam_size of a spectrum is unique.
+        scores = rng.permutation(path_count * (vocab_size + 1)).astype(np.float64) * 0.01
+        path_score = -scores[:path_count]
+        candidate_score = -scores[path_count:].reshape(path_count, vocab_size)
+        candidate_mask = rng.random((path_count, vocab_size)) < 0.3
+        ## A path without candidates, and a spectrum with fewer candidates than beam_size.
+        candidate_mask[1] = False
+        candidate_mask[8] = False
+        candidate_mask[8, [3, 7]] = True
+        candidate_mask[9:] = False
+
+        path_index, AA_id, score = deepnovo_beam.select_top_paths(path_score,
+                                                                  candidate_score,
+                                                                  candidate_mask,
+                                                                  spectrum_id,
+                                                                  beam_size)
+
+        ## Reference: np.argpartition() of the new paths of each spectrum on its own.
+        reference = set()
+        for spectrum in range(4):
+            paths = np.flatnonzero(spectrum_id == spectrum)
+            new_path = [(path, aa_id, path_score[path] + candidate_score[path, aa_id])
+                        for path in paths for aa_id in np.flatnonzero(candidate_mask[path])]
+            if len(new_path) > beam_size:
+                new_score = np.array([x[2] for x in new_path])
+                new_path = [new_path[x] for x in np.argpartition(-new_score, beam_size)[:beam_size]]
+            reference.update(new_path)
+
+        selected = set(zip(path_index.tolist(), AA_id.tolist(), score.tolist()))
+        self.assertEqual(selected, set((int(x[0]), int(x[1]), float(x[2])) for x in reference))
+        self.assertEqual(len(selected), len(path_index))
+        ## Ordered by spectrum, at most beam_size per spectrum.
+        self.assertTrue(np.all(np.diff(spectrum_id[path_index]) >= 0))
+        self.assertEqual(np.bincount(spectrum_id[path_index], minlength = 4).tolist(), [5, 5, 2, 0])
+        self.assertNotIn(1, path_index.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
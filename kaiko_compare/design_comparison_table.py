@@ -3,29 +3,34 @@ this script is focused on minimizing the parsing and putting together
 a comparison between the target sequence and what the two models,
 kaiko and casanovo predicts
 """
-from pyteomics import mgf
 from pyteomics import mztab
 import pandas as pd
 import numpy as np
+import os
 import sys
 
+# reuse the decoder's sidecar MGF index instead of re-parsing every spectrum
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "Kaiko_denovo", "src"))
+import deepnovo_mgf_io
+
 
 def aggregate_kaiko_casanovo(mgf_path, kaiko_path, casanovo_path, output_path):
     # path below: path\to\mgf_file
     # mgf_file_path = sys.argv[1] # "C:\\Users\\leej179\\git\\kaiko_metaproteome\\Kaiko_volume\\Kaiko_input_files\\mgf_large_unit_test\\Biodiversity_A_cryptum_FeTSB_anaerobic_1_01Jun16_Pippin_16-03-39_unit_test_prop_0.005_seed_6969.mgf"
-    # read a mgf file
-    mgf_data = mgf.read(mgf_path, use_index=True)
-
-    # extract the precursor info from mgf_data as a dataframe
-    precursors = [d['params'] for d in mgf_data]
-    df = pd.DataFrame.from_records(precursors)
+    # read the precursor info of a mgf file from its (cached) index
+    mgf_index = deepnovo_mgf_io.get_index(mgf_path)
+    df = pd.DataFrame({
+        'scans': mgf_index['scans'],
+        'pepmass': mgf_index['precursor_mz'],
+        # get a integer for a charge value
+        'charge': mgf_index['charge'].astype(int),
+        'rtinseconds': mgf_index['rtinseconds'],
+        'seq': mgf_index['seq'],
+    })
 
     # create an index column
     df.reset_index(inplace=True)
-    # select the first element in a pepmass tuple
-    df['pepmass'] = df['pepmass'].apply(lambda x: x[0])
-    # get a integer for a charge value from the charge list
-    df['charge'] = df['charge'].apply(lambda x: int(x[0]))
 
     # path below: path\to\text_file
     # kaiko_output_path = sys.argv[2] # 'C:\\Users\\leej179\\git\\kaiko_metaproteome\\Kaiko_volume\\Kaiko_intermediate\\denovo_output\\mgf_large_unit_test\\Biodiversity_A_cryptum_FeTSB_anaerobic_1_01Jun16_Pippin_16-03-39_unit_test_prop_0.005_seed_6969_out.txt'
@@ -0,0 +1,167 @@
+import sys
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_config
+import deepnovo_debug
+
+def make_spectra(count, seed = 0):
+    ## Random spectra with the peaks below the peptide mass, like read_spectra() keeps them.
+    rng = np.random.default_rng(seed)
+    mz_list = []
+    intensity_list = []
+    peptide_mass_list = []
+    for index in range(count):
+        peptide_mass = rng.uniform(600.0, 2900.0)
+        peak_count = int(rng.integers(0, 150)) if index % 7 else 0
+        mz_list.append(np.sort(rng.uniform(50.0, peptide_mass, peak_count)).astype(np.float32))
+        intensity_list.append(rng.uniform(1.0, 1e5, peak_count).astype(np.float32))
+        peptide_mass_list.append(peptide_mass)
+    return mz_list, intensity_list, peptide_mass_list
+
+def peak_location(mz):
+    neutral_mass = np.asarray(mz, dtype = np.float32) - np.float32(deepnovo_config.mass_H)
+    return np.rint(neutral_mass * np.float32(deepnovo_config.SPECTRUM_RESOLUTION)).astype(np.int32)
+
+class TestSparseSpectrum(unittest.TestCase):
+
+    def check_sparse(self, sparse_spectra, dense_spectra):
+        for (location, intensity), spectrum in zip(sparse_spectra, dense_spectra):
+            self.assertTrue(np.all(np.diff(location) > 0))
+            self.assertTrue(np.all(intensity != 0.0))
+            np.testing.assert_array_equal(deepnovo_debug.densify_spectrum((location, intensity)), spectrum)
+
+    def test_process_spectrum_sparse(self):
+        for mz, intensity, peptide_mass in zip(*make_spectra(30)):
+            self.check_sparse(deepnovo_debug.process_spectrum_sparse(mz, intensity, peptide_mass),
+                              deepnovo_debug.process_spectrum(mz, intensity, peptide_mass))
+
+    def test_candidate_intensity_sparse(self):
+        rng = np.random.default_rng(1)
+        for mz, intensity, peptide_mass in zip(*make_spectra(8)):
+            (_,
+             spectrum_original_forward,
+             spectrum_original_backward) = deepnovo_debug.process_spectrum(mz, intensity, peptide_mass)
+            ## Prefix masses from the N-terminal to past the peptide mass, where the windows leave the spectrum.
+            prefix_mass_list = np.r_[0.0, rng.uniform(0.0, peptide_mass, 10), peptide_mass, deepnovo_config.MZ_MAX - 1.0]
+            for direction, spectrum_original in enumerate([spectrum_original_forward, spectrum_original_backward]):
+                location, location_intensity = deepnovo_debug.sparsify_spectrum(spectrum_original)
+                for prefix_mass in prefix_mass_list:
+                    np.testing.assert_array_equal(
+                        deepnovo_debug.get_candidate_intensity_sparse(location, location_intensity,
+                                                                      peptide_mass, prefix_mass, direction),
+                        deepnovo_debug.get_candidate_intensity(spectrum_original, peptide_mass, prefix_mass, direction))
+
+    def test_location_past_mz_size(self):
+        ## The peptide_mass and peptide_mass_N bins of a precursor heavier than MZ_MAX, and the complement
+        ## of a peak below 1 Da, are at or above MZ_SIZE: they are dropped (numpy raised an IndexError).
+        mz = np.array([1.5, 500.0, 1200.0], dtype = np.float32)
+        intensity = np.array([10.0, 40.0, 20.0], dtype = np.float32)
+        peptide_mass = deepnovo_config.MZ_MAX + 5.0
+        (spectrum_holder,
+         spectrum_original_forward,
+         spectrum_original_backward) = deepnovo_debug.process_spectrum(mz, intensity, peptide_mass)
+        mass_C = deepnovo_config.mass_C_terminus + deepnovo_config.mass_H
+        location_C = int(np.rint((peptide_mass - mass_C) * deepnovo_config.SPECTRUM_RESOLUTION))
+        self.assertLess(location_C, deepnovo_config.MZ_SIZE)
+        self.assertEqual(np.flatnonzero(spectrum_original_forward).tolist(), sorted(peak_location(mz).tolist() + [location_C]))
+        self.assertEqual(np.flatnonzero(spectrum_original_backward).tolist(), peak_location(mz).tolist())
+        self.assertEqual(spectrum_holder[location_C], 1.0)
+
+        ## Nothing is written into the next spectrum of a stack.
+        light_mz, light_intensity, light_peptide_mass = make_spectra(2)
+        stack = deepnovo_debug.process_spectrum_stack([mz] + light_mz, [intensity] + light_intensity,
+                                                      [peptide_mass] + light_peptide_mass)
+        sparse_stack = deepnovo_debug.process_spectrum_stack_sparse([mz] + light_mz, [intensity] + light_intensity,
+                                                                    [peptide_mass] + light_peptide_mass)
+        for spectrum, row in zip([spectrum_holder, spectrum_original_forward, spectrum_original_backward], stack):
+            np.testing.assert_array_equal(row[0], spectrum)
+        for index in range(2):
+            spectra = deepnovo_debug.process_spectrum(light_mz[index], light_intensity[index], light_peptide_mass[index])
+            for spectrum, row in zip(spectra, stack):
+                np.testing.assert_array_equal(row[index + 1], spectrum)
+        for index, sparse_spectra in enumerate(sparse_stack):
+            self.check_sparse(sparse_spectra, [row[index] for row in stack])
+
+class TestCandidateIntensityBatch(unittest.TestCase):
+
+    def test_batch_rows(self):
+        ## A block of paths over several spectra, the forward and backward paths mixed as in a beam search step.
+        rng = np.random.default_rng(2)
+        mz_list, intensity_list, peptide_mass_list = make_spectra(5, seed = 3)
+        dense_spectra = []
+        sparse_spectra = []
+        for mz, intensity, peptide_mass in zip(mz_list, intensity_list, peptide_mass_list):
+            _, forward, backward = deepnovo_debug.process_spectrum(mz, intensity, peptide_mass)
+            dense_spectra += [forward, backward]
+            sparse_spectra += [deepnovo_debug.sparsify_spectrum(forward), deepnovo_debug.sparsify_spectrum(backward)]
+        spectrum_location, spectrum_intensity, spectrum_offset = deepnovo_debug.pack_sparse_spectra(sparse_spectra)
+
+        block_size = 40
+        direction = rng.integers(0, 2, block_size)
+        spectrum_id = rng.integers(0, len(mz_list), block_size)
+        spectrum_index = 2 * spectrum_id + direction
+        peptide_mass = np.array(peptide_mass_list)[spectrum_id]
+        prefix_mass = rng.uniform(0.0, 1.0, block_size) * peptide_mass
+        candidate_intensity = deepnovo_debug.get_candidate_intensity_batch(spectrum_location,
+                                                                           spectrum_intensity,
+                                                                           spectrum_offset,
+                                                                           spectrum_index,
+                                                                           peptide_mass,
+                                                                           prefix_mass,
+                                                                           direction)
+        self.assertEqual(candidate_intensity.shape, (block_size, deepnovo_config.vocab_size,
+                                                     deepnovo_config.num_ion, deepnovo_config.WINDOW_SIZE))
+        self.assertEqual(sorted(set(direction.tolist())), [0, 1])
+        for path_id in range(block_size):
+            np.testing.assert_array_equal(candidate_intensity[path_id],
+                                          deepnovo_debug.get_candidate_intensity(dense_spectra[spectrum_index[path_id]],
+                                                                                 float(peptide_mass[path_id]),
+                                                                                 float(prefix_mass[path_id]),
+                                                                                 int(direction[path_id])))
+
+class TestSpectrumStack(unittest.TestCase):
+
+    def test_stack_kernels(self):
+        ## A stack larger than PROCESS_CHUNK_SIZE, so iter_process_spectrum_stack() processes it in 3 chunks.
+        mz_list, intensity_list, peptide_mass_list = make_spectra(600, seed = 4)
+        self.assertEqual(deepnovo_debug.PROCESS_CHUNK_SIZE, 256)
+        spectrum_list = [deepnovo_debug.process_spectrum(mz, intensity, peptide_mass)
+                         for mz, intensity, peptide_mass in zip(mz_list, intensity_list, peptide_mass_list)]
+
+        stack = deepnovo_debug.process_spectrum_stack(mz_list, intensity_list, peptide_mass_list)
+        for row in stack:
+            self.assertEqual(row.shape, (len(spectrum_list), deepnovo_config.MZ_SIZE))
+        for index, spectra in enumerate(spectrum_list):
+            for spectrum, row in zip(spectra, stack):
+                np.testing.assert_array_equal(row[index], spectrum)
+
+        sparse_stack = deepnovo_debug.process_spectrum_stack_sparse(mz_list, intensity_list, peptide_mass_list)
+        self.assertEqual(len(sparse_stack), len(spectrum_list))
+        for sparse_spectra, spectra in zip(sparse_stack, spectrum_list):
+            for sparse_spectrum, spectrum in zip(sparse_spectra, spectra):
+                np.testing.assert_array_equal(deepnovo_debug.densify_spectrum(sparse_spectrum), spectrum)
+
+        for sparse in [False, True]:
+            iter_spectra = list(deepnovo_debug.iter_process_spectrum_stack(mz_list, intensity_list, peptide_mass_list,
+                                                                           sparse = sparse))
+            self.assertEqual(len(iter_spectra), len(spectrum_list))
+            for processed_spectra, spectra in zip(iter_spectra, spectrum_list):
+                for processed_spectrum, spectrum in zip(processed_spectra, spectra):
+                    if sparse:
+                        processed_spectrum = deepnovo_debug.densify_spectrum(processed_spectrum)
+                    np.testing.assert_array_equal(processed_spectrum, spectrum)
+
+        ## A chunk size that does not divide the stack.
+        iter_spectra = deepnovo_debug.iter_process_spectrum_stack(mz_list, intensity_list, peptide_mass_list,
+                                                                  chunk_size = 37)
+        for processed_spectra, spectra in zip(iter_spectra, spectrum_list):
+            for processed_spectrum, spectrum in zip(processed_spectra, spectra):
+                np.testing.assert_array_equal(processed_spectrum, spectrum)
+
+
+if __name__ == '__main__':
+    unittest.main()
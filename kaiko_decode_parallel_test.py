@@ -0,0 +1,75 @@
+import io
+import sys
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_main_modules
+
+class FakeResult(object):
+    ## An AsyncResult that becomes ready once ready_at tasks have been submitted.
+
+    def __init__(self, pool, task, ready_at):
+        self.pool = pool
+        self.task = task
+        self.ready_at = ready_at
+
+    def ready(self):
+        return self.pool.submit_count >= self.ready_at
+
+    def get(self):
+        ## A real get() blocks until the stack is decoded.
+        self.pool.done.append(self.task)
+        self.pool.pending_count -= 1
+        input_file, _, stack = self.task
+        return "{0}:{1}\n".format(input_file, stack), (input_file, stack)
+
+class FakePool(object):
+    ## The stacks complete out of order: each one is ready after a random number of later submissions.
+
+    def __init__(self, seed):
+        self.rng = np.random.default_rng(seed)
+        self.submit_count = 0
+        self.pending_count = 0
+        self.max_pending = 0
+        self.function = None
+        self.done = []
+
+    def apply_async(self, function, args):
+        self.function = function
+        self.submit_count += 1
+        self.pending_count += 1
+        self.max_pending = max(self.max_pending, self.pending_count)
+        return FakeResult(self, args[0], self.submit_count + int(self.rng.integers(0, 6)))
+
+class TestDecodeStacksParallel(unittest.TestCase):
+
+    def test_merge_order(self):
+        stack_tasks = [("a.mgf", None, x) for x in range(7)] + [("b.mzML", None, x) for x in range(5)]
+        for num_workers in [1, 2, 3, 8]:
+            for seed in range(5):
+                decode_pool = FakePool(seed)
+                output_file_handle = io.StringIO()
+                stack_results = list(deepnovo_main_modules.decode_stacks_parallel(decode_pool,
+                                                                                 num_workers,
+                                                                                 iter(stack_tasks),
+                                                                                 output_file_handle))
+                self.assertIs(decode_pool.function, deepnovo_main_modules.decode_stack_task)
+                self.assertEqual(stack_results, [(input_file, stack) for input_file, _, stack in stack_tasks])
+                self.assertEqual(output_file_handle.getvalue(),
+                                 "".join("{0}:{1}\n".format(input_file, stack) for input_file, _, stack in stack_tasks))
+                self.assertEqual(decode_pool.done, stack_tasks)
+                self.assertLessEqual(decode_pool.max_pending, 2 * num_workers)
+
+    def test_fake_pool(self):
+        ## The fake pool does complete some later stacks before earlier ones.
+        decode_pool = FakePool(0)
+        ready_at = [decode_pool.apply_async(deepnovo_main_modules.decode_stack_task, (("a.mgf", None, x),)).ready_at
+                    for x in range(10)]
+        self.assertTrue(any(x > y for x, y in zip(ready_at, ready_at[1:])))
+
+
+if __name__ == '__main__':
+    unittest.main()
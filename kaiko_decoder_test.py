@@ -0,0 +1,200 @@
+import sys
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_config
+import deepnovo_knapsack
+import deepnovo_main_modules
+
+## The beam search decoder is checked against a plain list-based beam search, both driven by a mock model.
+## The mock model computes every row of a step on its own, so a path gets the same scores in any batch.
+
+knapsack_resolution = 100
+knapsack_precision = 1
+spectrum_count = 10
+decode_block_size = 4
+
+class MockTensor:
+    def __init__(self, name):
+        self.name = name
+
+class MockModel:
+    def __init__(self, fused = True):
+        self.input_dict = {"AAid": [MockTensor("AA_id_1"), MockTensor("AA_id_2")],
+                           "intensity": MockTensor("intensity"),
+                           "lstm_state": (MockTensor("c_state"), MockTensor("h_state")),
+                           "spectrum": MockTensor("spectrum")}
+        if fused:
+            self.input_dict["forward_size"] = MockTensor("forward_size")
+        self.output_forward = {"logprob": "forward/logprob", "lstm_state": "forward/lstm_state", "lstm_state0": "forward/lstm_state0"}
+        self.output_backward = {"logprob": "backward/logprob", "lstm_state": "backward/lstm_state", "lstm_state0": "backward/lstm_state0"}
+
+class MockSession:
+    def __init__(self, seed = 0):
+        rng = np.random.default_rng(seed)
+        vocab_size = deepnovo_config.vocab_size
+        self.weights = rng.standard_normal((2, 3, vocab_size, vocab_size))
+        self.encoder = rng.standard_normal((2, vocab_size))
+        self.step_count = 0
+
+    def step(self, direction, AA_id_1, AA_id_2, intensity, c_state, h_state):
+        weights = self.weights[direction]
+        intensity = intensity.sum(axis = (2, 3))
+        logit = (weights[0][AA_id_1] + weights[1][AA_id_2] + 0.1 * intensity
+                 + c_state.astype(np.float64) - h_state.astype(np.float64))
+        logprob = logit - np.log(np.exp(logit).sum(axis = 1, keepdims = True))
+        return [logprob.astype(np.float32),
+                (np.tanh(0.5 * c_state + 0.1 * logit).astype(np.float32),
+                 np.tanh(0.5 * h_state - 0.1 * logit).astype(np.float32))]
+
+    def encode(self, direction, spectrum):
+        vocab_size = deepnovo_config.vocab_size
+        spectrum = spectrum[:, :vocab_size * 1000].reshape(len(spectrum), vocab_size, 1000).sum(axis = 2)
+        state0 = np.tanh(spectrum * self.encoder[direction])
+        return (state0.astype(np.float32), (0.5 * state0).astype(np.float32))
+
+    def run(self, fetches, feed_dict):
+        if "spectrum" in feed_dict:
+            return [self.encode(0 if fetch.startswith("forward") else 1, feed_dict["spectrum"])
+                    for fetch in fetches]
+        self.step_count += 1
+        inputs = [feed_dict[name] for name in ("AA_id_1", "AA_id_2", "intensity", "c_state", "h_state")]
+        forward_size = feed_dict.get("forward_size", -1)
+        output = []
+        for fetch in fetches:
+            direction = 0 if fetch[0].startswith("forward") else 1
+            if forward_size < 0:
+                rows = slice(None)
+            elif direction == 0:
+                rows = slice(None, forward_size)
+            else:
+                rows = slice(forward_size, None)
+            output.append(self.step(direction, *[x[rows] for x in inputs]))
+        return output
+
+def make_data_set(seed = 0):
+    ## [scan, spectrum_holder, spectrum_original_forward, spectrum_original_backward, peptide_mass] of random peptides.
+    rng = np.random.default_rng(seed)
+    mass_ID = deepnovo_config.mass_ID
+    data_set = []
+    for spectrum_id in range(spectrum_count):
+        peptide = rng.integers(3, deepnovo_config.vocab_size, rng.integers(4, 9))
+        peptide_mass = (sum(mass_ID[x] for x in peptide)
+                        + mass_ID[deepnovo_config.GO_ID] + mass_ID[deepnovo_config.EOS_ID])
+        spectra = []
+        for _ in range(3):
+            location = np.sort(rng.choice(20000, 50, replace = False)).astype(np.int32)
+            spectra.append((location, rng.random(50).astype(np.float32)))
+        data_set.append(["scan_{a1}".format(a1 = spectrum_id)] + spectra + [peptide_mass])
+    return data_set
+
+def reference_beam_search(session, knapsack_matrix, direction, prefix_mass, spectrum_original, peptide_mass,
+                          c_state0, h_state0, beam_size):
+    ## The beam search of one spectrum with lists of [AA ids, prefix mass, score, c_state, h_state] paths.
+    mass_ID = deepnovo_config.mass_ID
+    FIRST_LABEL = [deepnovo_config.GO_ID, deepnovo_config.EOS_ID][direction]
+    LAST_LABEL = [deepnovo_config.EOS_ID, deepnovo_config.GO_ID][direction]
+    location, intensity, offset = deepnovo_main_modules.pack_sparse_spectra([spectrum_original])
+    top_paths = []
+    paths = [[[FIRST_LABEL], prefix_mass, 0.0, c_state0, h_state0]]
+    while paths:
+        new_paths = []
+        for AA_ids, path_mass, score, c_state, h_state in paths:
+            if AA_ids[-1] == LAST_LABEL:
+                if abs(path_mass - peptide_mass) <= deepnovo_config.PRECURSOR_MASS_PRECISION_TOLERANCE:
+                    top_paths.append([AA_ids, score, direction])
+                continue
+            candidates = deepnovo_main_modules.knapsack_search(knapsack_matrix,
+                                                               peptide_mass - path_mass - mass_ID[LAST_LABEL],
+                                                               knapsack_precision)
+            if not candidates:
+                candidates = [LAST_LABEL]
+            candidate_intensity = deepnovo_main_modules.get_candidate_intensity_batch(
+                location, intensity, offset, [0], [peptide_mass], [path_mass], [direction])
+            AA_id_1 = AA_ids[-2] if len(AA_ids) > 1 else AA_ids[-1]
+            logprob, (new_c_state, new_h_state) = session.step(direction, np.array([AA_id_1]), np.array([AA_ids[-1]]),
+                                                               candidate_intensity, c_state[np.newaxis], h_state[np.newaxis])
+            for aa_id in candidates:
+                new_score = score + float(logprob[0, aa_id]) if aa_id > 2 else score
+                new_paths.append([AA_ids + [aa_id], path_mass + mass_ID[aa_id], new_score, new_c_state[0], new_h_state[0]])
+        new_paths.sort(key = lambda x: -x[2])
+        paths = new_paths[:beam_size]
+    return top_paths
+
+def canonical(output_top_paths):
+    return [sorted((tuple(path[0]), path[1], path[2]) for path in top_paths) for top_paths in output_top_paths]
+
+class TestDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_config = {name: getattr(deepnovo_config, name)
+                             for name in ("KNAPSACK_AA_RESOLUTION", "mass_AA_min_round", "batch_size")}
+        self.saved_beam_size = deepnovo_config.FLAGS.beam_size
+        deepnovo_config.KNAPSACK_AA_RESOLUTION = knapsack_resolution
+        deepnovo_config.mass_AA_min_round = int(round(deepnovo_config.mass_AA_min * knapsack_resolution))
+        deepnovo_config.batch_size = decode_block_size
+
+        self.data_set = make_data_set()
+        column_count = int(max(x[4] for x in self.data_set) * knapsack_resolution) + knapsack_resolution
+        column_mask = deepnovo_knapsack.build_column_mask(column_count, resolution = knapsack_resolution)
+        self.knapsack_matrix = deepnovo_knapsack.unpack_columns(column_mask, deepnovo_config.vocab_size)
+
+    def tearDown(self):
+        for name, value in self.saved_config.items():
+            setattr(deepnovo_config, name, value)
+        deepnovo_config.FLAGS.beam_size = self.saved_beam_size
+
+    def direction_search(self, session, direction):
+        ## [direction, prefix_mass_list, knapsack_precision, data_set, lstm_state0] starting from GO or EOS.
+        mass_first = deepnovo_config.mass_ID[[deepnovo_config.GO_ID, deepnovo_config.EOS_ID][direction]]
+        data_set = [[x[0], x[1], x[2 + direction], x[4]] for x in self.data_set]
+        lstm_state0 = deepnovo_main_modules.encode_spectra(session, MockModel(), data_set, [direction])[0]
+        return [direction, [mass_first] * len(data_set), knapsack_precision, data_set, lstm_state0]
+
+    def test_beam_search_reference(self):
+        session = MockSession()
+        for beam_size in [1, 5, 20]:
+            deepnovo_config.FLAGS.beam_size = beam_size
+            for direction in [0, 1]:
+                search = self.direction_search(session, direction)
+                output_top_paths = deepnovo_main_modules.decode_beam_search_searches(
+                    session, MockModel(), self.knapsack_matrix, [search])[0]
+                reference_top_paths = [reference_beam_search(session, self.knapsack_matrix, direction, search[1][i],
+                                                             search[3][i][2], search[3][i][3],
+                                                             search[4][0][i], search[4][1][i], beam_size)
+                                       for i in range(spectrum_count)]
+                self.assertEqual(canonical(output_top_paths), canonical(reference_top_paths))
+                self.assertTrue(any(output_top_paths))
+
+    def test_fused_bidirectional(self):
+        deepnovo_config.FLAGS.beam_size = 5
+        saved_fused_bidirectional = deepnovo_config.FLAGS.fused_bidirectional
+        output_top_paths = {}
+        step_count = {}
+        try:
+            ## --nofused_bidirectional, --fused_bidirectional, and a model without the forward_size input.
+            for name, fused_bidirectional, model in [("sequential", False, MockModel()),
+                                                     ("fused", True, MockModel()),
+                                                     ("no_forward_size", True, MockModel(fused = False))]:
+                deepnovo_config.FLAGS.fused_bidirectional = fused_bidirectional
+                session = MockSession()
+                output_top_paths[name] = canonical(deepnovo_main_modules.decode_beam_search_2(
+                    session, model, self.data_set, self.knapsack_matrix))
+                step_count[name] = session.step_count
+        finally:
+            deepnovo_config.FLAGS.fused_bidirectional = saved_fused_bidirectional
+
+        self.assertTrue(any(output_top_paths["sequential"]))
+        self.assertEqual(output_top_paths["fused"], output_top_paths["sequential"])
+        self.assertEqual(output_top_paths["no_forward_size"], output_top_paths["sequential"])
+        ## One sess.run() per step for both directions instead of one per direction.
+        self.assertLess(step_count["fused"], step_count["sequential"])
+        self.assertGreaterEqual(2 * step_count["fused"], step_count["sequential"])
+        self.assertEqual(step_count["no_forward_size"], step_count["sequential"])
+
+
+if __name__ == '__main__':
+    unittest.main()
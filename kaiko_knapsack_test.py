@@ -0,0 +1,126 @@
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_config
+import deepnovo_knapsack
+import deepnovo_main_modules
+
+tolerance_list = [0, 1, 37, 100, 1000]
+
+def reference_knapsack_build(column_count):
+    ## The column by column dynamic programming of the original knapsack_build().
+    knapsack_matrix = np.zeros(shape = (deepnovo_config.vocab_size, column_count), dtype = bool)
+    for aa_id in range(3, deepnovo_config.vocab_size):
+        mass_aa_round = int(round(deepnovo_config.mass_ID[aa_id] * deepnovo_config.KNAPSACK_AA_RESOLUTION))
+        for col in range(column_count):
+            current_mass = col + 1
+            if current_mass == mass_aa_round:
+                knapsack_matrix[aa_id, col] = True
+            if current_mass > mass_aa_round:
+                sub_col = current_mass - mass_aa_round - 1
+                if np.sum(knapsack_matrix[:, sub_col]) > 0:
+                    knapsack_matrix[aa_id, col] = True
+                    knapsack_matrix[:, col] = np.logical_or(knapsack_matrix[:, col], knapsack_matrix[:, sub_col])
+    return knapsack_matrix
+
+class TestKnapsack(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_config = {name: getattr(deepnovo_config, name)
+                             for name in ("KNAPSACK_AA_RESOLUTION", "mass_AA_min_round")}
+
+    def tearDown(self):
+        for name, value in self.saved_config.items():
+            setattr(deepnovo_config, name, value)
+
+    def set_resolution(self, resolution):
+        deepnovo_config.KNAPSACK_AA_RESOLUTION = resolution
+        deepnovo_config.mass_AA_min_round = int(round(deepnovo_config.mass_AA_min * resolution))
+
+    def random_masses(self, rng, column_count, resolution, count = 300):
+        ## Masses below mass_AA_min, inside the matrix and past its last column.
+        upperbound = (deepnovo_config.mass_AA_min_round + column_count + 2000) / resolution
+        return rng.uniform(deepnovo_config.mass_AA_min - 10.0 / resolution, upperbound, count)
+
+    def test_search_index(self):
+        rng = np.random.default_rng(0)
+        vocab_size = deepnovo_config.vocab_size
+        for resolution in [100, 10000]:
+            self.set_resolution(resolution)
+            ## A random sparse matrix from mass_AA_min on.
+            column_count = deepnovo_config.mass_AA_min_round + 3000
+            knapsack_matrix = rng.random((vocab_size, column_count)) < 0.002
+            knapsack_matrix[:3] = False
+            knapsack_matrix[:, :deepnovo_config.mass_AA_min_round - 1] = False
+            knapsack_index = deepnovo_knapsack.KnapsackIndex.from_matrix(knapsack_matrix)
+
+            peptide_mass = self.random_masses(rng, column_count, resolution)
+            for tolerance in tolerance_list:
+                candidate_mask = knapsack_index.candidate_mask(knapsack_index.search_mask(peptide_mass, tolerance))
+                for mass, mask in zip(peptide_mass, candidate_mask):
+                    reference = deepnovo_main_modules.knapsack_search(knapsack_matrix, mass, tolerance)
+                    self.assertEqual(knapsack_index.search(mass, tolerance), reference)
+                    self.assertEqual(np.flatnonzero(mask).tolist(), reference)
+
+            ## A tolerance per mass, with and without precomputed windows.
+            tolerance = rng.choice(tolerance_list + [5, 250], len(peptide_mass))
+            candidate_mask = knapsack_index.candidate_mask(knapsack_index.search_mask(peptide_mass, tolerance))
+            for mass, mass_tolerance, mask in zip(peptide_mass, tolerance, candidate_mask):
+                reference = deepnovo_main_modules.knapsack_search(knapsack_matrix, mass, int(mass_tolerance))
+                self.assertEqual(np.flatnonzero(mask).tolist(), reference)
+            self.assertNotIn(250, knapsack_index.window_mask_dict)
+
+    def test_window_or(self):
+        rng = np.random.default_rng(1)
+        column_mask = rng.integers(0, 1 << 26, 2000, dtype = np.uint32)
+        column_mask[rng.random(2000) < 0.8] = 0
+        for tolerance in tolerance_list:
+            window_mask = deepnovo_knapsack.window_or(column_mask, tolerance)
+            self.assertEqual(len(window_mask), len(column_mask) + tolerance)
+            column = np.arange(len(window_mask))
+            reference = [np.bitwise_or.reduce(column_mask[max(col - tolerance, 0):col + tolerance + 1])
+                         for col in column]
+            self.assertEqual(window_mask.tolist(), [int(x) for x in reference])
+            np.testing.assert_array_equal(deepnovo_knapsack.window_or_at(column_mask, column, tolerance), window_mask)
+
+    def test_build_store(self):
+        ## build_column_mask() against the original loop at a small resolution, up to MZ_MAX.
+        self.set_resolution(10)
+        column_count = deepnovo_knapsack.knapsack_column_count()
+        knapsack_matrix = reference_knapsack_build(column_count)
+        column_mask = deepnovo_knapsack.build_column_mask(column_count)
+        self.assertTrue(knapsack_matrix.any())
+        np.testing.assert_array_equal(column_mask, deepnovo_knapsack.pack_columns(knapsack_matrix))
+        np.testing.assert_array_equal(deepnovo_knapsack.unpack_columns(column_mask, deepnovo_config.vocab_size),
+                                      knapsack_matrix)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            knapsack_file = os.path.join(temp_dir, "knapsack.npy")
+            np.save(knapsack_file, knapsack_matrix)
+            self.assertEqual(deepnovo_knapsack.check_knapsack(knapsack_file, column_mask), 0)
+
+            ## save_store() >> load_knapsack_index(), from the store or from the matrix file next to it.
+            knapsack_index = deepnovo_knapsack.KnapsackIndex(column_mask, deepnovo_config.vocab_size)
+            deepnovo_knapsack.save_store(deepnovo_knapsack.store_name(knapsack_file), knapsack_index)
+            for path in [deepnovo_knapsack.store_name(knapsack_file), knapsack_file]:
+                loaded_index = deepnovo_knapsack.load_knapsack_index(path)
+                self.assertEqual(loaded_index.vocab_size, deepnovo_config.vocab_size)
+                np.testing.assert_array_equal(loaded_index.column_mask, column_mask)
+                self.assertEqual(sorted(loaded_index.window_mask_dict), deepnovo_knapsack.STANDARD_TOLERANCE_LIST)
+                for tolerance in deepnovo_knapsack.STANDARD_TOLERANCE_LIST:
+                    np.testing.assert_array_equal(loaded_index.window_mask_dict[tolerance],
+                                                  knapsack_index.window_mask(tolerance))
+                peptide_mass = self.random_masses(np.random.default_rng(2), column_count, 10)
+                np.testing.assert_array_equal(loaded_index.search_mask(peptide_mass, 3),
+                                              knapsack_index.search_mask(peptide_mass, 3))
+                del loaded_index
+
+
+if __name__ == '__main__':
+    unittest.main()
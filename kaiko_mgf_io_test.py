@@ -0,0 +1,234 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_mgf_io as mgf_io
+
+spectrum_header = (b"BEGIN IONS\n"
+                   b"TITLE=run1.100.100.2 scan=100\n"
+                   b"PEPMASS=500.25\n"
+                   b"CHARGE=2+\n"
+                   b"SEQ=PEPTIDE\n")
+peak_lines = b"100.5 10.0\n200.25 20.5\n300.125 30.0\n"
+mz_correct = np.array([100.5, 200.25, 300.125])
+intensity_correct = np.array([10.0, 20.5, 30.0])
+
+class TestLocateSpectra(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_file = os.path.join(self.temp_dir.name, "test.mgf")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def readline_locations(self):
+        ## The readline()/tell() loop that inspect_file_location() used.
+        location_list = []
+        with open(self.input_file, "rb") as file_handle:
+            line = True
+            while line:
+                location = file_handle.tell()
+                line = file_handle.readline()
+                if line.startswith(b"BEGIN IONS"):
+                    location_list.append(location)
+        return location_list
+
+    def test_locations(self):
+        ## A BEGIN IONS inside a line is not a spectrum, CRLF line ends and a missing last newline are.
+        spectrum = spectrum_header + peak_lines + b"END IONS\n"
+        for text in [spectrum * 3,
+                     spectrum.replace(b"scan=100", b"BEGIN IONS") * 2,
+                     spectrum.replace(b"\n", b"\r\n") * 2 + b"\r\n",
+                     b"\n\n" + spectrum + spectrum.rstrip(b"\n")]:
+            with open(self.input_file, "wb") as file_handle:
+                file_handle.write(text)
+            location = mgf_io.locate_spectra(self.input_file)
+            self.assertEqual(location.dtype, np.int64)
+            self.assertEqual(location.tolist(), self.readline_locations())
+            for offset in location:
+                self.assertEqual(text[offset:offset + 10], b"BEGIN IONS")
+        self.assertEqual(len(mgf_io.locate_spectra(self.input_file)), 2)
+
+    def test_empty_file(self):
+        open(self.input_file, "wb").close()
+        self.assertEqual(mgf_io.locate_spectra(self.input_file).shape, (0,))
+
+class TestMgfIO(unittest.TestCase):
+
+    def check_peaks(self, peak_text, mz_max = None):
+        block = spectrum_header + peak_text
+        header_dict, peak_start = mgf_io.parse_header(block)
+        self.assertEqual(header_dict["PEPMASS"], "500.25")
+        return mgf_io.parse_peaks(block, peak_start, mz_max)
+
+    def test_parse_peaks_fast_path(self):
+        mz, intensity = self.check_peaks(peak_lines)
+        np.testing.assert_array_equal(mz, mz_correct)
+        np.testing.assert_array_equal(intensity, intensity_correct)
+
+        ## Without the last newline.
+        mz, intensity = self.check_peaks(peak_lines.rstrip(b"\n"))
+        np.testing.assert_array_equal(mz, mz_correct)
+        np.testing.assert_array_equal(intensity, intensity_correct)
+
+    def test_parse_peaks_fallback(self):
+        ## Blank lines, a 3-column peak line and CRLF line ends must give the same peaks as the clean lines.
+        for peak_text in [b"100.5 10.0\n\n200.25 20.5\n300.125 30.0\n\n",
+                          b"100.5 10.0 1\n200.25 20.5 1\n300.125 30.0\n",
+                          peak_lines.replace(b"\n", b"\r\n"),
+                          b"100.5 10.0\r\n\r\n200.25 20.5 2\r\n300.125 30.0\r\n"]:
+            mz, intensity = self.check_peaks(peak_text)
+            np.testing.assert_array_equal(mz, mz_correct)
+            np.testing.assert_array_equal(intensity, intensity_correct)
+
+    def test_parse_peaks_mz_max(self):
+        mz, intensity = self.check_peaks(peak_lines, mz_max = 250.0)
+        np.testing.assert_array_equal(mz, mz_correct[:2])
+        np.testing.assert_array_equal(intensity, intensity_correct[:2])
+
+    def test_parse_header_crlf(self):
+        block = spectrum_header.replace(b"\n", b"\r\n") + peak_lines.replace(b"\n", b"\r\n")
+        header_dict, peak_start = mgf_io.parse_header(block)
+        self.assertEqual(header_dict["SEQ"], "PEPTIDE")
+        self.assertEqual(header_dict["CHARGE"], "2+")
+        self.assertTrue(block[peak_start:].startswith(b"100.5"))
+
+    def test_block_without_peaks(self):
+        block = spectrum_header + b"END IONS\n"
+        header_dict, peak_start = mgf_io.parse_header(block)
+        self.assertEqual(len(header_dict), 4)
+        self.assertTrue(block[peak_start:].startswith(b"END IONS"))
+
+        ## read_spectrum_block() stops before END IONS, so the peak list is empty.
+        block = spectrum_header
+        header_dict, peak_start = mgf_io.parse_header(block)
+        mz, intensity = mgf_io.parse_peaks(block, peak_start)
+        self.assertEqual(mz.shape, (0,))
+        self.assertEqual(intensity.shape, (0,))
+
+    def test_header_scan(self):
+        self.assertEqual(mgf_io.header_scan({"SCANS": "F1:100", "TITLE": "run1 scan=7"}), "F1:100")
+        self.assertEqual(mgf_io.header_scan({"TITLE": "run1.100.100.2 scan=100"}), "scan100")
+        self.assertEqual(mgf_io.header_scan({"TITLE": "run1.100.100.2"}), "scan_run1.100.100.2")
+
+class TestMgfIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_file = os.path.join(self.temp_dir.name, "test.mgf")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_mgf(self, scan_list):
+        with open(self.input_file, "wb") as file_handle:
+            for scan in scan_list:
+                file_handle.write(spectrum_header.replace(b"scan=100", b"scan=" + scan) + peak_lines + b"END IONS\n")
+
+    def check_index(self, index, scan_list):
+        self.assertEqual(index["scans"].tolist(), ["scan" + x.decode() for x in scan_list])
+        self.assertEqual(index["offsets"].tolist(), mgf_io.locate_spectra(self.input_file).tolist())
+        self.assertEqual(index["peak_count"].tolist(), [3] * len(scan_list))
+
+    def test_index_rebuilt(self):
+        self.write_mgf([b"1", b"2", b"3"])
+        self.assertIsNone(mgf_io.load_index(self.input_file))
+        self.check_index(mgf_io.get_index(self.input_file), [b"1", b"2", b"3"])
+        self.assertTrue(os.path.exists(mgf_io.index_file(self.input_file)))
+        self.check_index(mgf_io.load_index(self.input_file), [b"1", b"2", b"3"])
+
+        ## A rewritten file of another size.
+        self.write_mgf([b"4", b"5"])
+        self.assertIsNone(mgf_io.load_index(self.input_file))
+        self.check_index(mgf_io.get_index(self.input_file), [b"4", b"5"])
+
+        ## The same size and mtime, another header.
+        file_stat = os.stat(self.input_file)
+        self.write_mgf([b"6", b"7"])
+        os.utime(self.input_file, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        self.assertIsNone(mgf_io.load_index(self.input_file))
+        self.check_index(mgf_io.get_index(self.input_file), [b"6", b"7"])
+
+        ## Only the mtime changed.
+        os.utime(self.input_file, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(mgf_io.load_index(self.input_file))
+        self.check_index(mgf_io.get_index(self.input_file), [b"6", b"7"])
+        self.assertIsNotNone(mgf_io.load_index(self.input_file))
+
+    def test_index_unreadable(self):
+        self.write_mgf([b"1", b"2"])
+        with open(mgf_io.index_file(self.input_file), "wb") as file_handle:
+            file_handle.write(b"not an index")
+        self.assertIsNone(mgf_io.load_index(self.input_file))
+        self.check_index(mgf_io.get_index(self.input_file), [b"1", b"2"])
+        self.check_index(mgf_io.load_index(self.input_file), [b"1", b"2"])
+
+class TestMgfWriter(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.mz = np.sort(rng.uniform(100.0, 2000.0, 50))
+        self.intensity = rng.uniform(0.0, 1e6, 50)
+        self.header = [("TITLE", "0.100"), ("PEPMASS", 500.25), ("CHARGE", "2+"), ("SCANS", "0:100")]
+
+    def baseline_text(self, mz, intensity):
+        ## The text mzml2kaiko.py wrote with print() before MgfWriter.
+        file_handle = io.StringIO()
+        print("BEGIN IONS", file = file_handle)
+        for name, value in self.header:
+            print("{0}={1}".format(name, value), file = file_handle)
+        for i in range(len(mz)):
+            print("{0} {1}".format(mz[i], intensity[i]), file = file_handle)
+        print("END IONS", file = file_handle)
+        return file_handle.getvalue()
+
+    def write_text(self, spectrum_count, **kwargs):
+        file_handle = io.StringIO()
+        with mgf_io.MgfWriter(file_handle, **kwargs) as writer:
+            for _ in range(spectrum_count):
+                writer.write_spectrum(self.header, self.mz, self.intensity)
+        return file_handle.getvalue()
+
+    def test_full_precision(self):
+        ## pyteomics gives float64 or float32 arrays.
+        for dtype in [np.float64, np.float32]:
+            mz = self.mz.astype(dtype)
+            intensity = self.intensity.astype(dtype)
+            file_handle = io.StringIO()
+            with mgf_io.MgfWriter(file_handle) as writer:
+                writer.write_spectrum(self.header, mz, intensity)
+            self.assertEqual(file_handle.getvalue(), self.baseline_text(mz, intensity))
+
+    def test_precision(self):
+        for precision in [0, 2, 4]:
+            lines = self.write_text(1, precision = precision).splitlines()
+            self.assertEqual(lines[:5], ["BEGIN IONS", "TITLE=0.100", "PEPMASS=500.25", "CHARGE=2+", "SCANS=0:100"])
+            self.assertEqual(lines[-1], "END IONS")
+            for line, mz, intensity in zip(lines[5:-1], self.mz, self.intensity):
+                self.assertEqual(line, "{0:.{2}f} {1:.{2}f}".format(mz, intensity, precision))
+            self.assertEqual(len(lines[5:-1]), len(self.mz))
+
+    def test_flush_on_exit(self):
+        ## Spectra larger than the buffer are written at once, the last ones by __exit__.
+        text = self.write_text(3)
+        self.assertEqual(text, self.baseline_text(self.mz, self.intensity) * 3)
+        self.assertEqual(self.write_text(3, buffer_size = 10), text)
+        self.assertEqual(self.write_text(3, buffer_size = len(text) - 1), text)
+
+        file_handle = io.StringIO()
+        writer = mgf_io.MgfWriter(file_handle, buffer_size = len(text))
+        writer.write_spectrum(self.header, self.mz, self.intensity)
+        self.assertEqual(file_handle.getvalue(), "")
+        writer.flush()
+        self.assertEqual(file_handle.getvalue(), text[:len(text) // 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
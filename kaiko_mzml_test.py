@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_config
+import deepnovo_main_modules
+import deepnovo_mgf_io
+import deepnovo_mzml
+import deepnovo_spectrum_store
+import mzml2kaiko
+from pyteomics import mzml
+
+## The mzML files of the tests hold a file name, pyteomics.mzml.read() is replaced by a reader of
+## the spectra generated for that name.
+
+def make_spectra(name, count = 4):
+    rng = np.random.default_rng(sum(name.encode()))
+    spectra = [{"ms level": 1, "id": "controllerType=0 scan=1"}]
+    for scan in range(2, count + 2):
+        mz = np.sort(rng.uniform(100.0, 1500.0, 30))
+        spectra.append({"ms level": 2,
+                        "id": "controllerType=0 controllerNumber=1 scan={0}".format(scan * 7),
+                        "m/z array": mz,
+                        "intensity array": rng.uniform(1.0, 1000.0, 30),
+                        "scanList": {"scan": [{"scan start time": 0.5 * scan}]},
+                        "precursorList": {"precursor": [{"selectedIonList": {"selectedIon": [
+                            {"selected ion m/z": float(rng.uniform(400.0, 900.0)), "charge state": 2}]}}]}})
+    return spectra
+
+def mock_read(file_handle, *args, **kwargs):
+    return iter(make_spectra(file_handle.read().decode()))
+
+def write_mgf(input_file, scan_list):
+    with open(input_file, "w") as file_handle:
+        for scan in scan_list:
+            file_handle.write("BEGIN IONS\nTITLE=mgf.{0}\nPEPMASS=500.0\nCHARGE=2+\nSCANS={0}\n"
+                              "RTINSECONDS=1.0\n100.0 10.0\n200.0 20.0\nEND IONS\n".format(scan))
+
+class TestMzmlFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_read = mzml.read
+        mzml.read = mock_read
+        self.saved_flags = {name: getattr(deepnovo_config.FLAGS, name) for name in ("beam_search", "direction")}
+        deepnovo_config.FLAGS.beam_search = True
+        deepnovo_config.FLAGS.direction = 2
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        mzml.read = self.saved_read
+        for name, value in self.saved_flags.items():
+            setattr(deepnovo_config.FLAGS, name, value)
+        self.temp_dir.cleanup()
+
+    def make_folder(self, name_list):
+        folder = os.path.join(self.temp_dir.name, "input")
+        os.makedirs(folder, exist_ok = True)
+        for name in name_list:
+            input_file = os.path.join(folder, name)
+            if name.endswith(".mzML"):
+                with open(input_file, "w") as file_handle:
+                    file_handle.write(deepnovo_mzml.mzml_name(name))
+            else:
+                write_mgf(input_file, ["F1:{0}".format(x) for x in range(3)])
+        return folder
+
+    def test_mzml_file_index(self):
+        input_files = ["x/c.mgf", "x/b.mzML", "x/a.mzML.gz", "x/a.kspec", "x/d.mzML", "x/b.mzML.gz"]
+        self.assertEqual(deepnovo_mzml.mzml_file_index(input_files),
+                         {"x/b.mzML": 0, "x/d.mzML": 1, "x/a.mzML.gz": 0, "x/b.mzML.gz": 1})
+
+    def test_decode_folder_ids(self):
+        ## mgf files, a spectrum store and mzML files in one folder, named so that the glob order and the
+        ## position of the mzML files among all files differ from their order among the mzML files.
+        folder = self.make_folder(["m2.mzML", "a.mgf", "z.mgf", "k.mgf", "m1.mzML", "b0.mzML"])
+        deepnovo_spectrum_store.convert_mgf(os.path.join(folder, "k.mgf"))
+        input_files = deepnovo_main_modules.collect_input_files(folder)
+        self.assertEqual([os.path.basename(x) for x in input_files],
+                         ["a.mgf", "b0.mzML", "k.kspec", "m1.mzML", "m2.mzML", "z.mgf"])
+
+        ## The SCANS ids written by mzml2kaiko.py.
+        out_dir = os.path.join(self.temp_dir.name, "converted")
+        mzml2kaiko.generate_mgf_files(folder, out_dir, gzipped = False)
+        converted_scans = {}
+        for name in ["b0", "m1", "m2"]:
+            out_file = os.path.join(out_dir, name + ".mgf")
+            converted_scans[name] = deepnovo_mgf_io.get_index(out_file)["scans"].tolist()
+        self.assertEqual(converted_scans["m1"][0], "1:14")
+
+        ## The ids of the spectra decoded directly, through the prefetching producer and through
+        ## read_stack_data_sets() with the file_index multi_decode() gives it.
+        mzml_file_index = deepnovo_mzml.mzml_file_index(input_files)
+        prefetch_items = deepnovo_main_modules.read_all_stack_data_sets(input_files, 3)
+        for input_file in input_files:
+            message, _ = next(prefetch_items)
+            self.assertEqual(message, "begin")
+            prefetch_scans = [x[0] for stack_data_set, _, _ in deepnovo_main_modules.iter_file_stack_data_sets(prefetch_items)
+                              for bucket in stack_data_set for x in bucket]
+            if deepnovo_mzml.is_mzml(input_file):
+                stack_data_sets = deepnovo_main_modules.read_stack_data_sets(input_file, None, 3,
+                                                                             mzml_file_index[input_file])
+                scans = [x[0] for stack_data_set, _, _ in stack_data_sets for bucket in stack_data_set for x in bucket]
+                self.assertEqual(sorted(scans), sorted(converted_scans[deepnovo_mzml.mzml_name(input_file)]))
+            else:
+                scans = ["F1:{0}".format(x) for x in range(3)]
+            self.assertEqual(sorted(prefetch_scans), sorted(scans))
+        self.assertEqual(list(prefetch_items), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
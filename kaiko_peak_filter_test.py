@@ -0,0 +1,57 @@
+import sys
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+from deepnovo_peak_filter import PeakFilter
+
+## Two 100 Da windows: [100, 200) and [200, 300).
+mz = np.array([110.0, 120.0, 130.0, 140.0, 210.0, 220.0, 230.0])
+intensity = np.array([50.0, 100.0, 5.0, 80.0, 60.0, 1.0, 70.0])
+
+class TestPeakFilter(unittest.TestCase):
+
+    def check_filter(self, peak_filter, mz_correct):
+        mz_kept, intensity_kept = peak_filter.filter(mz, intensity)
+        np.testing.assert_array_equal(mz_kept, mz_correct)
+        np.testing.assert_array_equal(intensity_kept, intensity[np.isin(mz, mz_correct)])
+
+    def test_disabled(self):
+        peak_filter = PeakFilter(top_n = 0, window_top_k = 0, min_intensity_ratio = 0.0)
+        self.assertFalse(peak_filter.enabled)
+        self.check_filter(peak_filter, mz)
+
+    def test_rules(self):
+        self.check_filter(PeakFilter(top_n = 3), [120.0, 140.0, 230.0])
+        self.check_filter(PeakFilter(top_n = 10), mz)
+        self.check_filter(PeakFilter(window_top_k = 2), [120.0, 140.0, 210.0, 230.0])
+        self.check_filter(PeakFilter(window_top_k = 1, window_size = 50.0), [120.0, 230.0])
+        self.check_filter(PeakFilter(min_intensity_ratio = 0.55), [120.0, 140.0, 210.0, 230.0])
+
+    def test_top_n_last(self):
+        ## top_n picks among the peaks kept by the window and ratio rules: 120 and 140 are the top 2
+        ## of the spectrum, but 140 is dropped by window_top_k = 1 and 230 takes its place.
+        self.check_filter(PeakFilter(top_n = 2, window_top_k = 1), [120.0, 230.0])
+        self.check_filter(PeakFilter(top_n = 3, window_top_k = 2, min_intensity_ratio = 0.65),
+                          [120.0, 140.0, 230.0])
+        self.check_filter(PeakFilter(top_n = 2, window_top_k = 2, min_intensity_ratio = 0.1),
+                          [120.0, 140.0])
+        self.check_filter(PeakFilter(top_n = 3, window_top_k = 3, min_intensity_ratio = 0.55),
+                          [120.0, 140.0, 230.0])
+        self.check_filter(PeakFilter(top_n = 4, window_top_k = 1), [120.0, 230.0])
+
+    def test_counts(self):
+        peak_filter = PeakFilter(top_n = 3)
+        peak_filter.filter(mz, intensity)
+        peak_filter.filter(mz[:2], intensity[:2])
+        peak_filter.filter(mz[:0], intensity[:0])
+        self.assertEqual((peak_filter.spectrum_count, peak_filter.peak_count, peak_filter.peak_count_kept),
+                         (3, 9, 5))
+        self.assertEqual(peak_filter.peak_count_dropped, 4)
+        self.assertEqual(peak_filter.summary(), "peak filter: 3 spectra, 5/9 peaks kept, 4 dropped (44.4%)")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+### python kaiko_precision_check.py --precision bfloat16 --beam_size 5
+
+# Decode the mgf_large_unit_test spectra in float32 and in a reduced
+# precision (--inference_precision), then report the run times and how many
+# top-1 sequences of the _out.txt files changed.
+
+import argparse
+
+import unit_test_util as util
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare reduced-precision decoding against float32.")
+    parser.add_argument("--precision", default = "bfloat16", choices = ["bfloat16", "float16"])
+    parser.add_argument("--beam_size", type = int, default = 5)
+    args = parser.parse_args()
+
+    reference_dir, reference_time = util.run_precision("float32", args.beam_size)
+    test_dir, test_time = util.run_precision(args.precision, args.beam_size)
+
+    counts = util.compare_top1_sequences(reference_dir, test_dir)
+    total_scans = sum(x[1] for x in counts)
+    total_changed = sum(x[2] for x in counts)
+
+    print("file\tscans\tchanged")
+    for name, scans, changed in counts:
+        print("{a1}\t{a2}\t{a3}".format(a1 = name, a2 = scans, a3 = changed))
+    print("total: {a1}/{a2} top-1 sequences changed ({a3:.2f}%)".format(
+        a1 = total_changed, a2 = total_scans, a3 = 100.0 * total_changed / max(total_scans, 1)))
+    print("time: float32 {a1:.1f} s, {a2} {a3:.1f} s ({a4:.2f}x)".format(
+        a1 = reference_time, a2 = args.precision, a3 = test_time, a4 = reference_time / max(test_time, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+from deepnovo_prefetch import Prefetcher
+
+## The producers run in a spawned worker, they must be module-level functions.
+
+def produce_items(count):
+    for index in range(count):
+        yield {"index": index, "square": index * index}
+
+def produce_error(count):
+    for index in range(count):
+        yield index
+    raise ValueError("bad spectrum stack")
+
+def produce_exit(count):
+    for index in range(count):
+        yield index
+    os._exit(3)
+
+class TestPrefetcher(unittest.TestCase):
+
+    def test_items(self):
+        with Prefetcher(produce_items, args = (7,), depth = 2) as prefetcher:
+            items = list(prefetcher)
+            self.assertEqual(items, [{"index": x, "square": x * x} for x in range(7)])
+            self.assertIsNone(prefetcher.process)
+            self.assertEqual(prefetcher.item_count, 7)
+            self.assertIsNotNone(prefetcher.producer_wait)
+            summary = prefetcher.summary()
+        self.assertTrue(summary.startswith("prefetch: 7 items, consumer stalled "), summary)
+        self.assertIn("/2", summary)
+        self.assertIn("producer blocked", summary)
+
+    def test_empty(self):
+        with Prefetcher(produce_items, args = (0,)) as prefetcher:
+            self.assertEqual(list(prefetcher), [])
+            self.assertTrue(prefetcher.summary().startswith("prefetch: 0 items"))
+
+    def test_error(self):
+        ## The items before the error are delivered, then the traceback of the worker is raised.
+        items = []
+        with Prefetcher(produce_error, args = (3,)) as prefetcher:
+            with self.assertRaises(RuntimeError) as context:
+                for item in prefetcher:
+                    items.append(item)
+            self.assertIsNone(prefetcher.process)
+        self.assertEqual(items, [0, 1, 2])
+        self.assertIn("worker failed", str(context.exception))
+        self.assertIn("ValueError: bad spectrum stack", str(context.exception))
+
+    def test_worker_exit(self):
+        with Prefetcher(produce_exit, args = (2,)) as prefetcher:
+            with self.assertRaises(RuntimeError) as context:
+                list(prefetcher)
+        self.assertIn("worker exited with code 3", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Kaiko_denovo" / "src"))
+import deepnovo_config
+import deepnovo_main_modules
+import deepnovo_mgf_io
+import deepnovo_spectrum_store
+
+## (SEQ, charge, peak count) of the test spectra; None means no SEQ line.
+spectrum_list = [("PEPTIDEK", 2, 40),
+                 ("ADM(+15.99)KQ(+.98)", 2, 40),
+                 ("PEPT(+42.01)IDEK", 2, 40),      # unknown modification
+                 ("PEPXIDEK", 2, 40),              # unknown AA
+                 ("G" * 40, 1, 40),                # longer than MAX_LEN
+                 ("W" * 25, 1, 40),                # heavier than MZ_MAX
+                 (None, 3, 40),
+                 ("GASPK", 2, 0),                  # no peaks
+                 ("SAMPLER", 3, 40)]
+read_count = 5
+
+def peptide_mass(seq):
+    ## Unknown residues weigh 100 Da, they are skipped anyway.
+    peptide = []
+    for aa in seq.replace("(+15.99)", "*").replace("(+.98)", "*").replace("(+42.01)", ""):
+        if aa == "*":
+            peptide[-1] += "mod"
+        else:
+            peptide.append(aa)
+    return (sum(deepnovo_config.mass_AA.get(aa, 100.0) for aa in peptide)
+            + deepnovo_config.mass_N_terminus + deepnovo_config.mass_C_terminus)
+
+def write_mgf(input_file, seed = 0):
+    ## Random peaks, a few of them above MZ_MAX.
+    rng = np.random.default_rng(seed)
+    with open(input_file, "w") as file_handle:
+        for scan, (seq, charge, peak_count) in enumerate(spectrum_list):
+            mass = peptide_mass(seq) if seq else 1500.0
+            file_handle.write("BEGIN IONS\n")
+            file_handle.write("TITLE=test.{0}.{0}.{1} scan={0}\n".format(scan, charge))
+            file_handle.write("PEPMASS={0}\n".format(mass / charge + deepnovo_config.mass_H))
+            file_handle.write("CHARGE={0}+\n".format(charge))
+            file_handle.write("SCANS=F1:{0}\n".format(scan))
+            file_handle.write("RTINSECONDS={0}\n".format(10.0 * scan))
+            if seq:
+                file_handle.write("SEQ={0}\n".format(seq))
+            mz = np.sort(rng.uniform(50.0, min(mass, deepnovo_config.MZ_MAX) + 20.0, peak_count))
+            for x, y in zip(mz, rng.uniform(1.0, 1000.0, peak_count)):
+                file_handle.write("{0:.4f} {1:.2f}\n".format(x, y))
+            file_handle.write("END IONS\n")
+
+class TestReadSpectra(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_flags = {name: getattr(deepnovo_config.FLAGS, name) for name in ("beam_search", "direction")}
+        deepnovo_config.FLAGS.beam_search = True
+        deepnovo_config.FLAGS.direction = 2
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_file = os.path.join(self.temp_dir.name, "test.mgf")
+        write_mgf(self.input_file)
+
+    def tearDown(self):
+        for name, value in self.saved_flags.items():
+            setattr(deepnovo_config.FLAGS, name, value)
+        self.temp_dir.cleanup()
+
+    def read_spectra(self, input_file = None):
+        input_file = input_file or self.input_file
+        spectra_file_location = deepnovo_main_modules.inspect_file_location("mgf", input_file)
+        with deepnovo_main_modules.open_spectra_file(input_file) as file_handle:
+            data_set, counts = deepnovo_main_modules.read_spectra(file_handle, "mgf", spectra_file_location)
+        return [x for bucket in data_set for x in bucket], counts
+
+    def test_skip_before_peaks(self):
+        ## The peaks of the skipped spectra are not parsed.
+        parse_peaks = deepnovo_mgf_io.parse_peaks
+        parse_count = [0]
+        def counting_parse_peaks(*args, **kwargs):
+            parse_count[0] += 1
+            return parse_peaks(*args, **kwargs)
+        deepnovo_mgf_io.parse_peaks = counting_parse_peaks
+        try:
+            data_set, counts = self.read_spectra()
+        finally:
+            deepnovo_mgf_io.parse_peaks = parse_peaks
+
+        self.assertEqual(parse_count[0], read_count)
+        ## The spectrum without peaks is read, then skipped.
+        self.assertEqual(counts[:6], [read_count, 5, 1, 1, 1, 1])
+        self.assertEqual(sorted(x[0] for x in data_set), ["F1:0", "F1:1", "F1:6", "F1:8"])
+
+    def test_spectrum_store(self):
+        store_dir = deepnovo_spectrum_store.convert_mgf(self.input_file)
+        self.assertEqual(store_dir, os.path.join(self.temp_dir.name, "test.kspec"))
+        self.assertTrue(deepnovo_spectrum_store.is_store(store_dir))
+        spectra_file_location = deepnovo_main_modules.inspect_file_location("mgf", self.input_file)
+
+        ## Each spectrum of the store against the mgf, the store keeps float32 peaks and rebuilds the header.
+        with deepnovo_spectrum_store.SpectrumStore(store_dir) as store, open(self.input_file, "rb") as file_handle:
+            self.assertEqual(len(store), len(spectrum_list))
+            self.assertEqual(store.get_location(), list(range(len(spectrum_list))))
+            for location, mgf_location in enumerate(spectra_file_location):
+                header_dict, mz, intensity = store.read_spectrum(location, deepnovo_config.MZ_MAX)
+                mgf_header_dict, mgf_mz, mgf_intensity = deepnovo_mgf_io.read_spectrum(file_handle, mgf_location,
+                                                                                        deepnovo_config.MZ_MAX)
+                self.assertEqual(mz.dtype, np.float32)
+                np.testing.assert_array_equal(mz, mgf_mz.astype(np.float32))
+                np.testing.assert_array_equal(intensity, mgf_intensity.astype(np.float32))
+                self.assertEqual(deepnovo_mgf_io.header_scan(header_dict), deepnovo_mgf_io.header_scan(mgf_header_dict))
+                self.assertEqual(header_dict.get("SEQ"), mgf_header_dict.get("SEQ"))
+                for name in ["PEPMASS", "RTINSECONDS"]:
+                    self.assertEqual(float(header_dict[name]), float(mgf_header_dict[name]))
+                self.assertEqual(float(header_dict["CHARGE"]), float(mgf_header_dict["CHARGE"].split("+")[0]))
+            self.assertEqual(store.read_spectrum(7)[1].shape, (0,))
+
+        ## read_spectra() of the store against read_spectra() of the mgf it came from.
+        data_set, counts = self.read_spectra(store_dir)
+        mgf_data_set, mgf_counts = self.read_spectra()
+        self.assertEqual(counts, mgf_counts)
+        self.assertEqual([x[0] for x in data_set], [x[0] for x in mgf_data_set])
+        for entry, mgf_entry in zip(data_set, mgf_data_set):
+            self.assertEqual(entry[4:], mgf_entry[4:])
+            for spectrum, mgf_spectrum in zip(entry[1:4], mgf_entry[1:4]):
+                np.testing.assert_array_equal(spectrum[0], mgf_spectrum[0])
+                np.testing.assert_allclose(spectrum[1], mgf_spectrum[1], rtol = 1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
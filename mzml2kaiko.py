@@ -8,32 +8,26 @@ import os
 import sys
 
 import argparse
+import concurrent.futures
+import copy
+import functools
 
-########################################################
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    '--mzml_dir', type=str,
-    help='mzML directory')
-parser.add_argument(
-    '--out_dir', type=str,
-    help='output directory')
-parser.add_argument(
-    '--gz', action='store_true',
-    help='mzML.gz?')
-
-FLAGS = parser.parse_args()
-########################################################
+# share the spectrum store with the decoder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Kaiko_denovo', 'src'))
+import deepnovo_mgf_io
+import deepnovo_mzml
+import deepnovo_peak_filter
+import deepnovo_spectrum_store
 
 def inspect_mzML_file(fpath, gzipped=True):
-    spectra = []
+    # yield spectra one at a time, so that memory does not grow with the run size
     if gzipped:
         f = gzip.open(fpath, 'rb')
     else:
-        f = fpath
-    for obj in mzml.read(f):
-        spectra.append(obj)
-    if gzipped: f.close()
-    return spectra
+        f = open(fpath, 'rb')
+    with f:
+        for obj in mzml.read(f):
+            yield obj
 
 # start_time = time.time()
 
@@ -41,9 +35,12 @@ def inspect_mzML_file(fpath, gzipped=True):
 # end_time = time.time()
 # print('Num:{0}, time:{1}'.format(len(spectra), end_time-start_time))
 
-def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=500, out_file='out.mgf'):
+def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=None, out_file='out.mgf', precision=None, peak_filter=None):
+    # ntops: keep the ntops most intense peaks, peak_filter: any other peak picking
+    if peak_filter is None:
+        peak_filter = deepnovo_peak_filter.PeakFilter(top_n=ntops)
     num_spectra = 0
-    with open(out_file, 'w') as f:
+    with open(out_file, 'w') as f, deepnovo_mgf_io.MgfWriter(f, precision=precision) as writer:
         for spectrum in mzml_spectra:
             if spectrum['ms level'] != 2:
                 continue
@@ -56,66 +53,83 @@ def generate_mgf_without_annotation(mzml_spectra, file_index=0, ntops=500, out_f
                 selectedIon = spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]
 
                 assert len(mz_arr) == len(int_arr), "[ERR] Wrong data format: len(mz_arr) != len(int_arr)"
+                mz_arr, int_arr = peak_filter.filter(mz_arr, int_arr)
 
-                print("BEGIN IONS", file=f)
-                print("TITLE={0}.{1}".format(file_index, scan), file=f)
-                print("PEPMASS={0}".format(selectedIon['selected ion m/z']), file=f)
                 # sometimes they don't have a charge info. if so, we use the annotation file
                 if 'charge state' in selectedIon:
-                    print("CHARGE={0:d}+".format(int(selectedIon['charge state'])), file=f)
+                    charge = int(selectedIon['charge state'])
                 else:
-                    print("CHARGE={0:d}+".format(999), file=f)
-                print("SCANS={0}:{1}".format(file_index, scan), file=f)
-                print("RTINSECONDS={0}".format(rtsec), file=f)
-                print("SEQ=UNKNOWN", file=f)
-                for i in range(len(mz_arr)):
-                    print("{0} {1}".format(mz_arr[i], int_arr[i]), file=f)
-                print("END IONS", file=f)
+                    charge = 999
+                header = [("TITLE", "{0}.{1}".format(file_index, scan)),
+                          ("PEPMASS", selectedIon['selected ion m/z']),
+                          ("CHARGE", "{0:d}+".format(charge)),
+                          ("SCANS", "{0}:{1}".format(file_index, scan)),
+                          ("RTINSECONDS", rtsec),
+                          ("SEQ", "UNKNOWN")]
+                writer.write_spectrum(header, mz_arr, int_arr)
                 num_spectra += 1
             except:
                 print('[ERR]', scan, spectrum)
                 continue
                     
-        return num_spectra
+    return num_spectra
 
-def generate_mgf_files(data_dir, dest_dir='./', gzipped=True):
-    # collect mzML.gz files
+def generate_kspec_without_annotation(mzml_spectra, file_index=0, out_file='out.kspec', peak_filter=None):
+    if peak_filter is None:
+        peak_filter = deepnovo_peak_filter.PeakFilter()
+    num_spectra = 0
+    with deepnovo_spectrum_store.SpectrumStoreWriter(out_file) as writer:
+        for spectrum in mzml_spectra:
+            try:
+                ms2_spectrum = deepnovo_mzml.parse_ms2_spectrum(spectrum, file_index)
+            except:
+                print('[ERR]', spectrum.get('id'), spectrum)
+                continue
+            if ms2_spectrum is None:
+                continue
+            mz_arr, int_arr = peak_filter.filter(ms2_spectrum['mz'], ms2_spectrum['intensity'])
+            writer.append(scan=ms2_spectrum['scan'],
+                          pepmass=ms2_spectrum['pepmass'],
+                          charge=ms2_spectrum['charge'],
+                          rtinseconds=ms2_spectrum['rtinseconds'],
+                          seq='',
+                          mz=mz_arr,
+                          intensity=int_arr)
+            num_spectra += 1
+    return num_spectra
+
+def convert_mzML_file(i, mzML_file, data_dir, dest_dir, gzipped=True, out_format='mgf', precision=None, peak_filter=None):
+    # convert one mzML file, returns (i, common_name, num_spectra, num_scans, msg, run_time)
+    file_start_time = time.time()
     if gzipped:
-        mzML_files = glob.glob(data_dir + "/*.mzML.gz")
+        common_name = os.path.basename(mzML_file).rsplit('.mzML.gz')[0]
     else:
-        mzML_files = glob.glob(data_dir + "/*.mzML")
-    
-    if not os.path.exists(dest_dir):
-        os.makedirs(dest_dir)
+        common_name = os.path.basename(mzML_file).rsplit('.mzML')[0]
 
-    mzML_log_handler = open(dest_dir + '/mgf_list.log', 'w+')
-    print("id\tmgf_file\tnum_scans\ttotal_scans", file=mzML_log_handler)
-    
-    start_time = time.time()
-    num_mzML_files = len(mzML_files)
-    total_scans = 0
-    for i, mzML_file in enumerate(mzML_files):
+    # outputs are renamed into place once complete, so an existing one is never partial
+    out_file = dest_dir + '/' + common_name + '.' + out_format
+    if os.path.exists(out_file):
+        return i, common_name, 0, 0, "EXISTS", time.time()-file_start_time
+
+    seq_file = glob.glob(data_dir + '/' + common_name + "*.txt")
+    mzml_spectra = inspect_mzML_file(mzML_file, gzipped)
+    # a fresh copy per file, so that the counters report this file only
+    if peak_filter is None:
+        peak_filter = deepnovo_peak_filter.PeakFilter()
+    else:
+        peak_filter = copy.copy(peak_filter)
+
+    if out_format == 'kspec':
+        # SpectrumStoreWriter already writes to a temporary folder
+        num_spectra = generate_kspec_without_annotation(mzml_spectra,
+                                                        file_index=i,
+                                                        out_file=out_file,
+                                                        peak_filter=peak_filter)
+        num_scans = num_spectra
+    else:
+        temp_file = '{0}.{1:d}.tmp'.format(out_file, os.getpid())
         try:
-            if gzipped:
-                common_name = os.path.basename(mzML_file).rsplit('.mzML.gz')[0]
-            else:
-                common_name = os.path.basename(mzML_file).rsplit('.mzML')[0]
-        
-            if os.path.exists(dest_dir + '/' + common_name + '.mgf'):
-                print('[{0:3d}/{1:3d}] {2}, Already exists' \
-                      .format(i+1,
-                              num_mzML_files,
-                              common_name))
-                continue
-                
-        
-            seq_file = glob.glob(data_dir + '/' + common_name + "*.txt")
-            msg = ""
-            scan_ids = []
-            num_spectra = 0
-            mzml_spectra = inspect_mzML_file(mzML_file, gzipped)
-            
-            if len(seq_file) == 1:    
+            if len(seq_file) == 1:
                 annotated = get_annotated_pepseq(seq_file[0])
                 scan_ids = list(annotated.Scan)
                 pepseqs = list(annotated.pepseq)
@@ -126,28 +140,137 @@ def generate_mgf_files(data_dir, dest_dir='./', gzipped=True):
                                            pepseqs,
                                            charges,
                                            file_index = i,
-                                           out_file=dest_dir + '/' + common_name + '.mgf')
+                                           out_file=temp_file)
             else:
                 num_spectra = generate_mgf_without_annotation(mzml_spectra,
                                                               file_index=i,
-                                                              out_file=dest_dir + '/' + common_name + '.mgf')
+                                                              out_file=temp_file,
+                                                              precision=precision,
+                                                              peak_filter=peak_filter)
                 num_scans = num_spectra
-            total_scans += num_spectra
-            msg = "SUCCESS"
-            print('[{0:3d}/{1:3d}] {2}, {3:d}/{4:d}/{5:d}, {6:.2f}sec' \
-                      .format(i+1,
-                              num_mzML_files,
-                              common_name,
-                              num_spectra,
-                              num_scans,
-                              total_scans,
-                              time.time()-start_time))
-            print("{0}\t{1}\t{2}\t{3}".format(i, common_name, num_spectra, total_scans), file=mzML_log_handler)
+            os.replace(temp_file, out_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    if peak_filter.enabled:
+        print('{0}, {1}'.format(common_name, peak_filter.summary()))
+        sys.stdout.flush()
+    return i, common_name, num_spectra, num_scans, "SUCCESS", time.time()-file_start_time
+
+def generate_mgf_files(data_dir, dest_dir='./', gzipped=True, out_format='mgf', workers=1, precision=None, peak_filter=None):
+    # collect mzML.gz files, sorted so that file_index does not depend on the glob order
+    if gzipped:
+        mzML_files = sorted(glob.glob(data_dir + "/*.mzML.gz"))
+    else:
+        mzML_files = sorted(glob.glob(data_dir + "/*.mzML"))
+    
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    mzML_log_handler = open(dest_dir + '/mgf_list.log', 'w+')
+    print("id\tmgf_file\tnum_scans\ttotal_scans", file=mzML_log_handler)
+    
+    start_time = time.time()
+    num_mzML_files = len(mzML_files)
+    total_scans = 0
+    # files may finish out of order with several workers, the log is written
+    # in file_index order as soon as all the previous files are done;
+    # files that already exist are skipped without a log entry, as before
+    finished = {}
+    next_index = 0
+    logged_scans = 0
+
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        futures = {executor.submit(convert_mzML_file, i, mzML_file, data_dir, dest_dir, gzipped, out_format, precision, peak_filter): (i, mzML_file)
+                   for i, mzML_file in enumerate(mzML_files)}
+        jobs = ((futures[future], future.result) for future in concurrent.futures.as_completed(futures))
+    else:
+        executor = None
+        jobs = (((i, mzML_file), functools.partial(convert_mzML_file, i, mzML_file, data_dir, dest_dir, gzipped, out_format, precision, peak_filter))
+                for i, mzML_file in enumerate(mzML_files))
+
+    try:
+        for (i, mzML_file), job in jobs:
+            try:
+                i, common_name, num_spectra, num_scans, msg, run_time = job()
+            except Exception as e:
+                print('[ERR] {}'.format(mzML_file))
+                print('[ERR]', e)
+                finished[i] = None
+            else:
+                if msg == "EXISTS":
+                    finished[i] = None
+                    print('[{0:3d}/{1:3d}] {2}, Already exists' \
+                          .format(i+1,
+                                  num_mzML_files,
+                                  common_name))
+                else:
+                    finished[i] = (common_name, num_spectra)
+                    total_scans += num_spectra
+                    print('[{0:3d}/{1:3d}] {2}, {3:d}/{4:d}/{5:d}, {6:.2f}sec, {7:.1f} spectra/sec' \
+                              .format(i+1,
+                                      num_mzML_files,
+                                      common_name,
+                                      num_spectra,
+                                      num_scans,
+                                      total_scans,
+                                      time.time()-start_time,
+                                      num_spectra/max(run_time, 1e-9)))
+            while next_index in finished:
+                entry = finished.pop(next_index)
+                if entry is not None:
+                    logged_scans += entry[1]
+                    print("{0}\t{1}\t{2}\t{3}".format(next_index, entry[0], entry[1], logged_scans), file=mzML_log_handler)
+                    mzML_log_handler.flush()
+                next_index += 1
             sys.stdout.flush()
-        except Exception as e:
-            print('[ERR] {}'.format(mzML_file))
-            print('[ERR]', e)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        mzML_log_handler.close()
+    print('{0:d} files, {1:d} spectra, {2:.2f}sec'.format(num_mzML_files, total_scans, time.time()-start_time))
         
 
 if __name__ == "__main__":
-    generate_mgf_files(FLAGS.mzml_dir, FLAGS.out_dir, FLAGS.gz)
+    ########################################################
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--mzml_dir', type=str,
+        help='mzML directory')
+    parser.add_argument(
+        '--out_dir', type=str,
+        help='output directory')
+    parser.add_argument(
+        '--gz', action='store_true',
+        help='mzML.gz?')
+    parser.add_argument(
+        '--format', type=str, default='mgf', choices=['mgf', 'kspec'],
+        help='output format, text mgf or binary spectrum store (kspec)')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of mzML files converted in parallel')
+    parser.add_argument(
+        '--precision', type=int, default=None,
+        help='decimals of the peaks in mgf files (default: full precision)')
+    parser.add_argument(
+        '--ntops', type=int, default=0,
+        help='keep the ntops most intense peaks of each spectrum (0: all)')
+    parser.add_argument(
+        '--window_top_k', type=int, default=0,
+        help='keep the top k most intense peaks per m/z window (0: all)')
+    parser.add_argument(
+        '--window_size', type=float, default=100.0,
+        help='m/z window (Da) of --window_top_k')
+    parser.add_argument(
+        '--min_intensity_ratio', type=float, default=0.0,
+        help='drop the peaks below this fraction of the base peak (0: none)')
+
+    FLAGS = parser.parse_args()
+    ########################################################
+
+    generate_mgf_files(FLAGS.mzml_dir, FLAGS.out_dir, FLAGS.gz, FLAGS.format, FLAGS.workers, FLAGS.precision,
+                       deepnovo_peak_filter.PeakFilter(top_n=FLAGS.ntops,
+                                                       window_top_k=FLAGS.window_top_k,
+                                                       window_size=FLAGS.window_size,
+                                                       min_intensity_ratio=FLAGS.min_intensity_ratio))
@@ -2,6 +2,7 @@ import os
 import glob
 import random
 import subprocess
+import time
 import yaml
 
 from pathlib import Path, PureWindowsPath
@@ -129,6 +130,56 @@ def make_new_test_input(mgf_dir, proportion = 0.007, seed = 117):
 
     
 
+def run_precision(precision, beam_size = 5):
+    ## Decode mgf_large_unit_test with --inference_precision, return the output folder and the run time.
+    mgf_dir = Path('Kaiko_volume/Kaiko_input_files/mgf_large_unit_test')
+    denovout_dir = Path('Kaiko_volume/Kaiko_intermediate/denovo_output/'
+                        + "{a1}_precision_{a2}_beam_size_{a3}".format(a1 = mgf_dir.name, a2 = precision, a3 = beam_size))
+    if not denovout_dir.exists():
+        denovout_dir.mkdir(parents = True)
+    ## the decoder appends to the _out.txt files
+    for out_file in denovout_dir.glob("*_out.txt"):
+        out_file.unlink()
+
+    kaiko_1_args = ["python", "src/kaiko_main.py",
+                    "--mgf_dir", mgf_dir.resolve(),
+                    "--train_dir", "model/",
+                    "--decode_dir", denovout_dir.resolve(),
+                    "--multi_decode",
+                    "--beam_search", "--beam_size", beam_size,
+                    "--inference_precision", precision]
+    kaiko_1_args = [str(x) for x in kaiko_1_args]
+    print(" ".join(kaiko_1_args) + "\n")
+
+    start_time = time.time()
+    subprocess.run(kaiko_1_args, cwd = "Kaiko_denovo", check = True)
+    return denovout_dir, time.time() - start_time
+
+
+def read_top1_sequences(out_file):
+    ## {scan: output_seq} of a decode _out.txt file.
+    sequences = {}
+    with open(out_file) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        scan_index, seq_index = header.index("scan"), header.index("output_seq")
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > seq_index:
+                sequences[fields[scan_index]] = fields[seq_index]
+    return sequences
+
+
+def compare_top1_sequences(reference_dir, test_dir):
+    ## Count, per _out.txt file, the scans whose top-1 sequence differs from the reference.
+    ## Returns a list of (file name, scans, changed).
+    counts = []
+    for reference_file in sorted(Path(reference_dir).glob("*_out.txt")):
+        reference = read_top1_sequences(reference_file)
+        test_file = Path(test_dir) / reference_file.name
+        test = read_top1_sequences(test_file) if test_file.exists() else {}
+        changed = sum(1 for scan, seq in reference.items() if test.get(scan) != seq)
+        counts.append((reference_file.name, len(reference), changed))
+    return counts
 
 
 